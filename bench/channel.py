@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Reports the time a Channel takes per message, sending to a receiver
+attached with attach(), to several of them, to a watch() subscriber, past
+subscribers filtering out every message, and buffering until the
+messages are received, one by one or in batches.
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from kitsh.core.inout import Channel, Message, DATA, RESIZE
+
+
+MSG = Message(DATA, b'x' * 64)
+
+
+def attached(count, batch):
+    chan = Channel()
+    received = []
+    chan.attach(received.append)
+    msgs = [MSG] * batch
+    started = time.time()
+    if batch > 1:
+        for _ in range(count // batch):
+            chan.send_many(msgs)
+    else:
+        for _ in range(count):
+            chan.send(MSG)
+    return time.time() - started
+
+
+def broadcast(count, batch, receivers=8):
+    chan = Channel()
+    for _ in range(receivers):
+        chan.attach([].append)
+    started = time.time()
+    for _ in range(count):
+        chan.send(MSG)
+    return time.time() - started
+
+
+def watched(count, batch):
+    chan = Channel()
+    sub = chan.watch()
+    started = time.time()
+    for _ in range(count):
+        chan.send(MSG)
+        sub.recv()
+    return time.time() - started
+
+
+def filtered(count, batch, watchers=8):
+    chan = Channel()
+    subs = [chan.watch(kinds=(RESIZE,)) for _ in range(watchers)]
+    started = time.time()
+    for _ in range(count):
+        chan.send(MSG)
+    assert not any(len(sub) for sub in subs)
+    return time.time() - started
+
+
+def buffered(count, batch):
+    chan = Channel()
+    started = time.time()
+    for _ in range(count // batch):
+        for _ in range(batch):
+            chan.send(MSG)
+        if batch > 1:
+            chan.recv_many()
+        else:
+            chan.recv()
+    return time.time() - started
+
+
+CASES = dict(attached=attached, broadcast=broadcast, watched=watched,
+             filtered=filtered, buffered=buffered)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', '-n', type=int, default=200000)
+    parser.add_argument('--batch', '-b', type=int, default=64,
+                        help='Messages per send_many/recv_many')
+    parser.add_argument('--repeat', '-r', type=int, default=5,
+                        help='Report the best of this many runs')
+    parser.add_argument('cases', nargs='*', default=sorted(CASES),
+                        help='Any of: %s' % (', '.join(sorted(CASES)),))
+    args = parser.parse_args()
+    for name in args.cases:
+        case = CASES[name]
+
+        def best(batch):
+            return min(case(args.messages, batch)
+                       for _ in range(args.repeat))
+        single = best(1)
+        print("%-10s %7.0f ns/msg" % (name, single / args.messages * 1e9),
+              end='')
+        if name in ('attached', 'buffered'):
+            batched = best(args.batch)
+            print(", %7.0f ns/msg in batches of %d" % (
+                batched / args.messages * 1e9, args.batch), end='')
+        print()
+
+
+if __name__ == "__main__":
+    main()
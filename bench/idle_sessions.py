@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Reports the memory used per idle session.
+
+A session is modelled like the web UI's: two tasks, each blocked reading
+its input, with their channels bridged together. No processes or sockets
+are created, so only the Python side of a session is measured.
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import tracemalloc
+
+import gevent
+
+from kitsh.core.task import TaskManager
+
+
+class IdleTask(object):
+    __slots__ = ()
+
+    def run(self, task):
+        for _ in task.input:
+            pass
+
+
+def rss():
+    with open('/proc/self/statm') as handle:
+        return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def spawn_sessions(count, bridged):
+    sessions = []
+    for _ in range(count):
+        front = TaskManager.spawn(IdleTask())
+        back = TaskManager.spawn(IdleTask())
+        bridge = front.bridge(back) if bridged else None
+        sessions.append((front, back, bridge))
+    # Let every task start and block on its input
+    gevent.sleep(0)
+    return sessions
+
+
+def measure(count, bridged):
+    gc.collect()
+    tracemalloc.start()
+    rss_before = rss()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = spawn_sessions(count, bridged)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    rss_after = rss()
+    tracemalloc.stop()
+    for front, back, bridge in sessions:
+        if bridge is not None:
+            bridge.close()
+        front.stop()
+        back.stop()
+    gevent.sleep(0)
+    return (after - before) / float(count), (rss_after - rss_before) / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', '-n', type=int, default=10000)
+    parser.add_argument('--unbridged', action='store_true',
+                        help='Leave the two tasks of a session unconnected')
+    args = parser.parse_args()
+    traced, resident = measure(args.sessions, not args.unbridged)
+    print("%d idle sessions: %.0f bytes/session traced, %.0f bytes/session RSS" % (
+        args.sessions, traced, resident))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Finds how many concurrent sessions one kitsh server handles, by ramping up
+the number of websocket sessions replaying keystrokes against it.
+
+Every session speaks the protocol of kitsh/client.py to /websocket and
+types its trace, a script or a recording made with `client.py --record`,
+in a loop. The time from sending a key to the first output after it is
+the echo latency. For each step of the ramp the p50/p99/p999 latency,
+the output received per second and the server's CPU and RSS are
+reported, and with --output written as JSON lines for comparing
+versions.
+
+Unless --url is given a server is started on localhost for the test.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import gevent
+from gevent.pool import Pool
+from gevent.queue import Queue, Empty
+
+from kitsh.agent import connect
+from kitsh.client import encode_data, encode_resize, decode
+from kitsh.core.process import cpu_seconds, rss_bytes
+
+
+# Typed into the shell when no trace is given
+SCRIPT = [dict(delay=0.1, data=key) for key in "echo hello world\n"]
+
+
+def load_trace(filename):
+    with open(filename) as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Session(object):
+    """
+    One client replaying a trace, collecting the echo latency of every key
+    """
+    __slots__ = ('_url', '_trace', '_timeout', '_ws', '_output',
+                 'latencies', 'received', 'errors')
+
+    def __init__(self, url, trace, timeout=5.0):
+        self._url = url
+        self._trace = trace
+        self._timeout = timeout
+        self._ws = None
+        self._output = Queue()
+        self.latencies = []
+        self.received = 0
+        self.errors = 0
+
+    def connect(self):
+        self._ws = connect(self._url)
+        self._ws.send(encode_resize(24, 80))
+        gevent.spawn(self._reader)
+
+    def _reader(self):
+        try:
+            while True:
+                data = decode(self._ws.recv())
+                self.received += len(data)
+                self._output.put(time.time())
+        except Exception:
+            self._output.put(None)
+
+    def run(self, until):
+        try:
+            while time.time() < until:
+                for step in self._trace:
+                    gevent.sleep(step.get('delay', 0))
+                    if time.time() >= until:
+                        break
+                    self._key(step['data'])
+        except Exception:
+            self.errors += 1
+
+    def _key(self, data):
+        # Output still arriving from the previous key doesn't count
+        while not self._output.empty():
+            if self._output.get() is None:
+                raise EOFError()
+        sent = time.time()
+        self._ws.send(encode_data(data))
+        try:
+            echoed = self._output.get(timeout=self._timeout)
+        except Empty:
+            self.errors += 1
+            return
+        if echoed is None:
+            raise EOFError()
+        self.latencies.append(echoed - sent)
+
+    def close(self):
+        if self._ws is not None:
+            self._ws.shutdown()
+
+
+def run_step(url, count, trace, duration, concurrency, pid):
+    sessions = [Session(url, trace) for _ in range(count)]
+    pool = Pool(concurrency)
+    for session in sessions:
+        pool.spawn(session.connect)
+    pool.join()
+    # Let the shells start before measuring
+    gevent.sleep(1.0)
+    cpu_before = cpu_seconds(pid) if pid else None
+    times_before = os.times()
+    started = time.time()
+    gevent.joinall([gevent.spawn(session.run, started + duration)
+                    for session in sessions])
+    elapsed = time.time() - started
+    times_after = os.times()
+    row = dict(sessions=count, duration=round(elapsed, 3))
+    # Near 100% the harness itself limits the results
+    row['client_cpu'] = round(
+        (times_after[0] + times_after[1] - times_before[0] - times_before[1])
+        / elapsed * 100, 1)
+    if pid:
+        row['server_cpu'] = round(
+            (cpu_seconds(pid) - cpu_before) / elapsed * 100, 1)
+        row['server_rss'] = rss_bytes(pid)
+    latencies = sorted(latency for session in sessions
+                       for latency in session.latencies)
+    for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        value = percentile(latencies, fraction)
+        row[name] = round(value * 1000, 3) if value is not None else None
+    row['keys'] = len(latencies)
+    row['keys_per_sec'] = round(len(latencies) / elapsed, 1)
+    row['output_per_sec'] = int(sum(session.received
+                                    for session in sessions) / elapsed)
+    row['errors'] = sum(session.errors for session in sessions)
+    for session in sessions:
+        session.close()
+    # Give the server time to stop the sessions before the next step
+    gevent.sleep(1.0)
+    return row
+
+
+def start_server(port):
+    server = subprocess.Popen([sys.executable, '-m', 'kitsh.webui',
+                               '--host', '127.0.0.1', '--port', str(port)])
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start on port %d" % (port,))
+
+
+def raise_nofile():
+    # Every session is a socket here, and a socket and PTY in the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ramp', default='10,50,100,250,500,1000',
+                        help='Comma separated numbers of sessions')
+    parser.add_argument('--duration', '-d', type=float, default=10.0,
+                        help='Seconds to run each step')
+    parser.add_argument('--trace', '-t',
+                        help='JSON lines of {"delay": s, "data": key}')
+    parser.add_argument('--url', help='Test this server instead of '
+                        'starting one, e.g. ws://127.0.0.1:5000/websocket')
+    parser.add_argument('--pid', type=int,
+                        help='Process ID of the --url server, for CPU and RSS')
+    parser.add_argument('--port', type=int, default=5055,
+                        help='Port of the server started for the test')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Most sessions connecting at once')
+    parser.add_argument('--output', '-o', type=argparse.FileType('a'),
+                        help='Append a JSON line for every step to this file')
+    parser.add_argument('--label', default=None,
+                        help='Label for the results, e.g. a version')
+    args = parser.parse_args()
+
+    raise_nofile()
+    trace = load_trace(args.trace) if args.trace else SCRIPT
+    server = None
+    url, pid = args.url, args.pid
+    if url is None:
+        server = start_server(args.port)
+        url = 'ws://127.0.0.1:%d/websocket' % (args.port,)
+        pid = server.pid
+    columns = ('sessions', 'p50', 'p99', 'p999', 'keys_per_sec',
+               'output_per_sec', 'server_cpu', 'server_rss', 'client_cpu',
+               'errors')
+    print(' '.join('%14s' % (column,) for column in columns))
+    try:
+        for count in [int(step) for step in args.ramp.split(',')]:
+            row = run_step(url, count, trace, args.duration,
+                           args.concurrency, pid)
+            print(' '.join('%14s' % (row.get(column, '-'),)
+                           for column in columns))
+            if args.output is not None:
+                row['label'] = args.label
+                args.output.write(json.dumps(row) + "\n")
+                args.output.flush()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
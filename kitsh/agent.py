@@ -0,0 +1,298 @@
+"""
+Agent mode: a kitsh process which dials out to a front-end and runs the
+sessions it places there, all carried over one multiplexed websocket.
+"""
+import hmac
+import shlex
+import socket
+import logging
+
+import gevent
+import gevent.socket
+import gevent.ssl
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from .core.task import TaskManager
+from .core.plugin import Plugin, PluginHost
+from .core.process import Process
+from .core.mux import Multiplexer
+
+__all__ = ('Agent', 'AgentRouter', 'connect', 'dial')
+
+
+LOG = logging.getLogger(__name__)
+
+# Shared secret agents present to the front-end, unless given otherwise
+TOKEN_ENV = 'KITSH_AGENT_TOKEN'
+
+# Seconds an agent has to say hello before it is disconnected
+HELLO_TIMEOUT = 10.0
+
+
+class _ClientSocket(object):
+    """
+    Gives a websocket-client connection the send and receive of a
+    gevent-websocket one, as used by the Multiplexer.
+    """
+    __slots__ = ('_ws',)
+
+    def __init__(self, ws):
+        self._ws = ws
+
+    def send(self, data):
+        self._ws.send_binary(data)
+
+    def receive(self):
+        import websocket
+        try:
+            opcode, data = self._ws.recv_data()
+        except (websocket.WebSocketException, socket.error):
+            return None
+        if opcode == websocket.ABNF.OPCODE_CLOSE:
+            return None
+        return data
+
+    def close(self):
+        import websocket
+        # close() would wait for the reply, which receive() is reading
+        try:
+            self._ws.send_close()
+        except (websocket.WebSocketException, socket.error):
+            pass
+        self._ws.shutdown()
+
+
+def connect(url, timeout=10.0):
+    """
+    Connects a websocket-client websocket to `url` over a gevent socket,
+    so it doesn't block the other greenlets.
+    """
+    import websocket
+    parsed = urlparse(url)
+    secure = parsed.scheme in ('wss', 'https')
+    port = parsed.port or (443 if secure else 80)
+    sock = gevent.socket.create_connection((parsed.hostname, port),
+                                           timeout=timeout)
+    # Keystrokes are small writes which must not wait for earlier ACKs
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if secure:
+        context = gevent.ssl.create_default_context()
+        sock = context.wrap_socket(sock, server_hostname=parsed.hostname)
+    ws = websocket.create_connection(url, socket=sock, timeout=timeout)
+    ws.settimeout(None)
+    return ws
+
+
+def dial(url, timeout=10.0):
+    """
+    Connects to `url` for a Multiplexer, see `connect`
+    """
+    return _ClientSocket(connect(url, timeout))
+
+
+class AgentRouter(object):
+    """
+    Front-end registry of the agents connected to it. New sessions are
+    placed on the named agent, or the least loaded one: the agent with
+    the fewest sessions for its capacity.
+
+    Agents must present `token` in their hello, without a token no
+    agent is accepted.
+    """
+    __slots__ = ('_agents', '_token')
+
+    def __init__(self, token=None):
+        self._agents = dict()
+        self._token = token
+
+    def __len__(self):
+        return len(self._agents)
+
+    def agents(self):
+        return [dict(name=mux.name, capacity=capacity, sessions=len(mux))
+                for mux, capacity in self._agents.items()]
+
+    def serve(self, ws, remote=None):
+        """
+        Carries the sessions of the agent connected over websocket `ws`,
+        until it disconnects.
+        """
+        def oncontrol(msg):
+            hello = msg.get('hello') if isinstance(msg, dict) else None
+            if not isinstance(hello, dict) or mux in self._agents:
+                return
+            error = self._check_hello(hello)
+            if error is not None:
+                LOG.warning("Agent from %s rejected: %s", remote, error)
+                mux.close()
+                return
+            mux.name = hello.get('name') or remote
+            self._agents[mux] = hello.get('capacity', 1)
+            LOG.info("Agent %r connected from %s", mux, remote)
+
+        def unknown():
+            if mux not in self._agents:
+                LOG.warning("Agent from %s sent no hello", remote)
+                mux.close()
+
+        if self._token is None:
+            LOG.warning("Agent from %s rejected: no token configured", remote)
+            ws.close()
+            return
+        mux = Multiplexer(ws, initiator=True, oncontrol=oncontrol,
+                          name=remote)
+        timer = gevent.spawn_later(HELLO_TIMEOUT, unknown)
+        try:
+            mux.run()
+        finally:
+            timer.kill()
+            if self._agents.pop(mux, None) is not None:
+                LOG.info("Agent %r disconnected", mux)
+
+    def _check_hello(self, hello):
+        """
+        Reason to reject the hello of an agent, or None when it's valid
+        """
+        token = hello.get('token')
+        if not isinstance(token, type(u'')) or not hmac.compare_digest(
+                token.encode('utf-8'), self._token.encode('utf-8')):
+            return "invalid token"
+        name = hello.get('name')
+        if name is not None and (not isinstance(name, type(u'')) or
+                                 not 0 < len(name) <= 255):
+            return "invalid name %r" % (name,)
+        capacity = hello.get('capacity', 1)
+        if isinstance(capacity, bool) or not isinstance(capacity, int) or \
+                capacity < 1:
+            return "invalid capacity %r" % (capacity,)
+        return None
+
+    def place(self, name=None):
+        """
+        The agent for a new session, or None when there is no room
+        """
+        best = None
+        best_load = None
+        for mux, capacity in self._agents.items():
+            if mux.closed or len(mux) >= capacity:
+                continue
+            if name is not None and mux.name != name:
+                continue
+            load = len(mux) / float(capacity)
+            if best is None or load < best_load:
+                best, best_load = mux, load
+        return best
+
+    def open(self, name=None, **params):
+        """
+        Opens a session on an agent, returning its stream task or None
+        """
+        mux = self.place(name)
+        if mux is None:
+            return None
+        return mux.open(**params)
+
+
+class Agent(Plugin):
+    """
+    Dials out to the front-end at `--url` and runs a `--shell` for every
+    session it opens, reconnecting when the connection is lost.
+    """
+    def __init__(self, url=None, name=None, capacity=100, shell='bash',
+                 retry=5.0, token=None):
+        self._url = url
+        self._token = token
+        self._name = name or socket.gethostname()
+        self._capacity = capacity
+        self._shell = shell
+        self._retry = retry
+        self._mux = None
+        self._stopped = False
+
+    def __repr__(self):
+        return "%s(%s @ %s)" % (self.__class__.__name__, self._name,
+                                self._url)
+
+    def options(self, parser, env):
+        parser.add_argument('--url', '-u',
+            required=True,
+            help='Front-end agent endpoint, e.g. ws://host:5000/agent')
+
+        parser.add_argument('--agent-name',
+            default=socket.gethostname(),
+            help='Name of this agent (default: hostname)')
+
+        parser.add_argument('--capacity',
+            type=int,
+            default=100,
+            help='Most sessions to run at once (default: 100)')
+
+        parser.add_argument('--shell',
+            default='bash',
+            help='Command run for every session (default: bash)')
+
+        parser.add_argument('--retry',
+            type=float,
+            default=5.0,
+            help='Seconds between reconnects (default: 5)')
+
+        parser.add_argument('--token',
+            default=env.get(TOKEN_ENV),
+            help='Secret shared with the front-end (default: $%s)' % (
+                TOKEN_ENV,))
+
+    def configure(self, options, conf):
+        self._url = options.url
+        self._name = options.agent_name
+        self._capacity = options.capacity
+        self._shell = options.shell
+        self._retry = options.retry
+        self._token = options.token
+
+    def _session(self, stream_task):
+        try:
+            proc = Process(shlex.split(self._shell))
+        except (OSError, ValueError) as ex:
+            LOG.warning("%r cannot run %r: %s", self, self._shell, ex)
+            stream_task.stop()
+            return
+        proc_task = TaskManager.spawn(proc)
+        stream_task.obj.throttle = proc_task.output
+        with stream_task.bridge(proc_task) as bridge:
+            bridge.wait()
+        proc_task.stop()
+        stream_task.stop()
+
+    def attach(self, ws):
+        """
+        Runs sessions for the front-end connected over `ws` until it
+        disconnects.
+        """
+        mux = self._mux = Multiplexer(ws, initiator=False,
+                                      onopen=self._session, name=self._url)
+        mux.send_control(dict(hello=dict(name=self._name,
+                                         capacity=self._capacity,
+                                         token=self._token)))
+        mux.run()
+
+    def run(self, task=None):
+        while not self._stopped:
+            try:
+                self.attach(dial(self._url))
+            except Exception as ex:
+                LOG.warning("%r connection failed: %s", self, ex)
+            if not self._stopped:
+                gevent.sleep(self._retry)
+
+    def stop(self):
+        self._stopped = True
+        if self._mux is not None:
+            self._mux.close()
+
+
+if __name__ == "__main__":
+    PluginHost.main(Agent())
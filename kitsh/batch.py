@@ -0,0 +1,114 @@
+import codecs
+import logging
+
+import gevent
+from gevent.pool import Pool
+from gevent.queue import Queue
+
+from .core.task import TaskManager
+from .core.process import Process
+
+__all__ = ('BatchExec',)
+
+
+LOG = logging.getLogger(__name__)
+
+
+class BatchExec(object):
+    """
+    Runs a batch of commands non-interactively as Process tasks, with at
+    most `concurrency` of them running at once.
+
+    Iterating yields events as they happen, each tagged with the index of
+    the command in the batch:
+
+      {'id': 0, 'data': '...'}    output of the command
+      {'id': 0, 'error': '...'}   error output of the command
+      {'id': 0, 'exit': 0}        the command finished
+      {'exit': [0, 1, ...]}       every command finished, last event
+
+    Commands are either argument lists, or strings run with the shell.
+    They run with pipes rather than PTYs, so stdout and stderr are kept
+    apart and large batches don't use up the system's PTYs.
+    """
+    __slots__ = ('_commands', '_pool', '_events', '_env', '_exits')
+
+    def __init__(self, commands, concurrency=16, env=None):
+        assert concurrency > 0
+        self._commands = list(commands)
+        self._pool = Pool(concurrency)
+        self._events = Queue()
+        self._env = env
+        self._exits = [None] * len(self._commands)
+
+    def __repr__(self):
+        return "%s(%d commands, concurrency=%d)" % (
+            self.__class__.__name__, len(self._commands), self._pool.size)
+
+    def __iter__(self):
+        feeder = gevent.spawn(self._feed)
+        try:
+            for event in self._events:
+                if event is StopIteration:
+                    break
+                yield event
+        finally:
+            feeder.kill()
+            self._pool.kill()
+
+    @property
+    def exits(self):
+        return self._exits
+
+    def _feed(self):
+        for ident, command in enumerate(self._commands):
+            self._pool.spawn(self._run, ident, command)
+        self._pool.join()
+        self._events.put(dict(exit=self._exits))
+        self._events.put(StopIteration)
+
+    def _process(self, command):
+        if isinstance(command, (list, tuple)):
+            return Process(list(command), env=self._env, tty=False)
+        return Process(command, env=self._env, shell=True, tty=False)
+
+    @staticmethod
+    def _decoder():
+        return codecs.getincrementaldecoder('utf-8')('replace')
+
+    def _run(self, ident, command):
+        try:
+            proc = self._process(command)
+        except (OSError, ValueError) as ex:
+            LOG.warning("Cannot run %r: %s", command, ex)
+            self._events.put(dict(id=ident, error=str(ex)))
+            self._exits[ident] = -1
+            self._events.put(dict(id=ident, exit=-1))
+            return
+        task = TaskManager.spawn(proc)
+        # Batch commands get no input, they must not wait for any
+        task.input.close()
+        try:
+            self._collect(ident, task)
+            task.wait()
+            returncode = proc.wait()
+        finally:
+            # Also when the batch is abandoned, e.g. the client went away
+            task.stop()
+        self._exits[ident] = returncode
+        self._events.put(dict(id=ident, exit=returncode))
+
+    def _collect(self, ident, task):
+        decoders = dict()
+        with task.output.watch() as sub:
+            for msg in sub:
+                decoder = decoders.get(msg.kind)
+                if decoder is None:
+                    decoder = decoders[msg.kind] = self._decoder()
+                text = decoder.decode(msg.payload)
+                if text:
+                    self._events.put({'id': ident, msg.kind: text})
+        for kind, decoder in decoders.items():
+            text = decoder.decode(b'', True)
+            if text:
+                self._events.put({'id': ident, kind: text})
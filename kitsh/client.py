@@ -12,6 +12,7 @@ import tty
 import fcntl
 import platform
 import struct
+import time
 
 try:
     import json
@@ -36,12 +37,35 @@ def _pty_size():
     return rows, cols
 
 
+def encode_data(data):
+    return json.dumps({'data': data})
+
+
+def encode_resize(rows, cols):
+    return json.dumps({'resize': {'width': cols, 'height': rows}})
+
+
+def decode(data):
+    """
+    Terminal output in a message from the server
+    """
+    message = json.loads(data)
+    if 'error' in message:
+        raise ConnectionError(message['error'])
+    return message.get('data', '')
+
+
 def _resize(ws):
     rows, cols = _pty_size()
-    ws.send(json.dumps({'resize': {'width': cols, 'height': rows}}))
+    ws.send(encode_resize(rows, cols))
 
 
-def invoke_shell(endpoint):
+def invoke_shell(endpoint, record=None):
+    """
+    Interactive session, with `record` every keystroke is written to it
+    as a JSON line {"delay": seconds since the last, "data": key}, which
+    the load test can replay.
+    """
     try:
         ssh = websocket.create_connection(endpoint)
     except socket.error as ex:
@@ -61,7 +85,8 @@ def invoke_shell(endpoint):
         tty.setcbreak(sys.stdin.fileno())
 
         rows, cols = _pty_size()
-        ssh.send(json.dumps({'resize': {'width': cols, 'height': rows}}))
+        ssh.send(encode_resize(rows, cols))
+        last_key = time.time()
 
         while True:
             try:
@@ -70,17 +95,18 @@ def invoke_shell(endpoint):
                     data = ssh.recv()
                     if not data:
                         break
-                    message = json.loads(data)
-                    if 'error' in message:
-                        raise ConnectionError(message['error'])
-                    if 'data' in message:
-                        sys.stdout.write(message['data'])
+                    sys.stdout.write(decode(data))
                     sys.stdout.flush()
                 if sys.stdin in r:
                     x = sys.stdin.read(1)
                     if len(x) == 0:
                         break
-                    ssh.send(json.dumps({'data': x}))
+                    ssh.send(encode_data(x))
+                    if record is not None:
+                        now = time.time()
+                        record.write(json.dumps({'delay': now - last_key,
+                                                 'data': x}) + "\n")
+                        last_key = now
             except (select.error, IOError) as e:
                 if e.args and e.args[0] == errno.EINTR:
                     pass
@@ -106,11 +132,16 @@ def main():
         type=int,
         default=5000)
 
+    parser.add_argument('--record', '-r',
+        help='Record keystrokes to this file, for bench/loadtest.py',
+        type=argparse.FileType('w'),
+        default=None)
+
     args = parser.parse_args()
     endpoint = 'ws://{host}:{port}/websocket'.format(**vars(args))
 
     try:
-        invoke_shell(endpoint)
+        invoke_shell(endpoint, args.record)
     except ConnectionError as e:
         print >>sys.stderr, 'client: {0}'.format(e.message or 'Connection error')
     else:
@@ -7,12 +7,13 @@ class ConsoleTask(object):
     def __repr__(self):
         return "Console @ %x" % (id(self),)
 
-    def run(self, bridge):
-        sock = bridge.stdin()
+    def run(self, task):
+        stdin = task.input.datastream('utf-8')
+        sock = task.output.datastream('utf-8')
         sock.write("{%shell begin %}")
         while True:
             sock.write(u"> ")
-            line = sock.readline()
+            line = stdin.readline(u"\r")
             if not line:
                 break
             sock.write(line + "\r\n")
@@ -1,61 +1,46 @@
 import logging
-import code
+
+from ..core.process import Process
+from ..core.forkserver import DEFAULT_FORKSERVER, console
 
 LOG = logging.getLogger(__name__)
 
 
-class PythonConsole(code.InteractiveConsole, object):
+class PythonConsole(object):
+    """
+    Interactive Python console as a task. Every console is a process
+    forked from the preloaded template of `forkserver`, so it starts
+    quickly and whatever is typed into it runs outside of the gevent
+    hub: a runaway expression doesn't hold up other sessions.
 
-    ident = 0  # Id of next instance; also counts instances
+    `symtab` holds the console's initial local variables, which have to
+    be picklable.
+    """
+    def __init__(self, symtab=None, forkserver=DEFAULT_FORKSERVER):
+        self._symtab = dict(symtab or ())
+        self._forkserver = forkserver
+        self._proc = None
 
     def __repr__(self):
-        return "Python @ %x" % (id(self),)
-
-    def __init__(self, symtab=None):
-        if symtab is None:
-            symtab = dict()
-        # Make exit() in the console only exit the console, not the program.
-        # (There's still sys.exit().)
-        symtab['exit'] = self.stop
-        self._line = ''
-        # TODO get the right context in here (locals)
-        super(PythonConsole, self).__init__(
-            filename='<Python-' + str(self) + '>',
-            locals=symtab)
-
-    def raw_input(self, prompt=""):
-        newline = '\r'
-        self.write(prompt)
-        while True:            
-            data = self.sock.read()
-            if data is StopIteration:
-                break
-            if newline not in data:
-                self._line += data
-                self.sock.write(data)
-            else:
-                pos = data.index(newline) + 1
-                before = data[:pos]
-                after = data[pos:]
-                self.sock.write(before)
-                self._line += before
-                line = self._line[0:len(self._line)].rstrip("\r\n")
-                self._line = after
-                return line
-        raise EOFError()
-
-    def write(self, strdata):
-        self.sock.write(strdata.replace("\n", "\r\n"))
-
-    def run(self, bridge):
-        self.sock = bridge.stdin()
-        try:
-            try:
-                self.interact()
-            except Exception:
-                pass
-        finally:
-            self.sock.close()
+        if self._proc is None:
+            return "Python @ %x" % (id(self),)
+        return "Python @ %x pid %d" % (id(self), self._proc.pid)
+
+    @property
+    def pid(self):
+        return self._proc.pid if self._proc is not None else None
+
+    def usage(self):
+        return self._proc.usage() if self._proc is not None else None
+
+    def run(self, task):
+        child, master = self._forkserver.spawn(console, self._symtab)
+        self._proc = Process.adopt(child, master, args=['python'])
+        self._proc.run(task)
+
+    def wait(self, timeout=None):
+        return self._proc.wait(timeout)
 
     def stop(self):
-        self.sock.close()
+        if self._proc is not None:
+            self._proc.stop()
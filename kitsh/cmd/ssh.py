@@ -9,6 +9,8 @@ try:
 except ImportError:
     from io import StringIO
 
+from ..core.inout import Message, DATA
+
 
 class SSHTask(object):
     __slots__ = ('_ssh', '_command', '_term', '_title')
@@ -69,11 +71,11 @@ class SSHTask(object):
         self._ssh.close()
 
     def _write(self, msg):
-        if 'data' in msg:
-            return msg['data']
+        if msg.kind == DATA:
+            return msg.payload
 
     def _read(self, data):
-        return dict(data=data)
+        return Message(DATA, data)
 
     def run(self, bridge):
         if self._command:
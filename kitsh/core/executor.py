@@ -0,0 +1,341 @@
+"""
+Executors decide where the `run(task)` of a task executes. The task's
+greenlet, states and channels stay in the hub whichever is used, only
+the work moves:
+
+  GREENLET        in the task's greenlet, the default
+  ThreadExecutor  in a bounded pool of native threads, for blocking code
+  ForkExecutor    in processes forked from a forkserver template, for
+                  CPU bound code, which then runs on other cores
+
+Outside of the hub `run` is given a stand-in for the task whose `input`
+and `output` receive and send like channels.
+"""
+import sys
+import socket
+import pickle
+import logging
+import traceback
+
+import gevent
+import gevent.socket
+from gevent.hub import get_hub
+from gevent.lock import Semaphore
+from gevent.monkey import get_original
+from gevent.threadpool import ThreadPool
+
+from .inout import DataStream
+from .reaper import ChildReaper
+from .forkserver import DEFAULT_FORKSERVER, LENGTH
+
+__all__ = ('Executor', 'GreenletExecutor', 'ThreadExecutor', 'ForkExecutor',
+           'GREENLET')
+
+
+LOG = logging.getLogger(__name__)
+
+# Threads wait for the hub with this, even if threading is monkey patched
+NativeEvent = get_original('threading', 'Event')
+
+
+class Executor(object):
+    """
+    Runs the `method` of a task object for the task, returning what it
+    returns and raising what it raises once it has finished.
+    """
+    __slots__ = ()
+
+    def execute(self, method, task):
+        raise NotImplementedError()
+
+    def stop(self, task):
+        """
+        The task is being stopped, after its channels were closed
+        """
+        pass
+
+
+class GreenletExecutor(Executor):
+    __slots__ = ()
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def execute(self, method, task):
+        return method(task)
+
+
+GREENLET = GreenletExecutor()
+
+
+class _ChannelProxy(object):
+    """
+    What a task's run() uses of a Channel, for code outside of the hub
+    """
+    __slots__ = ('_recv', '_send', '_close', '_ended')
+
+    def __init__(self, recv, send, close):
+        self._recv = recv
+        self._send = send
+        self._close = close
+        self._ended = False
+
+    def __iter__(self):
+        while True:
+            msg = self.recv()
+            if msg is StopIteration:
+                break
+            yield msg
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def watch(self):
+        return self
+
+    @property
+    def closed(self):
+        return self._ended
+
+    def recv(self):
+        if self._ended:
+            return StopIteration
+        msg = self._recv()
+        if msg is StopIteration:
+            self._ended = True
+        return msg
+
+    def send(self, msg):
+        self._send(msg)
+
+    def close(self):
+        self._close()
+
+    def datastream(self, encoding=None):
+        return DataStream(self, encoding)
+
+
+class _TaskProxy(object):
+    """
+    Stands in for a task outside of the hub
+    """
+    __slots__ = ('input', 'output', 'obj')
+
+    def __init__(self, inch, outch, obj):
+        self.input = inch
+        self.output = outch
+        self.obj = obj
+
+
+def _call_in_hub(loop, func, *args):
+    """
+    From another thread: runs `func(*args)` in a greenlet of the hub of
+    `loop`, and waits for its result
+    """
+    done = NativeEvent()
+    result = []
+
+    def call():
+        try:
+            result.append((True, func(*args)))
+        except BaseException:
+            result.append((False, sys.exc_info()[1]))
+        finally:
+            done.set()
+    loop.run_callback_threadsafe(gevent.spawn, call)
+    done.wait()
+    succeeded, value = result[0]
+    if not succeeded:
+        raise value
+    return value
+
+
+class ThreadExecutor(Executor):
+    """
+    Runs tasks in a pool of at most `size` native threads, waiting for a
+    free thread. Receiving waits for the hub, sending is queued to it.
+
+    Threads can't be interrupted: stopping a task closes its channels,
+    which ends a run() waiting on them, but one blocked in anything else
+    keeps its thread, and one of the `size`, until it returns, even
+    though the task is already STOPPED.
+    """
+    __slots__ = ('_pool',)
+
+    def __init__(self, size=4):
+        self._pool = ThreadPool(size)
+
+    def __repr__(self):
+        return "%s(%d)" % (self.__class__.__name__, self._pool.maxsize)
+
+    def _proxy(self, loop, chan):
+        return _ChannelProxy(
+            lambda: _call_in_hub(loop, chan.recv),
+            lambda msg: loop.run_callback_threadsafe(chan.send, msg),
+            lambda: loop.run_callback_threadsafe(chan.close))
+
+    @staticmethod
+    def _call(method, proxy):
+        # Raised in the hub instead, the pool would also report it
+        try:
+            return True, method(proxy)
+        except Exception:
+            return False, sys.exc_info()[1]
+
+    def execute(self, method, task):
+        loop = get_hub().loop
+        proxy = _TaskProxy(self._proxy(loop, task.input),
+                           self._proxy(loop, task.output), task.obj)
+        succeeded, value = self._pool.apply(self._call, (method, proxy))
+        if not succeeded:
+            raise value
+        return value
+
+
+class _Frames(object):
+    """
+    Pickled objects over a stream socket, each prefixed by its length
+    """
+    __slots__ = ('_sock',)
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def send(self, obj):
+        data = pickle.dumps(obj)
+        self._sock.sendall(LENGTH.pack(len(data)) + data)
+
+    def _read(self, nbytes):
+        buf = b''
+        while len(buf) < nbytes:
+            try:
+                data = self._sock.recv(nbytes - len(buf))
+            except socket.error:
+                data = None
+            if not data:
+                raise EOFError()
+            buf += data
+        return buf
+
+    def recv(self):
+        """
+        Next object, raises EOFError when the other end has gone
+        """
+        return pickle.loads(self._read(LENGTH.unpack(
+            self._read(LENGTH.size))[0]))
+
+    def close(self):
+        self._sock.close()
+
+
+def _forked(fd, method):
+    """
+    Entry point in the forked child, runs `method` for a stand-in task
+    whose input and output are the frames of the socket `fd`. Sends
+    ('out', msg), ('in', msg), ('close', 'output'|'input'), then
+    ('done', None) or ('error', traceback).
+    """
+    frames = _Frames(socket.socket(fileno=fd))
+
+    def recv():
+        try:
+            return frames.recv()
+        except EOFError:
+            return StopIteration
+
+    task = _TaskProxy(
+        _ChannelProxy(recv, lambda msg: frames.send(('in', msg)),
+                      lambda: frames.send(('close', 'input'))),
+        _ChannelProxy(None, lambda msg: frames.send(('out', msg)),
+                      lambda: frames.send(('close', 'output'))),
+        getattr(method, '__self__', None))
+    try:
+        method(task)
+    except Exception:
+        frames.send(('error', traceback.format_exc()))
+    else:
+        frames.send(('done', None))
+    frames.close()
+
+
+class ForkExecutor(Executor):
+    """
+    Runs tasks in processes forked from the template of `forkserver`, at
+    most `size` at once. The task object is pickled to its process, and
+    its messages go back and forth over a UNIX socket. Stopping the task
+    terminates the process, see `ChildReaper.terminate`.
+    """
+    __slots__ = ('_forkserver', '_slots', '_kill_timeout', '_children')
+
+    def __init__(self, size=4, forkserver=DEFAULT_FORKSERVER,
+                 kill_timeout=5.0):
+        self._forkserver = forkserver
+        self._slots = Semaphore(size)
+        self._kill_timeout = kill_timeout
+        self._children = dict()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._forkserver)
+
+    @staticmethod
+    def _feed(inch, frames):
+        try:
+            for msg in inch:
+                frames.send(msg)
+            frames.send(StopIteration)
+        except (socket.error, IOError):
+            pass
+
+    def execute(self, method, task):
+        with self._slots:
+            ours, theirs = socket.socketpair(socket.AF_UNIX,
+                                             socket.SOCK_STREAM)
+            try:
+                child = self._forkserver.fork(theirs.fileno(), _forked,
+                                              method)
+            finally:
+                theirs.close()
+            frames = _Frames(gevent.socket.socket(fileno=ours.detach()))
+            feeder = gevent.spawn(self._feed, task.input, frames)
+            self._children[id(task)] = child
+            done = False
+            try:
+                done = self._relay(frames, task, child)
+            finally:
+                del self._children[id(task)]
+                feeder.kill()
+                frames.close()
+                if not done:
+                    ChildReaper.terminate(child, self._kill_timeout)
+
+    def stop(self, task):
+        child = self._children.get(id(task))
+        if child is not None:
+            ChildReaper.terminate(child, self._kill_timeout)
+
+    @staticmethod
+    def _relay(frames, task, child):
+        """
+        Passes on what the child sends, returns True once it's done
+        """
+        while True:
+            try:
+                kind, value = frames.recv()
+            except EOFError:
+                if task.output.ended:
+                    # Stopped
+                    return False
+                raise RuntimeError("%r ended with %r" % (child, child.wait()))
+            if kind == 'out':
+                task.output.send(value)
+            elif kind == 'in':
+                task.input.send(value)
+            elif kind == 'close':
+                getattr(task, value).close()
+            elif kind == 'error':
+                raise RuntimeError("In %r:\n%s" % (child, value))
+            elif kind == 'done':
+                return True
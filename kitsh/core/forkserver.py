@@ -0,0 +1,378 @@
+"""
+Runs Python consoles, or other Python entry points, in processes forked
+from a template interpreter which has already imported what they need.
+Forking the template is much quicker than starting an interpreter, and
+the code runs outside of the gevent hub, so a busy console only slows
+itself down.
+
+The template is started on first use and talks to us over a UNIX socket:
+each request carries a file descriptor for the forked child, such as the
+slave end of a PTY which becomes its terminal, and the template reports
+the child's PID and later its exit status.
+"""
+import os
+import sys
+import pty
+import array
+import errno
+import fcntl
+import pickle
+import select
+import signal
+import socket
+import struct
+import logging
+import termios
+import importlib
+from collections import deque
+
+import gevent
+import gevent.socket
+from gevent.event import AsyncResult, Event
+from gevent.hub import get_hub
+from gevent.subprocess import Popen
+
+from .reaper import ChildReaper
+
+__all__ = ('ForkServer', 'ForkedChild', 'DEFAULT_FORKSERVER')
+
+
+LOG = logging.getLogger(__name__)
+
+LENGTH = struct.Struct('!I')
+
+# Imported by the template, so every child starts with them
+PRELOAD = ('code', 'readline', 'rlcompleter')
+
+
+def console(symtab):
+    """
+    Entry point of a forked child: an interactive console on its terminal
+    """
+    import code
+    try:
+        import readline
+        import rlcompleter
+        readline.set_completer(rlcompleter.Completer(symtab).complete)
+        readline.parse_and_bind('tab: complete')
+    except ImportError:
+        pass
+    code.interact(local=symtab)
+
+
+class ForkedChild(object):
+    """
+    A child of the template, with the parts of Popen which `Process` and
+    `ChildReaper` use. Its exit status comes from the template.
+    """
+    __slots__ = ('pid', 'returncode', '_exited', '_links')
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+        self._exited = Event()
+        self._links = []
+
+    def __repr__(self):
+        return "%s(%d)" % (self.__class__.__name__, self.pid)
+
+    def rawlink(self, callback):
+        if self.returncode is not None:
+            get_hub().loop.run_callback(callback, self)
+        else:
+            self._links.append(callback)
+
+    def wait(self, timeout=None):
+        self._exited.wait(timeout)
+        return self.returncode
+
+    def exited(self, returncode):
+        if self.returncode is not None:
+            return
+        self.returncode = returncode
+        self._exited.set()
+        links, self._links = self._links, []
+        for callback in links:
+            callback(self)
+
+
+class ForkServer(object):
+    """
+    Our end of a template interpreter which imports `preload` once, then
+    forks a child for every `spawn()`. Stopping it sends the template
+    SIGTERM, then SIGKILL after `kill_timeout` seconds.
+    """
+    __slots__ = ('_preload', '_proc', '_sock', '_pending', '_children',
+                 '_reader', '_kill_timeout')
+
+    def __init__(self, preload=PRELOAD, kill_timeout=5.0):
+        self._preload = tuple(preload)
+        self._kill_timeout = kill_timeout
+        self._proc = None
+        self._sock = None
+        self._pending = deque()
+        self._children = dict()
+        self._reader = None
+
+    def __repr__(self):
+        return "%s(pid=%s, %d children)" % (
+            self.__class__.__name__,
+            self._proc.pid if self._proc is not None else None,
+            len(self._children))
+
+    @property
+    def running(self):
+        return self._sock is not None
+
+    def start(self):
+        if self.running:
+            return
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Entry points are imported from the same path as ours
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            path for path in sys.path if path))
+        try:
+            self._proc = Popen(
+                [sys.executable, '-m', __name__, str(theirs.fileno())] +
+                list(self._preload),
+                pass_fds=(theirs.fileno(),), close_fds=True, env=env)
+        except Exception:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        self._sock = gevent.socket.socket(fileno=ours.detach())
+        self._reader = gevent.spawn(self._read)
+        LOG.info("Started %r", self)
+
+    def stop(self):
+        if self._reader is not None:
+            self._reader.kill()
+            self._reader = None
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+        if self._proc is not None:
+            ChildReaper.terminate(self._proc, self._kill_timeout)
+            self._proc = None
+        self._lost()
+
+    def spawn(self, entry=console, *args):
+        """
+        Forks a child running `entry(*args)` on a new PTY, which must be
+        importable by name and its arguments picklable. Returns the child
+        and the PTY master.
+        """
+        master, slave = pty.openpty()
+        try:
+            child = self._request(slave, True, entry, args)
+        except Exception:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        return child, master
+
+    def fork(self, fd, entry, *args):
+        """
+        Forks a child running `entry(fd, *args)` with its own copy of the
+        file descriptor `fd`, see `spawn`. Returns the child.
+        """
+        return self._request(fd, False, entry, args)
+
+    def _request(self, fd, tty, entry, args):
+        self.start()
+        # Arguments are only unpickled in the child, not the template
+        request = pickle.dumps((entry.__module__, entry.__name__, tty,
+                                pickle.dumps(args)))
+        result = AsyncResult()
+        self._pending.append(result)
+        try:
+            self._sock.sendmsg(
+                [LENGTH.pack(len(request)), request],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                  array.array('i', [fd]))])
+        except Exception:
+            self._pending.remove(result)
+            raise
+        return result.get()
+
+    def _read(self):
+        buf = b''
+        try:
+            while True:
+                data = self._sock.recv(4096)
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    self._dispatch(line.decode('ascii').split())
+        except Exception as ex:
+            LOG.warning("%r control connection failed: %s", self, ex)
+        finally:
+            if self._sock is not None:
+                LOG.warning("%r has gone", self)
+                self._sock.close()
+                self._sock = None
+            self._lost()
+
+    def _dispatch(self, words):
+        if words[0] == 'pid':
+            child = ForkedChild(int(words[1]))
+            self._children[child.pid] = child
+            self._pending.popleft().set(child)
+        elif words[0] == 'error':
+            self._pending.popleft().set_exception(
+                OSError(int(words[1]), os.strerror(int(words[1]))))
+        elif words[0] == 'exit':
+            child = self._children.pop(int(words[1]), None)
+            if child is not None:
+                child.exited(int(words[2]))
+
+    def _lost(self):
+        # Nobody is left to report on the children, so they go too
+        while self._pending:
+            self._pending.popleft().set_exception(
+                RuntimeError("%r has gone" % (self,)))
+        children = list(self._children.values())
+        self._children.clear()
+        for child in children:
+            try:
+                os.kill(child.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            child.exited(-signal.SIGKILL)
+
+
+# The template used for every console
+DEFAULT_FORKSERVER = ForkServer()
+
+
+def _recv_request(sock):
+    fds = array.array('i')
+    header, ancdata, _, _ = sock.recvmsg(
+        LENGTH.size, socket.CMSG_SPACE(fds.itemsize))
+    if not header:
+        return None, None
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    while len(header) < LENGTH.size:
+        header += sock.recv(LENGTH.size - len(header))
+    length = LENGTH.unpack(header)[0]
+    request = b''
+    while len(request) < length:
+        data = sock.recv(length - len(request))
+        if not data:
+            return None, None
+        request += data
+    return pickle.loads(request), (fds[0] if fds else None)
+
+
+def _child(sock, wakeup, slave, module, name, tty, args):
+    """
+    In the forked child: makes the PTY its terminal and runs the entry,
+    or without `tty` passes the descriptor to the entry
+    """
+    sock.close()
+    for fd in wakeup:
+        os.close(fd)
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    os.setsid()
+    entry = getattr(importlib.import_module(module), name)
+    args = pickle.loads(args)
+    if not tty:
+        return entry(slave, *args)
+    fcntl.ioctl(slave, termios.TIOCSCTTY, 0)
+    for fd in (0, 1, 2):
+        os.dup2(slave, fd)
+    if slave > 2:
+        os.close(slave)
+    # Standard streams were set up for the template's files
+    sys.stdin = os.fdopen(0, 'r', closefd=False)
+    sys.stdout = os.fdopen(1, 'w', 1, closefd=False)
+    sys.stderr = os.fdopen(2, 'w', 1, closefd=False)
+    entry(*args)
+
+
+def _reap(sock):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as ex:
+            if ex.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        sock.sendall(b'exit %d %d\n' % (pid, returncode))
+
+
+def serve(fd, preload=PRELOAD):
+    """
+    The template: forks a child for every request on the socket `fd`,
+    until it is closed
+    """
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError as ex:
+            sys.stderr.write("Cannot preload %s: %s\n" % (module, ex))
+    sock = socket.socket(fileno=fd)
+    wakeup = os.pipe()
+    for end in wakeup:
+        fcntl.fcntl(end, fcntl.F_SETFL, os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup[1])
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        readable = select.select([sock, wakeup[0]], [], [])[0]
+        if wakeup[0] in readable:
+            try:
+                os.read(wakeup[0], 4096)
+            except OSError:
+                pass
+            _reap(sock)
+        if sock not in readable:
+            continue
+        request, slave = _recv_request(sock)
+        if request is None:
+            break
+        if slave is None:
+            sock.sendall(b'error %d\n' % (errno.EBADF,))
+            continue
+        try:
+            pid = os.fork()
+        except OSError as ex:
+            os.close(slave)
+            sock.sendall(b'error %d\n' % (ex.errno,))
+            continue
+        if pid == 0:
+            code = 0
+            try:
+                _child(sock, wakeup, slave, *request)
+            except SystemExit as ex:
+                code = ex.code if isinstance(ex.code, int) else 0
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(code)
+        os.close(slave)
+        sock.sendall(b'pid %d\n' % (pid,))
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]), sys.argv[2:])
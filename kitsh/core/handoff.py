@@ -0,0 +1,265 @@
+"""
+Restarting without disconnecting: a running server hands its listening
+socket and the PTY of every terminal session to the server replacing
+it, over a UNIX socket, and exits without stopping the shells.
+
+    kitsh --handoff /run/kitsh.sock              # running
+    kitsh --handoff /run/kitsh.sock --takeover   # its replacement
+
+The replacement connects to the running server, which sends it one
+message per descriptor: a length prefixed JSON header, with the
+descriptor passed as SCM_RIGHTS. First the listening socket, then each
+session with the pid and args of its child and its name, then the
+number sent. Neither server reads the PTYs meanwhile, so no output is
+lost. Once the replacement has adopted them all it replies with that
+number, and only then does the running server let go of its sessions
+and stop; if anything goes wrong before, it carries on as if nothing
+happened.
+
+The shells are not children of the replacement, which learns of their
+exit from a pidfd but not their exit status. Websocket connections are
+not handed over: clients reconnect and rejoin their shells by session
+name, see `WebUI.mux`.
+"""
+import os
+import json
+import array
+import errno
+import socket
+import logging
+
+import gevent
+import gevent.socket
+from gevent.hub import get_hub
+
+from .task import TaskManager
+from .process import Process
+from .forkserver import ForkedChild, LENGTH
+
+__all__ = ('AdoptedChild', 'HandoffServer', 'take_over')
+
+
+LOG = logging.getLogger(__name__)
+
+# Exit status of an adopted child, which can't be known
+UNKNOWN = -1
+
+
+class AdoptedChild(ForkedChild):
+    """
+    A process which isn't our child, such as a shell inherited from the
+    server we replaced. Its exit is noticed with a pidfd where the
+    kernel has them, otherwise by checking every `interval` seconds.
+    """
+    __slots__ = ('_pidfd', '_watcher')
+
+    def __init__(self, pid, interval=1.0):
+        super(AdoptedChild, self).__init__(pid)
+        self._pidfd = None
+        loop = get_hub().loop
+        try:
+            self._pidfd = os.pidfd_open(pid)
+        except AttributeError:
+            self._watcher = loop.timer(interval, interval)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+            # Already gone
+            self._watcher = loop.timer(0)
+        else:
+            self._watcher = loop.io(self._pidfd, 1)
+        self._watcher.start(self._check)
+
+    def _check(self):
+        if self._pidfd is None:
+            try:
+                os.kill(self.pid, 0)
+                return
+            except OSError as ex:
+                if ex.errno != errno.ESRCH:
+                    return
+        self._watcher.stop()
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+        self.exited(UNKNOWN)
+
+
+def _send(sock, header, fd=None):
+    data = json.dumps(header).encode('utf-8')
+    if fd is None:
+        sock.sendall(LENGTH.pack(len(data)) + data)
+    else:
+        sock.sendmsg([LENGTH.pack(len(data)), data],
+                     [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                       array.array('i', [fd]))])
+
+
+def _read(sock, nbytes):
+    buf = b''
+    while len(buf) < nbytes:
+        data = sock.recv(nbytes - len(buf))
+        if not data:
+            raise EOFError()
+        buf += data
+    return buf
+
+
+def _recv(sock):
+    """
+    Next header and the descriptor sent with it, if any. Raises EOFError
+    when the other end has gone.
+    """
+    fds = array.array('i')
+    buf, ancdata, _, _ = sock.recvmsg(LENGTH.size,
+                                      socket.CMSG_SPACE(fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    try:
+        buf += _read(sock, LENGTH.size - len(buf))
+        data = _read(sock, LENGTH.unpack(buf)[0])
+        return json.loads(data.decode('utf-8')), (fds[0] if fds else None)
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+class HandoffServer(object):
+    """
+    Waits on the UNIX socket `path` for a replacement, which is handed
+    the listening socket `listener` and every terminal session, then
+    calls `ondone()`.
+    """
+    __slots__ = ('_path', '_listener', '_ondone', '_sock', '_greenlet')
+
+    def __init__(self, path, listener, ondone):
+        self._path = path
+        self._listener = listener
+        self._ondone = ondone
+        self._sock = None
+        self._greenlet = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._path)
+
+    def start(self):
+        # A leftover, or the server we took over from, which is done
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self._path)
+            os.chmod(self._path, 0o600)
+            sock.listen(1)
+        except Exception:
+            sock.close()
+            raise
+        self._sock = sock
+        self._greenlet = gevent.spawn(self._serve)
+
+    def stop(self, unlink=True):
+        if self._greenlet is not None and \
+                self._greenlet is not gevent.getcurrent():
+            self._greenlet.kill()
+        self._greenlet = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if unlink and os.path.exists(self._path):
+                os.unlink(self._path)
+
+    def _serve(self):
+        while True:
+            conn, _ = self._sock.accept()
+            try:
+                self._handoff(conn)
+            except Exception:
+                LOG.exception("%r failed, carrying on", self)
+                continue
+            finally:
+                conn.close()
+            break
+        # The replacement now listens on the path
+        self.stop(unlink=False)
+        self._ondone()
+
+    def _handoff(self, conn):
+        sessions = []
+        for task in list(TaskManager.tasks().values()):
+            if task.state != 'RUNNING' or not isinstance(task.obj, Process):
+                continue
+            handoff = task.obj.handoff()
+            if handoff is not None:
+                sessions.append((task, handoff))
+        # Whatever the child outputs from now on is read by whoever ends
+        # up with it
+        for task, _ in sessions:
+            task.obj.pause()
+        try:
+            _send(conn, dict(listener=True), self._listener.fileno())
+            for task, (fd, session) in sessions:
+                session.update(name=task.session,
+                               idle_timeout=task.idle_timeout)
+                _send(conn, dict(session=session), fd)
+            _send(conn, dict(sent=len(sessions)))
+            reply, _ = _recv(conn)
+            if reply.get('adopted') != len(sessions):
+                raise RuntimeError("Replacement adopted %r of %d sessions" % (
+                    reply.get('adopted'), len(sessions)))
+        except BaseException:
+            for task, _ in sessions:
+                task.obj.resume()
+            raise
+        for task, _ in sessions:
+            task.obj.release()
+        LOG.info("Handed the listener and %d sessions over", len(sessions))
+
+
+def take_over(path):
+    """
+    Takes over from the server waiting on the UNIX socket `path`, see
+    `HandoffServer`. Returns its listening socket and a task for each of
+    its sessions.
+    """
+    sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener = None
+    tasks = []
+    try:
+        sock.connect(path)
+        while True:
+            header, fd = _recv(sock)
+            if header.get('listener'):
+                listener = gevent.socket.socket(fileno=fd)
+            elif 'session' in header:
+                session = header['session']
+                proc = Process.adopt(AdoptedChild(session['pid']), fd,
+                                     args=session['args'],
+                                     kill_timeout=session['kill_timeout'])
+                # Read once the running server has stopped reading
+                proc.pause()
+                tasks.append(TaskManager.spawn(
+                    proc, idle_timeout=session.get('idle_timeout'),
+                    session=session.get('name')))
+            elif 'sent' in header:
+                break
+            elif fd is not None:
+                os.close(fd)
+        if listener is None or header['sent'] != len(tasks):
+            raise RuntimeError("Incomplete handoff from %r" % (path,))
+        _send(sock, dict(adopted=len(tasks)))
+        for task in tasks:
+            task.obj.resume()
+    except Exception:
+        # The sessions stay with the running server
+        for task in tasks:
+            task.obj.release()
+        if listener is not None:
+            listener.close()
+        raise
+    finally:
+        sock.close()
+    LOG.info("Took over the listener and %d sessions from %r",
+             len(tasks), path)
+    return listener, tasks
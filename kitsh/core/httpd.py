@@ -5,6 +5,11 @@ from flask import Flask
 from gevent.pywsgi import WSGIServer
 from geventwebsocket.handler import WebSocketHandler
 from .plugin import Plugin
+from .task import TaskManager
+from .trace import TRACER
+from .inout import SpillQueue
+from .handoff import HandoffServer, take_over
+from .forkserver import DEFAULT_FORKSERVER
 
 
 LOG = logging.getLogger(__name__)
@@ -16,6 +21,10 @@ class Httpd(Plugin):
         self._flask = None
         self._listen = None
         self._server = None
+        self._idle_timeout = None
+        self._handoff_path = None
+        self._takeover = False
+        self._handoff = None
 
     def options(self, parser, env):
         parser.add_argument('--port', '-p',
@@ -27,8 +36,48 @@ class Httpd(Plugin):
             default='0.0.0.0',
             help='Host to listen to (default: 0.0.0.0)')
 
+        parser.add_argument('--idle-timeout',
+            type=float,
+            default=None,
+            help='Stop sessions idle for this many seconds')
+
+        parser.add_argument('--trace-rate',
+            type=float,
+            default=0.0,
+            help='Fraction of output to trace the latency of, see /latency'
+                 ' (default: 0)')
+
+        parser.add_argument('--spill-threshold',
+            type=int,
+            default=SpillQueue.threshold,
+            help='Bytes a channel buffers in memory before writing the '
+                 'oldest to disk, 0 to never (default: %(default)s)')
+
+        parser.add_argument('--spill-dir',
+            default=None,
+            help='Directory for buffers written to disk (default: $TMPDIR)')
+
+        parser.add_argument('--handoff',
+            metavar='PATH',
+            default=None,
+            help='Hand the listening socket and running sessions to a '
+                 'replacement started with --takeover, over this UNIX '
+                 'socket, instead of stopping them')
+
+        parser.add_argument('--takeover',
+            action='store_true',
+            help='Take over from the server waiting on --handoff')
+
     def configure(self, options, conf):
         self._listen = (options.host, options.port)
+        self._idle_timeout = options.idle_timeout
+        TRACER.rate = options.trace_rate
+        SpillQueue.threshold = options.spill_threshold or None
+        SpillQueue.spill_dir = options.spill_dir
+        self._handoff_path = options.handoff
+        self._takeover = options.takeover
+        if self._takeover and not self._handoff_path:
+            raise ValueError('--takeover needs --handoff')
 
     def __repr__(self):
         return "%s%r @ http://%s:%d" % (
@@ -36,17 +85,38 @@ class Httpd(Plugin):
             self._listen[0], int(self._listen[1]))
 
     def stop(self):
+        TaskManager.stop_reaper()
+        if self._handoff:
+            self._handoff.stop()
         if self._server:
             self._server.stop()
+        DEFAULT_FORKSERVER.stop()
+        for blueprint in self._blueprints:
+            close = getattr(blueprint, 'close', None)
+            if close is not None:
+                close()
 
     def run(self, task=None):
         flask = Flask(__name__, static_folder=None)
         for blueprint in self._blueprints:
             flask.register_blueprint(blueprint)
 
-        self._server = WSGIServer(self._listen, flask,
+        listener = self._listen
+        if self._takeover:
+            listener, _ = take_over(self._handoff_path)
+        self._server = WSGIServer(listener, flask,
             log=LOG,
             handler_class=WebSocketHandler)
+        if self._handoff_path:
+            # Once a replacement has everything this stops serving
+            self._server.start()
+            self._handoff = HandoffServer(self._handoff_path,
+                                          self._server.socket, self.stop)
+            self._handoff.start()
+        if self._idle_timeout:
+            TaskManager.start_reaper(
+                interval=min(10.0, self._idle_timeout / 2),
+                idle_timeout=self._idle_timeout)
         try:
             self._server.serve_forever()
         except KeyboardInterrupt:
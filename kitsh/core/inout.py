@@ -1,29 +1,439 @@
 from __future__ import print_function
 
+import re
+import mmap
+import time
+import codecs
+import pickle
 import logging
+import tempfile
+from collections import deque, namedtuple
+from itertools import islice
 
-from gevent.queue import Queue
+from gevent.hub import get_hub, Waiter
 from gevent.event import Event
 
-__all__ = ('Channel', 'Subscriber', 'Publisher', 'DataStream')
+__all__ = ('Channel', 'Subscriber', 'Publisher', 'DataStream', 'History',
+           'MessageQueue', 'SpillQueue', 'MessageFilter', 'Message',
+           'TracedMessage', 'DATA', 'ERROR', 'RESIZE')
 
 
 LOG = logging.getLogger(__name__)
 
 
+SET = Event()
+SET.set()
+
+DATA = 'data'
+ERROR = 'error'
+RESIZE = 'resize'
+# Name of a terminal session, for the client to rejoin it by
+SESSION = 'session'
+
+KINDS = (DATA, ERROR, RESIZE, SESSION)
+
+
+class Message(namedtuple('Message', ('kind', 'payload'))):
+    """
+    A chunk moving between tasks, tagged with its kind: DATA and ERROR
+    carry output, RESIZE a dict with the terminal 'width' and 'height'.
+
+    Only the JSON edges convert messages to and from {kind: payload}.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, obj):
+        for kind in KINDS:
+            if kind in obj:
+                return cls(kind, obj[kind])
+        raise ValueError("Unknown message: %r" % (obj,))
+
+    def to_dict(self):
+        return {self.kind: self.payload}
+
+
+# High resolution clock for tracing, falls back to time.time on Python 2
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class TracedMessage(Message):
+    """
+    A Message sampled for latency tracing, see `kitsh.core.trace`. Its
+    `trace` lists the (stage, clock()) it has passed, until the message
+    is finished with and `trace` becomes None.
+    """
+    # No __slots__, it needs somewhere to keep the trace
+
+    def stamp(self, stage):
+        trace = self.trace
+        if trace is not None:
+            trace.append((stage, clock()))
+
+
+class MessageQueue(object):
+    """
+    FIFO of messages with a blocking `get()`. Much lighter than gevent's
+    Queue for channels which are idle most of the time: nothing is
+    allocated until a message is buffered or a reader has to wait.
+    """
+    __slots__ = ('_items', '_waiters')
+
+    def __init__(self):
+        self._items = None
+        self._waiters = None
+
+    def __len__(self):
+        items = self._items
+        return len(items) if items else 0
+
+    qsize = __len__
+
+    def _wake(self):
+        waiter = self._waiters.pop(0)
+        get_hub().loop.run_callback(waiter.switch, None)
+
+    def put_nowait(self, item):
+        items = self._items
+        if items is None:
+            items = self._items = deque()
+        items.append(item)
+        if self._waiters:
+            self._wake()
+
+    def _wait(self):
+        if self._waiters is None:
+            self._waiters = []
+        waiter = Waiter()
+        self._waiters.append(waiter)
+        try:
+            waiter.get()
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif self._items and self._waiters:
+                # Pass on the wakeup this reader won't use
+                self._wake()
+            raise
+
+    def get(self):
+        while not self._items:
+            self._wait()
+        items = self._items
+        item = items.popleft()
+        if not items:
+            self._items = None
+        return item
+
+    def get_many(self):
+        """
+        Takes every buffered item at once, waiting for one if there are
+        none. Returns them as a deque.
+        """
+        if not self._items:
+            self._items = deque([self.get()])
+        items, self._items = self._items, None
+        return items
+
+
+class MessageFilter(object):
+    """
+    Picks the messages a filtered subscriber receives, see `Channel.watch`:
+
+      regex      only DATA or ERROR matching it, also where a match
+                 spans messages, within the last `window` bytes
+      line_mode  complete lines instead of chunks, each without its line
+                 ending, and with `regex` only the lines matching it.
+                 Lines longer than `max_line` bytes are delivered in
+                 parts of that size.
+
+    Called with every message published, it returns those to deliver.
+    Other objects than Messages are never delivered. Filtering by kind
+    is left to the Publisher.
+    """
+    __slots__ = ('_regex', '_line_mode', '_window', '_max_line', '_bufs')
+
+    def __init__(self, regex=None, line_mode=False, window=256,
+                 max_line=1 << 16):
+        if regex is not None:
+            if not hasattr(regex, 'search'):
+                regex = re.compile(regex if isinstance(regex, bytes)
+                                   else regex.encode('utf-8'))
+            elif not isinstance(regex.pattern, bytes):
+                regex = re.compile(regex.pattern.encode('utf-8'),
+                                   regex.flags & ~re.UNICODE)
+        self._regex = regex
+        self._line_mode = line_mode
+        self._window = window
+        self._max_line = max_line
+        # Unmatched or incomplete data, for each kind
+        self._bufs = None
+
+    def __call__(self, msg):
+        if msg is StopIteration:
+            return self._flush() + (StopIteration,)
+        if not isinstance(msg, Message):
+            return ()
+        payload = msg.payload
+        if not isinstance(payload, bytes):
+            if not isinstance(payload, type(u'')):
+                return ()
+            payload = payload.encode('utf-8')
+        if self._bufs is None:
+            self._bufs = dict()
+        data = self._bufs.pop(msg.kind, b'') + payload
+        if self._line_mode:
+            return self._lines(msg.kind, data)
+        return self._search(msg, data)
+
+    def _search(self, msg, data):
+        end = None
+        for match in self._regex.finditer(data):
+            end = match.end()
+        # What may still start a match with the next message
+        rest = data[max(end or 0, len(data) - self._window):]
+        if rest:
+            self._bufs[msg.kind] = rest
+        return (msg,) if end is not None else ()
+
+    def _lines(self, kind, data):
+        lines = data.split(b'\n')
+        rest = lines.pop()
+        max_line = self._max_line
+        while len(rest) >= max_line:
+            # A line this long is delivered in parts
+            lines.append(rest[:max_line])
+            rest = rest[max_line:]
+        if rest:
+            self._bufs[kind] = rest
+        regex = self._regex
+        return tuple(Message(kind, line) for line in
+                     (line[:-1] if line.endswith(b'\r') else line
+                      for line in lines)
+                     if regex is None or regex.search(line))
+
+    def _flush(self):
+        """
+        The incomplete last line of each kind, once the channel ends
+        """
+        bufs, self._bufs = self._bufs, None
+        if not bufs or not self._line_mode:
+            return ()
+        msgs = ()
+        for kind, rest in bufs.items():
+            if self._regex is None or self._regex.search(rest):
+                msgs += (Message(kind, rest),)
+        return msgs
+
+
+def _size(item):
+    if type(item) is Message and isinstance(item.payload, bytes):
+        return len(item.payload)
+    return 0
+
+
+class _SpillFile(object):
+    """
+    Messages written to an unlinked temporary file, read back in order
+    through an mmap of the part of it being read, so what was read
+    doesn't stay mapped
+    """
+    __slots__ = ('_file', '_map', '_start', '_end', '_records', '_held',
+                 'nbytes')
+
+    # Bytes mapped at once, unless one message is larger
+    WINDOW = 1 << 22
+
+    # Kind of the records of what couldn't be pickled
+    HELD = object()
+
+    def __init__(self, spill_dir=None):
+        self._file = tempfile.TemporaryFile(prefix='kitsh-spill-',
+                                            dir=spill_dir)
+        self._map = None
+        # Offset of the mapped part in the file
+        self._start = 0
+        self._end = 0
+        # (kind, offset, length) of each message, kind is None when the
+        # whole message was pickled, HELD when it is in `_held`
+        self._records = deque()
+        # What couldn't be pickled, in order
+        self._held = deque()
+        # Written and not yet read back
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def write(self, item):
+        """
+        Writes the message, or keeps it in memory in its place if it
+        can't be pickled
+        """
+        if type(item) is Message and isinstance(item.payload, bytes):
+            kind, data = item.kind, item.payload
+        else:
+            try:
+                kind, data = None, pickle.dumps(item, -1)
+            except Exception:
+                self._held.append(item)
+                self._records.append((_SpillFile.HELD, self._end, 0))
+                return
+        self._file.write(data)
+        self._records.append((kind, self._end, len(data)))
+        self._end += len(data)
+        self.nbytes += len(data)
+
+    def read(self):
+        kind, offset, length = self._records.popleft()
+        if kind is _SpillFile.HELD:
+            return self._held.popleft()
+        end = offset + length
+        data = b''
+        if length:
+            mapped = self._map
+            if mapped is None or end > self._start + len(mapped):
+                self._file.flush()
+                if mapped is not None:
+                    mapped.close()
+                start = offset - offset % mmap.ALLOCATIONGRANULARITY
+                mapped = self._map = mmap.mmap(
+                    self._file.fileno(),
+                    min(max(self.WINDOW, end - start), self._end - start),
+                    access=mmap.ACCESS_READ, offset=start)
+                self._start = start
+            data = mapped[offset - self._start:end - self._start]
+        self.nbytes -= length
+        if kind is None:
+            return pickle.loads(data)
+        return Message(kind, data)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+class SpillQueue(MessageQueue):
+    """
+    A MessageQueue which keeps at most about `threshold` bytes of DATA
+    and ERROR in memory. Past that the oldest messages are written to a
+    temporary file in `spill_dir`, and read back from it in order. The
+    file is closed once everything in it was read.
+
+    The newest message always stays in memory, so waiting readers are
+    woken by it like with a MessageQueue.
+    """
+    __slots__ = ('_nbytes', '_spill')
+
+    # Set to None to keep everything in memory
+    threshold = 1 << 20
+    spill_dir = None
+
+    def __init__(self):
+        MessageQueue.__init__(self)
+        # Bytes of the messages in memory
+        self._nbytes = 0
+        self._spill = None
+
+    def __len__(self):
+        items, spill = self._items, self._spill
+        return (len(items) if items else 0) + (len(spill) if spill else 0)
+
+    qsize = __len__
+
+    @property
+    def spilled(self):
+        """
+        Bytes written to disk and not yet read back
+        """
+        spill = self._spill
+        return spill.nbytes if spill is not None else 0
+
+    def put_nowait(self, item):
+        # MessageQueue.put_nowait() and _size() inline, this is busy
+        items = self._items
+        if items is None:
+            items = self._items = deque()
+        items.append(item)
+        if self._waiters:
+            self._wake()
+        if type(item) is Message and isinstance(item.payload, bytes):
+            self._nbytes += len(item.payload)
+            threshold = self.threshold
+            if threshold is not None and self._nbytes > threshold:
+                self._spill_oldest(threshold // 2)
+
+    def _spill_oldest(self, keep):
+        items = self._items
+        while self._nbytes > keep and len(items) > 1:
+            if self._spill is None:
+                self._spill = _SpillFile(self.spill_dir)
+            item = items.popleft()
+            self._spill.write(item)
+            self._nbytes -= _size(item)
+
+    def _unspill(self):
+        spill = self._spill
+        item = spill.read()
+        if not spill:
+            self._spill = None
+            spill.close()
+        return item
+
+    def get(self):
+        while not self._items:
+            self._wait()
+        if self._spill is not None:
+            return self._unspill()
+        items = self._items
+        item = items.popleft()
+        if not items:
+            self._items = None
+        if type(item) is Message and isinstance(item.payload, bytes):
+            self._nbytes -= len(item.payload)
+        return item
+
+    def get_many(self):
+        """
+        Takes every buffered item at once, but while some are on disk
+        only those of them up to the threshold
+        """
+        while not self._items:
+            self._wait()
+        if self._spill is None:
+            self._nbytes = 0
+            return MessageQueue.get_many(self)
+        items = deque()
+        nbytes = 0
+        limit = self.threshold or 0
+        while self._spill is not None and nbytes <= limit:
+            item = self._unspill()
+            nbytes += _size(item)
+            items.append(item)
+        return items
+
+
 class Subscriber(object):
-    __slots__ = ('_pub', '_queue', '_closed', '_replyfn')
+    """
+    Queues the messages of a publisher until they are received, or only
+    those of `kinds` picked by `msgfilter`, see `MessageFilter`.
+    """
+    __slots__ = ('_pub', '_queue', '_closed', '_filter')
 
-    def __init__(self, pub):
+    def __init__(self, pub, msgfilter=None, kinds=None):
         assert isinstance(pub, Publisher)
         self._pub = pub
-        self._queue = Queue()
-        self._closed = Event()
-        pub.attach(self)
+        self._queue = MessageQueue()
+        self._closed = False
+        self._filter = msgfilter
+        pub.attach(self, kinds)
 
     def __len__(self):
         if self._queue:
             return self._queue.qsize()
+        return 0
 
     def __call__(self, msg):
         return self.send(msg)
@@ -46,73 +456,150 @@ class Subscriber(object):
                 yield msg
 
     def recv(self):
-        if self._queue:
+        if self._queue is not None:
             msg = self._queue.get()
             if msg is StopIteration:
                 self._queue = None
                 self.close()
                 return None
+            if type(msg) is TracedMessage:
+                msg.stamp('recv')
             return msg
 
     def send(self, msg):
         if self.closed:
             # XXX: raise better exception
             raise RuntimeError("Closed")
+        if self._filter is not None:
+            # Only what passes is queued, the rest costs nothing more
+            for msg in self._filter(msg):
+                if msg is StopIteration:
+                    return self.close()
+                self._queue.put_nowait(msg)
+            return
         if msg is StopIteration:
             return self.close()
         self._queue.put_nowait(msg)
 
     @property
     def closed(self):
-        return self._closed.ready() and self._queue is None
+        return self._closed and self._queue is None
 
     def close(self):
         if self._queue is not None:
-            self._queue.put(StopIteration)
-        if not self.closed:
+            self._queue.put_nowait(StopIteration)
+        if not self._closed:
             self._pub.detach(self)
-            self._closed.set()
+            self._closed = True
 
-    def datastream(self):
-        return DataStream(self)
+    def datastream(self, encoding=None):
+        return DataStream(self, encoding)
 
 
 class Publisher(object):
-    __slots__ = ('_subs',)
+    """
+    Sends every message to each attached receiver, in the order they
+    were attached. The receivers are kept as a tuple which is replaced,
+    never changed, so sending needn't copy it in case a receiver
+    detaches while it is being called.
+
+    Receivers attached for some `kinds` of message are looked up by the
+    kind of each message, so they cost nothing for other messages. They
+    all receive the end of the stream.
+    """
+    __slots__ = ('_subs', '_filtered', '_bykind')
 
     def __init__(self):
-        self._subs = set()
+        self._subs = ()
+        self._filtered = ()
+        self._bykind = None
 
     def __len__(self):
-        return len(self._subs)
+        return len(self._subs) + len(self._filtered)
 
     def __del__(self):
         self.close()
 
-    def subscribe(self):
-        return Subscriber(self)
-
-    def attach(self, receiverfn):
-        self._subs.add(receiverfn)
+    def subscribe(self, msgfilter=None, kinds=None):
+        return Subscriber(self, msgfilter, kinds)
+
+    def attach(self, receiverfn, kinds=None):
+        if receiverfn in self._subs or receiverfn in self._filtered:
+            return
+        if kinds is None:
+            self._subs += (receiverfn,)
+            return
+        self._filtered += (receiverfn,)
+        if self._bykind is None:
+            self._bykind = dict()
+        bykind = self._bykind
+        if isinstance(kinds, (str, type(u''))):
+            kinds = (kinds,)
+        for kind in set(kinds):
+            bykind[kind] = bykind.get(kind, ()) + (receiverfn,)
 
     def detach(self, receiverfn):
-        self._subs.discard(receiverfn)
+        if receiverfn in self._subs:
+            self._subs = tuple(fn for fn in self._subs if fn != receiverfn)
+        elif receiverfn in self._filtered:
+            self._filtered = tuple(fn for fn in self._filtered
+                                   if fn != receiverfn)
+            bykind = self._bykind
+            for kind, receivers in list(bykind.items()):
+                if receiverfn in receivers:
+                    receivers = tuple(fn for fn in receivers
+                                      if fn != receiverfn)
+                    if receivers:
+                        bykind[kind] = receivers
+                    else:
+                        del bykind[kind]
+            if not self._filtered:
+                self._bykind = None
 
     def send(self, msg):
-        for receiverfn in self._subs.copy():
-            receiverfn(msg)
+        subs = self._subs
+        if len(subs) == 1:
+            subs[0](msg)
+        else:
+            for receiverfn in subs:
+                receiverfn(msg)
+        bykind = self._bykind
+        if bykind is not None:
+            if msg is StopIteration:
+                subs = self._filtered
+            else:
+                subs = bykind.get(getattr(msg, 'kind', None), ())
+            for receiverfn in subs:
+                receiverfn(msg)
 
     def close(self):
         self.send(StopIteration)
 
 
 class Channel(object):
-    __slots__ = ('_recvq', '_closed', '_mon')
+    """
+    Buffers messages until they are received, or delivers them to every
+    attached watcher. The publisher, buffer and closed event are only
+    created when they are first needed, so idle channels stay small.
+    Large buffers spill to disk, see `SpillQueue`.
+    """
+    __slots__ = ('_recvq', '_closed', '_ended', '_onend', '_onactive',
+                 '_taps', '_closed_event', '_mon', '_active', '_hold',
+                 'nmsgs', 'nbytes')
 
     def __init__(self):
-        self._mon = Publisher()
-        self._recvq = Queue()
-        self._closed = Event()
+        self._mon = None
+        self._hold = None
+        self._recvq = SpillQueue()
+        self._closed = False
+        self._ended = False
+        self._onend = None
+        self._onactive = None
+        self._taps = None
+        self._closed_event = None
+        self._active = get_hub().loop.now()
+        self.nmsgs = 0
+        self.nbytes = 0
 
     def __iter__(self):
         while not self.closed:
@@ -123,86 +610,376 @@ class Channel(object):
 
     def __len__(self):
         """
-        Number of messages in buffer which haven't been delivered to watchers
+        Number of messages in buffer which haven't been delivered to watchers,
+        `nmsgs` and `nbytes` count every message and DATA/ERROR byte sent.
         """
         return self._recvq.qsize()
 
     def __del__(self):
         self.close()
 
+    @property
+    def watchers(self):
+        """
+        Number of subscribers and receivers attached to the channel
+        """
+        mon = self._mon
+        return len(mon) if mon is not None else 0
+
+    @property
+    def last_active(self):
+        """
+        Event loop time at which the last message was sent
+        """
+        return self._active
+
+    def touch(self, nbytes=0):
+        """
+        Counts `nbytes` which went around the channel, such as straight
+        into another task's file descriptor, as activity on it
+        """
+        self._active = get_hub().loop.now()
+        self.nbytes += nbytes
+        if self._onactive is not None:
+            self._woken()
+
     def send(self, msg):
-        self._recvq.put_nowait(msg)
-        if len(self._mon):
+        self._active = get_hub().loop.now()
+        if self._onactive is not None:
+            self._woken()
+        self._put(msg)
+
+    def send_many(self, msgs):
+        """
+        Sends each of `msgs` in turn, like `send` but only marking the
+        channel active once for all of them
+        """
+        self._active = get_hub().loop.now()
+        if self._onactive is not None:
+            self._woken()
+        put = self._put
+        for msg in msgs:
+            put(msg)
+
+    def _put(self, msg):
+        if msg is StopIteration and not self._ended:
+            self._ended = True
+            callbacks, self._onend = self._onend, None
+            for callback in callbacks or ():
+                callback(self)
+        if type(msg) is TracedMessage:
+            msg.stamp('send')
+        self.nmsgs += 1
+        if isinstance(msg, Message) and isinstance(msg.payload, bytes):
+            self.nbytes += len(msg.payload)
+        if self._taps is not None:
+            for callback in self._taps:
+                callback(msg)
+        if self._mon is None or not len(self._mon):
+            self._recvq.put_nowait(msg)
+        elif self._recvq._items or self._closed:
+            # Behind what is still buffered
+            self._recvq.put_nowait(msg)
             self.recv()
+        else:
+            # Straight to the watchers, without a round trip via the queue
+            self._dispatch(msg)
 
-    def watch(self):
-        was_first = len(self._mon) == 0
-        subscriber = self._mon.subscribe()
+    def _publisher(self):
+        if self._mon is None:
+            self._mon = Publisher()
+        return self._mon
+
+    def watch(self, kinds=None, regex=None, line_mode=False):
+        """
+        Subscribes to the messages of the channel, starting with those
+        still buffered. With `kinds` only messages of those kinds are
+        queued for the subscriber, with `regex` or `line_mode` only those
+        picked by a `MessageFilter`.
+        """
+        msgfilter = None
+        if regex is not None or line_mode:
+            msgfilter = MessageFilter(regex, line_mode)
+        was_first = self.watchers == 0
+        subscriber = self._publisher().subscribe(msgfilter, kinds)
         if was_first:
             self._recvall()
         return subscriber
 
+    def attach(self, receiverfn):
+        """
+        Deliver every message directly to `receiverfn`, without the
+        intermediate Subscriber queue that `watch()` creates.
+        """
+        was_first = self.watchers == 0
+        self._publisher().attach(receiverfn)
+        if was_first:
+            self._recvall()
+
+    def detach(self, receiverfn):
+        if self._mon is not None:
+            self._mon.detach(receiverfn)
+
     def _recvall(self):
         while self._recvq.qsize():
             self.recv()
 
     def write(self, data):
-        self.send(dict(data=data))
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.send(Message(DATA, data))
 
     def recv(self):
         if self.closed:
             # XXX: raise better exception
             raise RuntimeError("Closed")
-        msg = self._recvq.get()
-        self._mon.send(msg)
+        return self._dispatch(self._recvq.get())
+
+    def recv_many(self):
+        """
+        Receives every buffered message at once, waiting for one if there
+        are none. The list ends with StopIteration if the channel does.
+        """
+        if self.closed:
+            # XXX: raise better exception
+            raise RuntimeError("Closed")
+        msgs = []
+        dispatch = self._dispatch
+        for msg in self._recvq.get_many():
+            msgs.append(dispatch(msg))
+            if msg is StopIteration:
+                break
+        return msgs
+
+    def _dispatch(self, msg):
+        if self._mon is not None:
+            self._mon.send(msg)
         if msg is StopIteration:
-            self._closed.set()
+            self._closed = True
+            if self._closed_event is not None:
+                self._closed_event.set()
         return msg
 
     def wait(self):
-        return self._closed.wait()
+        if self._closed:
+            return True
+        if self._closed_event is None:
+            self._closed_event = Event()
+        return self._closed_event.wait()
 
     @property
     def closed(self):
-        return self._closed.ready()
+        return self._closed
+
+    @property
+    def ended(self):
+        """
+        True once the end of the channel has been sent, it is `closed`
+        when the end has also been received.
+        """
+        return self._ended
+
+    def onend(self, callback):
+        """
+        Calls `callback(channel)` as soon as the end of the channel is
+        sent, before any watcher receives it.
+        """
+        if self._ended:
+            callback(self)
+        elif self._onend is None:
+            self._onend = [callback]
+        else:
+            self._onend.append(callback)
+
+    def remove_onend(self, callback):
+        if self._onend is not None and callback in self._onend:
+            self._onend.remove(callback)
+
+    def onactive(self, callback):
+        """
+        Calls `callback(channel)` once, the next time there is activity on
+        the channel, so quiet channels needn't be polled.
+        """
+        if self._onactive is None:
+            self._onactive = [callback]
+        else:
+            self._onactive.append(callback)
+
+    def remove_onactive(self, callback):
+        if self._onactive is not None and callback in self._onactive:
+            self._onactive.remove(callback)
+
+    def tap(self, callback):
+        """
+        Calls `callback(msg)` with every message sent, up to and including
+        the end of the channel. Unlike a watcher it doesn't receive them,
+        they are still buffered for the channel's reader.
+        """
+        self._taps = (self._taps or ()) + (callback,)
+
+    def untap(self, callback):
+        if self._taps is not None and callback in self._taps:
+            self._taps = tuple(fn for fn in self._taps
+                               if fn != callback) or None
+
+    def _woken(self):
+        callbacks, self._onactive = self._onactive, None
+        for callback in callbacks:
+            callback(self)
 
     def close(self):
-        if not self.closed:
+        self.release()
+        if not self._ended:
             self.send(StopIteration)
 
-    def datastream(self):
-        return DataStream(self)
+    def hold(self):
+        """
+        Asks senders which can pause, such as a Process reading its
+        output, to stop sending until `release()`.
+        """
+        if self._hold is None:
+            self._hold = Event()
 
+    def release(self):
+        hold = self._hold
+        if hold is not None:
+            self._hold = None
+            hold.set()
 
-class DataStream(object):
-    __slots__ = ('_buf', '_sock')
+    def ready(self, timeout=None):
+        """
+        Waits until the channel isn't held, True if it isn't
+        """
+        hold = self._hold
+        if hold is not None:
+            hold.wait(timeout)
+        return self._hold is None
+
+    def datastream(self, encoding=None):
+        return DataStream(self, encoding)
+
+
+class History(object):
+    """
+    Remembers the last `maxlen` messages sent on a channel, numbered from
+    1 upwards, so readers which attach later can catch up from a known
+    position. `onclose` is called with the history when the channel ends.
+    """
+    __slots__ = ('_chan', '_msgs', '_last', '_onclose')
+
+    def __init__(self, chan, maxlen=1000, onclose=None):
+        self._chan = chan
+        self._msgs = deque(maxlen=maxlen)
+        self._last = 0
+        self._onclose = onclose
+        chan.attach(self)
+
+    def __len__(self):
+        return len(self._msgs)
+
+    def __call__(self, msg):
+        if msg is StopIteration:
+            self.close()
+        else:
+            self._last += 1
+            self._msgs.append(msg)
+
+    @property
+    def last(self):
+        """
+        Number of the most recent message
+        """
+        return self._last
+
+    @property
+    def closed(self):
+        return self._chan is None
+
+    def since(self, seq):
+        """
+        Returns (number, message) pairs for buffered messages after `seq`,
+        older messages which have fallen out of the buffer are skipped.
+        """
+        first = self._last - len(self._msgs) + 1
+        start = max(seq + 1, first)
+        return list(zip(range(start, self._last + 1),
+                        islice(self._msgs, start - first, None)))
 
-    def __init__(self, sock):
-        self._buf = ''
+    def close(self):
+        chan = self._chan
+        if chan is not None:
+            self._chan = None
+            chan.detach(self)
+            if self._onclose is not None:
+                self._onclose(self)
+
+
+class DataStream(object):
+    """
+    Reads and writes the DATA payloads of a channel or subscriber as one
+    stream of bytes. With an `encoding` it reads and writes text instead,
+    decoding incrementally so characters split across messages survive.
+    Reads return an empty value at the end of the stream.
+    """
+    __slots__ = ('_buf', '_sock', '_encoding', '_decoder')
+
+    def __init__(self, sock, encoding=None):
         self._sock = sock
+        self._encoding = encoding
+        if encoding is None:
+            self._decoder = None
+            self._buf = b''
+        else:
+            self._decoder = codecs.getincrementaldecoder(encoding)('replace')
+            self._buf = u''
 
     def __len__(self):
         return len(self._buf)
 
-    def readline(self, newline='\n'):
-        if newline in self._buf:
-            pos = self._buf.index(newline)
-            line = self._buf[:pos]
-            self._buf = self._buf[pos:]
-            return line.rstrip(newline)
-
-        for data in self:
-            if newline in data:
-                pos = data.index(newline) + 1
-                line = self._buf + data[:pos]
-                self._buf = data[pos:]
-                return line.rstrip(newline)
-            else:
-                self._buf += data
+    def _next(self):
+        """
+        Next chunk of the stream, empty at the end
+        """
+        decoder = self._decoder
+        if self._sock is not None:
+            for msg in self._sock:
+                if not isinstance(msg, Message) or msg.kind != DATA:
+                    continue
+                data = msg.payload
+                if decoder is not None:
+                    data = decoder.decode(data)
+                if data:
+                    return data
+        if decoder is not None:
+            return decoder.decode(b'', True)
+        return b''
+
+    def readline(self, newline=None):
+        """
+        Returns the next line without its `newline`, or what remains
+        of the stream if it ends first.
+        """
+        if newline is None:
+            newline = b'\n' if self._decoder is None else u'\n'
+        while True:
+            pos = self._buf.find(newline)
+            if pos >= 0:
+                line = self._buf[:pos]
+                self._buf = self._buf[pos + len(newline):]
+                return line
+            data = self._next()
+            if not data:
+                line = self._buf
+                self._buf = self._buf[:0]
+                return line
+            self._buf += data
 
     def __iter__(self):
-        while not self._sock.closed:
-            yield self.read()
+        while True:
+            data = self.read()
+            if not data:
+                break
+            yield data
 
     def __enter__(self):
         return self
@@ -213,22 +990,34 @@ class DataStream(object):
     def __del__(self):
         self.close()
 
+    @property
+    def closed(self):
+        return self._sock is None
+
     def close(self):
         self._sock = None
 
     def write(self, data):
-        self._sock.send(dict(data=data))
+        if not isinstance(data, bytes):
+            data = data.encode(self._encoding or 'utf-8')
+        self._sock.send(Message(DATA, data))
 
     def read(self, maxbytes=None):
-        for msg in self._sock:
-            if 'data' not in msg:
-                continue
-            data = msg['data']
-            if maxbytes is None:
+        """
+        Returns the next chunk, or with `maxbytes` waits for that many
+        bytes (characters in text mode) unless the stream ends first.
+        """
+        if maxbytes is None:
+            if self._buf:
+                data = self._buf
+                self._buf = self._buf[:0]
                 return data
+            return self._next()
+        while len(self._buf) < maxbytes:
+            data = self._next()
+            if not data:
+                break
             self._buf += data
-            if len(self._buf) >= maxbytes:
-                retval = self._buf[:maxbytes]
-                self._buf = self._buf[maxbytes:]
-                return retval
-        raise StopIteration
+        data = self._buf[:maxbytes]
+        self._buf = self._buf[maxbytes:]
+        return data
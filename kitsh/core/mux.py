@@ -0,0 +1,351 @@
+import json
+import struct
+import logging
+
+import gevent
+from gevent.event import Event
+from gevent.lock import Semaphore
+
+from .inout import Message, TracedMessage, DATA, ERROR
+from .trace import TRACER
+from .task import TaskManager
+
+__all__ = ('Multiplexer', 'MuxStream', 'OPEN', 'CLOSE', 'MSG', 'DATA_FRAME',
+           'CONTROL', 'WINDOW')
+
+
+LOG = logging.getLogger(__name__)
+
+# Every frame is a binary websocket message, starting with the stream ID
+# and frame type. Stream 0 carries messages about the connection itself.
+HEADER = struct.Struct('!IB')
+CREDIT = struct.Struct('!I')
+
+OPEN = 1        # New stream, payload is a JSON object of parameters
+CLOSE = 2       # Stream has ended, no payload
+DATA_FRAME = 3  # Raw bytes of a DATA message
+CONTROL = 4     # Other messages as JSON {kind: payload}, any JSON on 0
+WINDOW = 5      # Receiver consumed this many more DATA bytes, as uint32
+MSG = (DATA_FRAME, CONTROL)
+
+
+def pack(stream_id, op, payload=b''):
+    return HEADER.pack(stream_id, op) + payload
+
+
+def unpack(frame):
+    stream_id, op = HEADER.unpack_from(frame)
+    return stream_id, op, bytes(frame[HEADER.size:])
+
+
+def encode_message(msg):
+    """
+    Frame type and payload for a task message
+    """
+    if msg.kind == DATA:
+        payload = msg.payload
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        return DATA_FRAME, payload
+    payload = msg.payload
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', 'replace')
+    return CONTROL, json.dumps({msg.kind: payload}).encode('utf-8')
+
+
+def decode_message(op, payload):
+    if op == DATA_FRAME:
+        return Message(DATA, payload)
+    msg = Message.from_dict(json.loads(payload.decode('utf-8')))
+    if msg.kind == ERROR and not isinstance(msg.payload, bytes):
+        msg = Message(ERROR, msg.payload.encode('utf-8'))
+    return msg
+
+
+class MuxStream(object):
+    """
+    One logical stream of a `Multiplexer`, run as a task. Messages sent
+    to the task's input go to the other end, messages from the other end
+    come out of its output, so it bridges to a Process like a Websocket.
+
+    When the other end opened the stream with a `window` parameter, it
+    may only be sent that many bytes of DATA more than it has consumed,
+    which it tells us with WINDOW frames. DATA larger than the credit
+    left is split. While out of credit the stream holds the `throttle`
+    channel, so a Process feeding it stops reading.
+    """
+    __slots__ = ('_mux', 'stream_id', 'params', 'task', '_remote_closed',
+                 '_credit', '_window', 'throttle')
+
+    def __init__(self, mux, stream_id, params=None, credit=None):
+        self._mux = mux
+        self.stream_id = stream_id
+        self.params = params or dict()
+        self.task = None
+        self._remote_closed = False
+        self._credit = credit
+        self._window = None
+        self.throttle = None
+
+    def __repr__(self):
+        return "%s %d @ %r" % (self.__class__.__name__, self.stream_id,
+                               self._mux)
+
+    def run(self, task):
+        try:
+            for msg in task.input.watch():
+                if self._remote_closed:
+                    break
+                if not isinstance(msg, Message):
+                    continue
+                traced = type(msg) is TracedMessage
+                op, payload = encode_message(msg)
+                if traced:
+                    msg.stamp('encode')
+                if op == DATA_FRAME and self._credit is not None:
+                    if not self._send_data(payload):
+                        break
+                elif not self._mux.send(self.stream_id, op, payload):
+                    break
+                if traced:
+                    msg.stamp('sent')
+                    TRACER.finish(msg)
+        finally:
+            self.close()
+
+    def _send_data(self, payload):
+        """
+        Sends DATA in frames no larger than the credit left
+        """
+        offset = 0
+        while offset < len(payload):
+            if not self._wait_credit():
+                return False
+            chunk = payload[offset:offset + self._credit]
+            offset += len(chunk)
+            self._credit -= len(chunk)
+            if self._credit <= 0 and self.throttle is not None:
+                self.throttle.hold()
+            if not self._mux.send(self.stream_id, DATA_FRAME, chunk):
+                return False
+        return True
+
+    def _wait_credit(self):
+        while self._credit <= 0 and not self._remote_closed:
+            if self._window is None:
+                self._window = Event()
+            self._window.wait()
+            self._window = None
+        return not self._remote_closed
+
+    def credit(self, nbytes):
+        """
+        The other end consumed `nbytes` more, from a WINDOW frame
+        """
+        if self._credit is None:
+            return
+        self._credit += nbytes
+        if self._credit > 0:
+            if self.throttle is not None:
+                self.throttle.release()
+            if self._window is not None:
+                self._window.set()
+
+    def grant(self, nbytes):
+        """
+        Tells the other end we consumed `nbytes` of its DATA, when this
+        end opened the stream with a `window`
+        """
+        self._mux.send(self.stream_id, WINDOW, CREDIT.pack(nbytes))
+
+    def deliver(self, msg):
+        self.task.output.send(msg)
+
+    def remote_closed(self):
+        """
+        The other end closed the stream, or the connection has gone
+        """
+        if not self._remote_closed:
+            self._remote_closed = True
+            if self._window is not None:
+                self._window.set()
+            if self.throttle is not None:
+                self.throttle.release()
+            self.task.output.close()
+            self.task.input.close()
+
+    def close(self):
+        mux = self._mux
+        if mux.forget(self) and not self._remote_closed:
+            mux.send(self.stream_id, CLOSE)
+
+    def stop(self):
+        # Stopping the task closes its input, run() then sends what is
+        # still queued before closing the stream
+        pass
+
+
+class Multiplexer(object):
+    """
+    Carries many task streams over one message based connection, such as
+    a websocket, which has `send(bytes)` and `receive()` returning None
+    once it is closed.
+
+    Either end can `open()` a stream; the `initiator` end uses odd stream
+    IDs and the other end even IDs so they never collide. Streams opened
+    by the other end are passed to `onopen(stream_task)`, in their own
+    greenlet. JSON objects sent to stream 0 with `send_control` are passed
+    to `oncontrol(obj)`.
+    """
+    __slots__ = ('_ws', '_streams', '_next_id', '_lock', '_closed',
+                 '_onopen', '_oncontrol', 'name', '__weakref__')
+
+    def __init__(self, ws, initiator=True, onopen=None, oncontrol=None,
+                 name=None):
+        self._ws = ws
+        self._streams = dict()
+        self._next_id = 1 if initiator else 2
+        self._lock = Semaphore()
+        self._closed = False
+        self._onopen = onopen
+        self._oncontrol = oncontrol
+        self.name = name
+
+    def __repr__(self):
+        return "%s(%s, %d streams)" % (
+            self.__class__.__name__, self.name or "%x" % (id(self),),
+            len(self._streams))
+
+    def __len__(self):
+        return len(self._streams)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def send(self, stream_id, op, payload=b''):
+        """
+        Sends one frame, returns False if the connection has gone
+        """
+        if self._closed:
+            return False
+        # Frames from different greenlets must not interleave
+        with self._lock:
+            try:
+                self._ws.send(pack(stream_id, op, payload))
+            except Exception as ex:
+                LOG.warning("%r send failed: %s", self, ex)
+                self.close()
+                return False
+        return True
+
+    def send_control(self, obj):
+        return self.send(0, CONTROL, json.dumps(obj).encode('utf-8'))
+
+    def _stream(self, stream_id, params, credit=None):
+        stream = MuxStream(self, stream_id, params, credit)
+        self._streams[stream_id] = stream
+        stream.task = TaskManager.spawn(stream)
+        return stream.task
+
+    def open(self, **params):
+        """
+        Opens a new stream, returning its task. With `window=nbytes` the
+        other end sends at most that much DATA beyond what was granted
+        back with `task.obj.grant()`.
+        """
+        if self._closed:
+            raise RuntimeError("%r is closed" % (self,))
+        stream_id = self._next_id
+        self._next_id += 2
+        # Registered first, so the stream closes if sending OPEN fails
+        stream_task = self._stream(stream_id, params)
+        self.send(stream_id, OPEN, json.dumps(params).encode('utf-8'))
+        return stream_task
+
+    def forget(self, stream):
+        """
+        Removes a stream, True if it was still open
+        """
+        return self._streams.pop(stream.stream_id, None) is not None
+
+    def run(self, task=None):
+        """
+        Receives and dispatches frames until the connection closes
+        """
+        try:
+            while not self._closed:
+                frame = self._ws.receive()
+                if frame is None:
+                    break
+                if isinstance(frame, type(u'')) or len(frame) < HEADER.size:
+                    LOG.warning("%r ignoring invalid frame", self)
+                    continue
+                self._dispatch(*unpack(frame))
+        except Exception as ex:
+            LOG.warning("%r receive failed: %s", self, ex)
+        finally:
+            self.close()
+
+    def _dispatch(self, stream_id, op, payload):
+        if op == OPEN:
+            if stream_id == 0 or stream_id in self._streams or \
+                    stream_id % 2 == self._next_id % 2:
+                LOG.warning("%r invalid stream %d opened", self, stream_id)
+                return
+            try:
+                params = json.loads(payload.decode('utf-8'))
+            except ValueError:
+                params = None
+            credit = None
+            if isinstance(params, dict):
+                window = params.get('window')
+                if isinstance(window, int) and window > 0:
+                    credit = window
+            stream_task = self._stream(stream_id, params, credit)
+            if self._onopen is None:
+                stream_task.stop()
+            else:
+                gevent.spawn(self._onopen, stream_task)
+            return
+        if stream_id == 0:
+            if op == CONTROL and self._oncontrol is not None:
+                try:
+                    obj = json.loads(payload.decode('utf-8'))
+                except ValueError:
+                    LOG.warning("%r invalid control message", self)
+                    return
+                self._oncontrol(obj)
+            return
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            return
+        if op == CLOSE:
+            self._streams.pop(stream_id, None)
+            stream.remote_closed()
+        elif op == WINDOW:
+            if len(payload) == CREDIT.size:
+                stream.credit(CREDIT.unpack(payload)[0])
+        elif op in MSG:
+            try:
+                stream.deliver(decode_message(op, payload))
+            except (ValueError, TypeError):
+                LOG.warning("%r stream %d invalid message", self, stream_id)
+
+    def close(self):
+        """
+        Closes the connection and every stream carried over it
+        """
+        if self._closed:
+            return
+        self._closed = True
+        streams = list(self._streams.values())
+        self._streams.clear()
+        for stream in streams:
+            stream.remote_closed()
+        try:
+            self._ws.close()
+        except Exception:
+            pass
+
+    stop = close
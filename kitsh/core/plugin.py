@@ -45,9 +45,14 @@ class Plugin(object):
     """
     Provides an interface to validate options and initialise its self
     similar to: http://nose.readthedocs.org/en/latest/plugins/writing.html
+
+    Plugins run for as long as the program, so their tasks are never
+    stopped for being idle.
     """
     __slots__ = ()
 
+    idle_timeout = float('inf')
+
     def options(self, parser, env):
         """
         Add additional program options to the parser
@@ -2,16 +2,23 @@ from __future__ import print_function
 
 import os
 import pty
+import errno
 import logging
 import struct
 import fcntl
 import termios
+import resource
 
 import gevent
 from gevent.hub import get_hub
 from gevent.socket import wait, cancel_wait
 from gevent.event import Event
-from gevent.subprocess import Popen
+from gevent.subprocess import Popen, PIPE
+
+from .reaper import ChildReaper
+from .sched import DEFAULT_SCHEDULER
+from .inout import DATA, ERROR, RESIZE
+from .trace import TRACER
 
 __all__ = ('Process',)
 
@@ -19,27 +26,272 @@ __all__ = ('Process',)
 LOG = logging.getLogger(__name__)
 
 
+SPLICE_CHUNK = 65536
+
+READ_SIZE = 65536
+
+PIPE_SIZE = 1 << 20
+
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
 def set_winsize(fileno, row, col, xpix=0, ypix=0):
     winsize = struct.pack("HHHH", row, col, xpix, ypix)
     fcntl.ioctl(fileno, termios.TIOCSWINSZ, winsize)
 
 
+LIMITS = {
+    'cpu': resource.RLIMIT_CPU,
+    'as': resource.RLIMIT_AS,
+    'nofile': resource.RLIMIT_NOFILE,
+}
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def limits_preexec(limits):
+    """
+    Returns a function that applies `limits` to the current process, a
+    dict of 'cpu' seconds, 'as' bytes and 'nofile' count. Each value is
+    either a number, or a (soft, hard) tuple.
+    """
+    rlimits = []
+    for name, value in limits.items():
+        if name not in LIMITS:
+            raise ValueError("Unknown limit: %r" % (name,))
+        if not isinstance(value, (tuple, list)):
+            value = (value, value)
+        rlimits.append((LIMITS[name], tuple(value)))
+
+    def preexec():
+        for which, value in rlimits:
+            resource.setrlimit(which, value)
+    return preexec
+
+
+def cpu_seconds(pid):
+    """
+    CPU time used by a process, read from /proc
+    """
+    with open('/proc/%d/stat' % (pid,)) as handle:
+        stat = handle.read()
+    # Fields after the command name, which may itself contain spaces
+    fields = stat[stat.rindex(')') + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+
+
+def rss_bytes(pid):
+    """
+    Resident memory of a process, read from /proc
+    """
+    with open('/proc/%d/statm' % (pid,)) as handle:
+        return int(handle.read().split()[1]) * PAGE_SIZE
+
+
+def set_pipe_size(fileno, size):
+    """
+    Enlarge the kernel buffer of a pipe, as far as the system allows
+    """
+    try:
+        fcntl.fcntl(fileno, F_SETPIPE_SZ, size)
+    except (OSError, IOError) as ex:
+        LOG.debug("Cannot resize pipe %d to %d: %s", fileno, size, ex)
+
+
+class _FdSink(object):
+    """
+    Moves bytes from a file descriptor to another without turning them
+    into Python messages. Uses os.splice() through an intermediate pipe
+    where the kernel supports it, otherwise a plain os.read/os.write loop.
+
+    The sink holds its own duplicate of the target descriptor, so it never
+    writes into an unrelated file if the owner closes the original.
+    """
+    __slots__ = ('_fd', '_write_event', '_pipe', '_pending')
+
+    def __init__(self, fd):
+        self._fd = os.dup(fd)
+        self._write_event = get_hub().loop.io(self._fd, 2)
+        self._pipe = None
+        self._pending = 0
+        if hasattr(os, 'splice'):
+            self._pipe = os.pipe()
+
+    @property
+    def broken(self):
+        return self._fd is None
+
+    def _close_pipe(self):
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+
+    def close(self):
+        self._close_pipe()
+        if self._fd is not None:
+            cancel_wait(self._write_event)
+            os.close(self._fd)
+            self._fd = None
+
+    def _write(self, buf):
+        while len(buf):
+            try:
+                buf = buf[os.write(self._fd, buf):]
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+                wait(self._write_event)
+
+    def _drain(self):
+        while self._pending:
+            try:
+                self._pending -= os.splice(self._pipe[0], self._fd,
+                                           self._pending)
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+                wait(self._write_event)
+
+    def _splice(self, source):
+        try:
+            self._pending = os.splice(
+                source, self._pipe[1], SPLICE_CHUNK,
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except OSError as ex:
+            if ex.errno != errno.EINVAL:
+                raise
+            # Source or sink can't be spliced, fall back to copying
+            self._close_pipe()
+            return None
+        nbytes = self._pending
+        try:
+            self._drain()
+        except OSError:
+            self.close()
+        return nbytes
+
+    def _copy(self, source):
+        data = os.read(source, SPLICE_CHUNK)
+        try:
+            self._write(data)
+        except OSError:
+            self.close()
+        return len(data)
+
+    def pump(self, source):
+        """
+        Moves whatever is readable from `source` into the sink, returns
+        the number of bytes read or 0 at the end of file. If the sink can
+        no longer be written to it is closed and becomes `broken`.
+        """
+        try:
+            if self._pipe is not None:
+                nbytes = self._splice(source)
+                if nbytes is not None:
+                    return nbytes
+            return self._copy(source)
+        except OSError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return -1
+            if ex.errno == errno.EIO:
+                return 0
+            raise
+
+
 class Process(object):
-    # TODO: handle bot stdout and stderr
-    # TODO: refactor into TTY, Process and TTYProcess?
-    def __init__(self, args, env=None, executable=None, shell=False):
-        master, slave = pty.openpty()
+    """
+    Runs a command as a task. By default the command gets a PTY, with
+    stdout and stderr merged into `data` messages. With `tty=False` it
+    gets pipes instead, enlarged to `pipe_size` bytes where the kernel
+    allows, and stderr is sent separately as `error` messages.
+
+    Stopping sends SIGTERM, then SIGKILL after `kill_timeout` seconds.
+
+    `limits` sets resource limits on the child, see `limits_preexec`.
+    Output is pumped under `scheduler`, see `OutputScheduler`.
+    """
+    def __init__(self, args, env=None, executable=None, shell=False,
+                 tty=True, pipe_size=PIPE_SIZE, kill_timeout=5.0,
+                 limits=None, scheduler=DEFAULT_SCHEDULER):
+        self._setup(args, tty, kill_timeout, limits, scheduler)
+        preexec = limits_preexec(self._limits) if limits else None
+        if tty:
+            self._spawn_tty(args, env, executable, shell, preexec)
+        else:
+            self._spawn_pipes(args, env, executable, shell, preexec,
+                              pipe_size)
+        self._watch()
+
+    @classmethod
+    def adopt(cls, proc, master, args=None, kill_timeout=5.0,
+              scheduler=DEFAULT_SCHEDULER):
+        """
+        Runs a process started some other way, whose terminal is the PTY
+        `master`, which the Process then owns. `proc` needs the `pid`,
+        `returncode`, `wait()` and `rawlink()` of a gevent Popen, see
+        `ForkedChild`.
+        """
+        self = cls.__new__(cls)
+        self._setup(args if args is not None else [proc.pid], True,
+                    kill_timeout, None, scheduler)
         fcntl.fcntl(master, fcntl.F_SETFL, os.O_NONBLOCK)
+        self._proc = proc
+        self._stdin = self._stdout = master
+        self._stderr = None
+        self._watch()
+        return self
 
+    def _setup(self, args, tty, kill_timeout, limits, scheduler):
         self._finished = Event()
-        self._master = master
-        self._read_event = get_hub().loop.io(master, 1)
-        self._write_event = get_hub().loop.io(master, 2)
+        self._scheduler = scheduler
+        self._exited = False
+        self._released = False
+        self._paused = None
+        self._sink = None
+        self._read_events = ()
         self._args = args
+        self._tty = tty
+        self._kill_timeout = kill_timeout
+        self._limits = limits or dict()
+
+    def _watch(self):
+        self._write_event = get_hub().loop.io(self._stdin, 2)
+        ChildReaper.watch(self._proc, self._on_exit)
+
+    def _spawn_tty(self, args, env, executable, shell, preexec):
+        master, slave = pty.openpty()
+        fcntl.fcntl(master, fcntl.F_SETFL, os.O_NONBLOCK)
+        try:
+            self._proc = Popen(
+                args, env=env, executable=executable, shell=shell,
+                stdin=slave, stdout=slave, stderr=slave, bufsize=0,
+                universal_newlines=False, close_fds=True,
+                preexec_fn=preexec)
+        except Exception:
+            os.close(master)
+            raise
+        finally:
+            # Only the child holds the slave, so reads hit EOF when it exits
+            os.close(slave)
+        self._stdin = self._stdout = master
+        self._stderr = None
+
+    def _spawn_pipes(self, args, env, executable, shell, preexec,
+                     pipe_size):
         self._proc = Popen(
             args, env=env, executable=executable, shell=shell,
-            stdin=slave, stdout=slave, stderr=slave, bufsize=0,
-            universal_newlines=False, close_fds=True)
+            stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=0,
+            universal_newlines=False, close_fds=True, preexec_fn=preexec)
+        self._stdin = self._proc.stdin.fileno()
+        self._stdout = self._proc.stdout.fileno()
+        self._stderr = self._proc.stderr.fileno()
+        for fd in (self._stdin, self._stdout, self._stderr):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+            if pipe_size:
+                set_pipe_size(fd, pipe_size)
 
     def __repr__(self):
         return "Process:%x %r" % (id(self), self._args)
@@ -48,64 +300,245 @@ class Process(object):
     def finished(self):
         return self._finished.ready()
 
-    def _waitclosed(self):
-        self._proc.wait()
-        self.stop()
+    @property
+    def released(self):
+        """
+        True once another process adopted the child, see `release()`
+        """
+        return self._released
+
+    @property
+    def pid(self):
+        return self._proc.pid
+
+    @property
+    def returncode(self):
+        return self._proc.returncode
+
+    def wait(self, timeout=None):
+        """
+        Waits for the process to exit, returns its exit code
+        """
+        return self._proc.wait(timeout)
+
+    def usage(self):
+        """
+        (CPU seconds, resident bytes) of the running child, or None
+        """
+        if self._proc.returncode is not None:
+            return None
+        try:
+            return cpu_seconds(self._proc.pid), rss_bytes(self._proc.pid)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def over_limit(self):
+        """
+        True when the child has used up its CPU limit but is still running,
+        for example because it ignores SIGXCPU.
+        """
+        cpu = self._limits.get('cpu')
+        if cpu is None or self._proc.returncode is not None:
+            return False
+        if isinstance(cpu, (tuple, list)):
+            cpu = cpu[0]
+        try:
+            return cpu_seconds(self._proc.pid) >= cpu
+        except (IOError, OSError, ValueError):
+            return False
+
+    def fileno(self):
+        """
+        File descriptor written to by the process input
+        """
+        return self._stdin
+
+    def attach_sink(self, fd):
+        """
+        Send output straight to the file descriptor `fd` while nothing
+        other than the sink's own link is watching the output channel.
+        """
+        self.detach_sink()
+        self._sink = _FdSink(fd)
+
+    def detach_sink(self):
+        sink = self._sink
+        if sink is not None:
+            self._sink = None
+            sink.close()
+
+    def _on_exit(self, returncode):
+        # Wake the readers, which drain what the process left behind
+        self._exited = True
+        for read_event in self._read_events:
+            cancel_wait(read_event)
+
+    def _read(self, fd):
+        """
+        Non-blocking read, returns None when nothing is available and an
+        empty string at the end of file.
+        """
+        try:
+            return os.read(fd, READ_SIZE)
+        except OSError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            if ex.errno == errno.EIO:
+                return b''
+            raise
 
     def _writer(self, inch):
         """
-        This greenlet will block until messages are ready to be written to pty
+        This greenlet will block until messages are ready to be written
+        to the process input
         """
         try:
-            sock = self._master
+            fd = self._stdin
             for msg in inch.watch():
-                if 'resize' in msg:
-                    set_winsize(sock, msg['resize']['width'], msg['resize']['height'])
-                if 'data' in msg:
-                    buf = msg['data']
+                if msg.kind == RESIZE and self._tty:
+                    set_winsize(fd, msg.payload['height'], msg.payload['width'])
+                elif msg.kind == DATA:
+                    buf = msg.payload
+                    if not isinstance(buf, bytes):
+                        buf = buf.encode('utf-8')
                     while not self.finished and len(buf):
                         try:
                             wait(self._write_event)
                         except Exception:
                             break
-                        nwritten = os.write(sock, msg['data'])
+                        nwritten = os.write(fd, buf)
                         buf = buf[nwritten:]
+            if not self._tty and not self.finished:
+                # Input channel closed, the command sees end of file
+                self._proc.stdin.close()
         except Exception:
             LOG.exception("In Process._writer")
 
+    def _reader(self, fd, read_event, output, kind, quota, sink=False):
+        """
+        Sends everything read from `fd` to the output channel as `kind`
+        messages, or into the attached sink when `sink` is allowed.
+        """
+        while not self.finished and not self._exited:
+            # Whoever reads the output can hold it, see Channel.hold
+            output.ready()
+            try:
+                wait(read_event)
+            except Exception:
+                break
+            paused = self._paused
+            if paused is not None:
+                paused.wait()
+                continue
+            if sink and self._sink is not None and output.watchers < 2:
+                nbytes = self._sink.pump(fd)
+                if not nbytes:
+                    return
+                if self._sink.broken:
+                    self.detach_sink()
+                if nbytes > 0:
+                    output.touch(nbytes)
+                quota.charge(max(nbytes, 0))
+                continue
+            data = self._read(fd)
+            if data is None:
+                continue
+            if len(data) == 0:
+                return
+            output.send(TRACER.message(kind, data))
+            quota.charge(len(data))
+        # Output written just before the process exited
+        paused = self._paused
+        if paused is not None:
+            paused.wait()
+        while not self.finished:
+            data = self._read(fd)
+            if not data:
+                break
+            output.send(TRACER.message(kind, data))
+
     def run(self, task):
-        writer_task = gevent.spawn(self._writer, task.input)
-        gevent.spawn(self._waitclosed)
-        proc = self._proc
+        loop = get_hub().loop
+        stdout_event = loop.io(self._stdout, 1)
+        read_events = [stdout_event]
+        # Both streams of the process share one quota of output
+        quota = self._scheduler.quota(task.input)
+        greenlets = [gevent.spawn(self._writer, task.input)]
+        if self._stderr is not None:
+            stderr_event = loop.io(self._stderr, 1)
+            read_events.append(stderr_event)
+            greenlets.append(gevent.spawn(
+                self._reader, self._stderr, stderr_event, task.output, ERROR,
+                quota))
+        self._read_events = read_events
+        if self._proc.returncode is not None:
+            self._on_exit(self._proc.returncode)
         try:
-            sock = self._master
-            while not self.finished:
-                try:
-                    wait(self._read_event)
-                except Exception:
-                    break
-                data = os.read(sock, 1024)
-                if len(data) == 0 or data is StopIteration:
-                    break                
-                if sock == proc.stderr:
-                    task.output.send(dict(error=data))
-                else:
-                    task.output.send(dict(data=data))
+            self._reader(self._stdout, stdout_event, task.output, DATA,
+                         quota, sink=True)
+            if len(greenlets) > 1:
+                greenlets[1].join()
         except Exception:
             LOG.exception("While reading from process")
         finally:
-            writer_task.kill()
+            gevent.killall(greenlets)
+            self.detach_sink()
             self.stop()
 
-    def stop(self):
-        if not self.finished:
-            cancel_wait(self._read_event)
-            cancel_wait(self._write_event)
+    def _close(self):
+        if self._tty:
+            fds = (self._stdin,)
+        else:
+            fds = (self._proc.stdin, self._proc.stdout, self._proc.stderr)
+        for fd in fds:
             try:
-                os.close(self._master)
+                if isinstance(fd, int):
+                    os.close(fd)
+                else:
+                    fd.close()
             except Exception:
                 pass
-            if not self._proc.poll():
-                self._proc.terminate()
-                self._proc.wait()
+
+    def stop(self):
+        if not self.finished:
+            for read_event in self._read_events:
+                cancel_wait(read_event)
+            cancel_wait(self._write_event)
+            self._close()
+            if not self._released:
+                ChildReaper.terminate(self._proc, self._kill_timeout)
             self._finished.set()
+
+    def handoff(self):
+        """
+        What another process needs to adopt the running child, see
+        `kitsh.core.handoff`: its PTY master and a dict of its pid, args
+        and kill timeout. None unless the child runs on a PTY.
+        """
+        if not self._tty or self.finished or \
+                self._proc.returncode is not None:
+            return None
+        return self._stdin, dict(pid=self._proc.pid, args=self._args,
+                                 kill_timeout=self._kill_timeout)
+
+    def pause(self):
+        """
+        Stops reading the child's output until `resume()`, such as while
+        it is handed to another process
+        """
+        if self._paused is None:
+            self._paused = Event()
+
+    def resume(self):
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.set()
+
+    def release(self):
+        """
+        Stops without terminating the child, once another process has
+        adopted it
+        """
+        self._released = True
+        self.stop()
+        self.resume()
@@ -0,0 +1,80 @@
+import os
+import signal
+import logging
+
+from gevent.hub import get_hub
+
+__all__ = ('ChildReaper',)
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ChildReaper(object):
+    """
+    Process-wide registry of child processes and their exit callbacks.
+
+    Exits are collected by the single SIGCHLD handler in the gevent hub
+    and dispatched to the callback registered for each child, so nothing
+    has to park a greenlet in wait(). Termination escalates from SIGTERM
+    to SIGKILL on a hub timer instead of blocking the caller.
+    """
+    _children = dict()
+    _timers = dict()
+
+    @classmethod
+    def count(cls):
+        return len(cls._children)
+
+    @classmethod
+    def watch(cls, proc, callback):
+        """
+        Calls `callback(returncode)` from the hub once the gevent Popen
+        `proc` has exited.
+        """
+        cls._children[proc.pid] = callback
+        proc.rawlink(cls._exited)
+
+    @classmethod
+    def _exited(cls, proc):
+        timer = cls._timers.pop(proc.pid, None)
+        if timer is not None:
+            timer.stop()
+        callback = cls._children.pop(proc.pid, None)
+        if callback is not None:
+            try:
+                callback(proc.returncode)
+            except Exception:
+                LOG.exception("In exit callback for %d", proc.pid)
+
+    @classmethod
+    def terminate(cls, proc, timeout=5.0):
+        """
+        Sends SIGTERM to `proc`, followed by SIGKILL if it is still
+        running after `timeout` seconds. Returns immediately.
+        """
+        if proc.returncode is not None or proc.pid in cls._timers:
+            return
+        cls._signal(proc, signal.SIGTERM)
+        if timeout is None:
+            return
+        timer = get_hub().loop.timer(timeout)
+        cls._timers[proc.pid] = timer
+        timer.start(cls._kill, proc)
+
+    @classmethod
+    def _kill(cls, proc):
+        timer = cls._timers.pop(proc.pid, None)
+        if timer is not None:
+            timer.stop()
+        if proc.returncode is None:
+            LOG.warning("Killing %d, still running after SIGTERM", proc.pid)
+            cls._signal(proc, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(proc, signum):
+        try:
+            os.kill(proc.pid, signum)
+        except OSError:
+            # Already exited, but not yet reaped
+            pass
@@ -0,0 +1,94 @@
+import time
+import logging
+
+import gevent
+from gevent.hub import get_hub
+
+__all__ = ('OutputScheduler', 'Quota')
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Quota(object):
+    """
+    Output accounting for one session, see `OutputScheduler.quota`.
+    """
+    __slots__ = ('_sched', '_activity', '_seen', '_used', '_turn',
+                 '_last_input', '_since_input', 'yields')
+
+    def __init__(self, sched, activity):
+        self._sched = sched
+        self._activity = activity
+        self._seen = activity.last_active if activity is not None else None
+        self._used = 0
+        self._turn = time.time()
+        self._last_input = None
+        self._since_input = 0
+        self.yields = 0
+
+    @property
+    def interactive(self):
+        """
+        True while the session is answering recent, small input, such as
+        echoing keystrokes, rather than streaming output on its own.
+        """
+        sched = self._sched
+        if self._last_input is None:
+            return False
+        recent = get_hub().loop.now() - self._last_input
+        return recent <= sched.window and self._since_input < sched.quantum
+
+    def charge(self, nbytes):
+        """
+        Accounts for `nbytes` of output, yielding to other sessions once
+        this session's quantum of bytes or time is used up.
+        """
+        activity = self._activity
+        if activity is not None and activity.last_active != self._seen:
+            self._seen = self._last_input = activity.last_active
+            self._since_input = 0
+        self._since_input += nbytes
+        self._used += nbytes
+        sched = self._sched
+        if self._used >= sched.quantum or \
+                time.time() - self._turn >= sched.timeslice:
+            self.yields += 1
+            sched.yield_turn(self.interactive)
+            self._used = 0
+            self._turn = time.time()
+
+
+class OutputScheduler(object):
+    """
+    Shares the event loop between sessions pumping output, so a session
+    flooding output can't starve the keystroke echo of others.
+
+    Every session may pump `quantum` bytes, or for `timeslice` seconds,
+    before yielding. Interactive sessions, those with input in the last
+    `window` seconds and little output since, go to the back of the run
+    queue. Others wait until the loop has no other pending events.
+    """
+    __slots__ = ('quantum', 'timeslice', 'window')
+
+    def __init__(self, quantum=65536, timeslice=0.005, window=1.0):
+        self.quantum = quantum
+        self.timeslice = timeslice
+        self.window = window
+
+    def quota(self, activity=None):
+        """
+        New accounting for a session, `activity` is the channel whose
+        messages count as its input.
+        """
+        return Quota(self, activity)
+
+    @staticmethod
+    def yield_turn(interactive):
+        if interactive:
+            gevent.sleep(0)
+        else:
+            gevent.idle()
+
+
+DEFAULT_SCHEDULER = OutputScheduler()
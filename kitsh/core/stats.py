@@ -0,0 +1,213 @@
+import time
+import logging
+
+from .task import TaskManager, STOPPED, ERROR
+
+__all__ = ('TaskStats',)
+
+
+LOG = logging.getLogger(__name__)
+
+
+class _Sample(object):
+    """
+    Last measurements of one task, used to work out rates between
+    refreshes and whether its row has changed.
+    """
+    __slots__ = ('task', 'row', 'when', 'bytes_in', 'bytes_out', 'cpu',
+                 'runtime', '_dirty', '_armed')
+
+    def __init__(self, task, dirty):
+        self.task = task
+        self.row = None
+        self.when = None
+        self.bytes_in = self.bytes_out = 0
+        self.cpu = None
+        self.runtime = 0.0
+        self._dirty = dirty
+        self._armed = []
+
+    @property
+    def settled(self):
+        """
+        True when the row can't change again until something happens to
+        the task, which wakes the sample or is announced as an event.
+        """
+        row = self.row
+        return row is not None and not (
+            row['in_rate'] or row['out_rate'] or row['busy'] or
+            row['in_queue'] or row['out_queue'])
+
+    def wake(self, chan):
+        if chan in self._armed:
+            self._armed.remove(chan)
+        self._dirty.add(id(self.task))
+
+    def arm(self):
+        """
+        Marks the sample dirty on the next activity of the task's
+        channels. Returns False while the task lacks a channel, which is
+        only created when first used.
+        """
+        armed = True
+        for chan in (self.task._input, self.task._output):
+            if chan is None:
+                armed = False
+            elif chan not in self._armed:
+                self._armed.append(chan)
+                chan.onactive(self.wake)
+        return armed
+
+    def disarm(self):
+        for chan in self._armed:
+            chan.remove_onactive(self.wake)
+        self._armed = []
+
+    def update(self, now, with_proc):
+        task = self.task
+        chan_in, chan_out = task._input, task._output
+        elapsed = (now - self.when) if self.when else 0
+        bytes_in = chan_in.nbytes if chan_in is not None else 0
+        bytes_out = chan_out.nbytes if chan_out is not None else 0
+        runtime = task.runtime
+        row = dict(
+            id=id(task),
+            task=repr(task.obj)[:60],
+            state=task.state,
+            created=task.created,
+            in_queue=len(chan_in) if chan_in is not None else 0,
+            out_queue=len(chan_out) if chan_out is not None else 0,
+            in_rate=0,
+            out_rate=0,
+            busy=0,
+            runtime=round(runtime, 3),
+            pid=None,
+            cpu=None,
+            rss=None)
+        if elapsed > 0:
+            row['in_rate'] = int((bytes_in - self.bytes_in) / elapsed)
+            row['out_rate'] = int((bytes_out - self.bytes_out) / elapsed)
+            row['busy'] = round((runtime - self.runtime) / elapsed * 100, 1)
+        pid = getattr(task.obj, 'pid', None)
+        if pid is not None:
+            row['pid'] = pid
+            old = self.row or dict()
+            usage = task.obj.usage() if with_proc else None
+            if usage is None:
+                row['cpu'] = old.get('cpu')
+                row['rss'] = old.get('rss')
+            else:
+                cpu, row['rss'] = usage
+                if self.cpu is not None and elapsed > 0:
+                    row['cpu'] = round((cpu - self.cpu) / elapsed * 100, 1)
+                self.cpu = cpu
+        self.when = now
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.runtime = runtime
+        changed = row != self.row
+        self.row = row
+        return changed
+
+
+class TaskStats(object):
+    """
+    Live statistics of every task for a "top" style view: state, age,
+    bytes in and out per second, queue depths, greenlet run time and the
+    CPU and memory of child processes, read from /proc.
+
+    `refresh()` only returns the rows which changed since it was last
+    called, and the ids of the tasks which have gone. Only tasks which
+    had channel activity or changed state, see `TaskManager.watch`, are
+    measured again, and the processes every `proc_every` refreshes.
+    Call `close()` when done.
+    """
+    __slots__ = ('_samples', '_ticks', '_proc_every', '_events', '_dirty',
+                 '_unarmed', '_procs')
+
+    def __init__(self, proc_every=5):
+        self._samples = dict()
+        self._ticks = 0
+        self._proc_every = proc_every
+        self._events = None
+        self._dirty = set()
+        self._unarmed = set()
+        self._procs = set()
+
+    def rows(self):
+        """
+        Every row as of the last refresh
+        """
+        return [sample.row for sample in self._samples.values()
+                if sample.row is not None]
+
+    def _add(self, task):
+        ident = id(task)
+        if ident not in self._samples:
+            self._samples[ident] = _Sample(task, self._dirty)
+            self._dirty.add(ident)
+
+    def _remove(self, ident, removed):
+        sample = self._samples.pop(ident, None)
+        if sample is not None:
+            sample.disarm()
+            self._dirty.discard(ident)
+            self._unarmed.discard(ident)
+            self._procs.discard(ident)
+            if sample.row is not None:
+                removed.append(ident)
+
+    def _handle(self, event, removed):
+        ident = id(event.task)
+        if event.kind in (STOPPED, ERROR):
+            self._remove(ident, removed)
+        elif ident in self._samples:
+            self._dirty.add(ident)
+        else:
+            self._add(event.task)
+
+    def refresh(self):
+        removed = []
+        if self._events is None:
+            # Nothing can happen in between, see TaskManager.snapshot
+            self._events = TaskManager.watch()
+            for event in TaskManager.snapshot():
+                self._add(event.task)
+        while len(self._events):
+            self._handle(self._events.recv(), removed)
+        now = time.time()
+        with_proc = self._ticks % self._proc_every == 0
+        self._ticks += 1
+        for ident in list(self._unarmed):
+            # Channels created since the last refresh may have been used
+            if self._samples[ident].arm():
+                self._unarmed.discard(ident)
+                self._dirty.add(ident)
+        # Samples hold on to the dirty set, so it is emptied not replaced
+        idents = set(self._dirty)
+        self._dirty.clear()
+        if with_proc:
+            idents.update(self._procs)
+        changed = []
+        for ident in idents:
+            sample = self._samples.get(ident)
+            if sample is None:
+                continue
+            if sample.update(now, with_proc):
+                changed.append(sample.row)
+            if sample.row['pid'] is not None:
+                self._procs.add(ident)
+            if not sample.settled:
+                # Went quiet, report the rates dropping to zero next time
+                self._dirty.add(ident)
+            if not sample.arm():
+                self._unarmed.add(ident)
+        return dict(time=now, rows=changed, removed=removed)
+
+    def close(self):
+        if self._events is not None:
+            self._events.close()
+            self._events = None
+        for sample in self._samples.values():
+            sample.disarm()
+        self._samples.clear()
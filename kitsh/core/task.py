@@ -1,18 +1,45 @@
 # -*- coding: utf-8 -*-
-__all__ = ('Task', 'TaskManager')
+__all__ = ('Task', 'TaskManager', 'TaskPipeline', 'TaskEvent')
 
 import sys
+import time
 import logging
+from collections import namedtuple
 
 import gevent
+from gevent.hub import get_hub
 from gevent.event import Event
 from gevent.greenlet import Greenlet
 
-from .inout import Channel
+from .inout import Channel, Publisher, TracedMessage, SET
+from .executor import GREENLET
 
 
 LOG = logging.getLogger(__name__)
 
+clock = getattr(time, 'perf_counter', time.time)
+
+
+SPAWNED = 'spawned'
+RUNNING = 'running'
+STOPPED = 'stopped'
+ERROR = 'error'
+
+
+class TaskEvent(namedtuple('TaskEvent', ('kind', 'task', 'time'))):
+    """
+    Announces a change in the lifecycle of a task, one of SPAWNED, RUNNING,
+    STOPPED or ERROR, at event loop `time`. See `TaskManager.watch`.
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        task = self.task
+        return dict(event=self.kind, id=id(task), task=repr(task.obj),
+                    state=task.state, created=task.created, time=self.time,
+                    elapsed=round(self.time - task.created, 6),
+                    runtime=round(task.runtime, 6))
+
 
 def make_callable(what, names):
     if callable(what):
@@ -32,14 +59,21 @@ class _GreenletStdio(Greenlet):
     Based on eventlet.backdoor, Copyright (c) 2005-2006, Bob Ippolito
 
     https://raw.githubusercontent.com/gevent/gevent/master/LICENSE (MIT atow)
+
+    Also accounts the time spent running in the greenlet, as `runtime`.
     """
     _fileobj = None
     saved = None
+    runtime = 0.0
 
     def switch(self, *args, **kw):
         if self._fileobj is not None:
             self.switch_in()
-        Greenlet.switch(self, *args, **kw)
+        started = clock()
+        try:
+            Greenlet.switch(self, *args, **kw)
+        finally:
+            self.runtime += clock() - started
 
     def switch_in(self, fileobj=None):
         self.saved = sys.stdin, sys.stderr, sys.stdout
@@ -66,13 +100,113 @@ class _GreenletStdio(Greenlet):
             self.switch_out()
 
 
-class _TaskIOBridge(object):
-    def __init__(self, intask, outtask):
-        self._intask = intask
-        self._outtask = outtask
-        self._in2out = gevent.spawn(self._forward_in2out)
-        self._out2in = gevent.spawn(self._forward_out2in)
-        self._closed = Event()
+class _ChannelLink(object):
+    """
+    Forwards every message published on one channel straight into another
+    channel. The publisher calls the link synchronously, so there is no
+    Subscriber queue or greenlet between the two channels.
+
+    When the source task can write its output directly to a file
+    descriptor of the destination task, such as two Process PTYs, the
+    link asks it to do so and messages are only used while other
+    watchers are attached to the source channel.
+
+    With `propagate` the end of the source channel also ends the
+    destination channel, so the next task in a pipe sees end of file.
+    The link closes when the destination channel ends, so the source
+    stops writing into a task which has gone.
+    """
+    __slots__ = ('_src', '_dst', '_pipeline', '_sinkobj', '_propagate')
+
+    def __init__(self, src, dst, pipeline, propagate=False):
+        self._src = src.output
+        self._dst = dst.input
+        self._pipeline = pipeline
+        self._sinkobj = None
+        self._propagate = propagate
+        if self._src.closed:
+            if propagate:
+                self._dst.close()
+            self.close()
+        elif self._dst.ended:
+            self.close()
+        else:
+            self._dst.onend(self._dst_ended)
+            self._src.attach(self)
+            # Attaching delivers what is queued, which may end the link
+            if not self.closed:
+                self._attach_sink(src._obj, dst._obj)
+
+    def _attach_sink(self, srcobj, dstobj):
+        attach_sink = getattr(srcobj, 'attach_sink', None)
+        fileno = getattr(dstobj, 'fileno', None)
+        if attach_sink is None or fileno is None:
+            return
+        try:
+            attach_sink(fileno())
+        except (OSError, IOError):
+            LOG.exception("Cannot attach sink %r -> %r", srcobj, dstobj)
+        else:
+            self._sinkobj = srcobj
+
+    def __call__(self, msg):
+        if msg is StopIteration:
+            if self._propagate:
+                self._dst.close()
+            self.close()
+        elif self._dst.ended:
+            self.close()
+        else:
+            if type(msg) is TracedMessage:
+                msg.stamp('forward')
+            self._dst.send(msg)
+
+    def _dst_ended(self, dst):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._src is None
+
+    def close(self):
+        src = self._src
+        if src is not None:
+            self._src = None
+            self._dst.remove_onend(self._dst_ended)
+            src.detach(self)
+            if self._sinkobj is not None:
+                self._sinkobj.detach_sink()
+                self._sinkobj = None
+            self._pipeline._link_closed(self)
+
+
+class TaskPipeline(object):
+    """
+    Connects the output of each task directly to the input of the next,
+    and with `bidirectional` the output of each task back to the previous.
+
+    A one way pipeline passes the end of each task's output on to the
+    input of the next task, and is closed once every link has seen the
+    end of its source. A bidirectional pipeline, such as a bridge between
+    a websocket and a shell, is closed as soon as either side ends.
+    Either is closed by `close()`.
+    """
+    __slots__ = ('_tasks', '_links', '_open', '_bidirectional', '_closed',
+                 '_closed_event')
+
+    def __init__(self, tasks, bidirectional=False):
+        self._tasks = tasks
+        self._bidirectional = bidirectional
+        self._closed = False
+        self._closed_event = None
+        self._links = []
+        assert len(tasks) > 1
+        self._open = (len(tasks) - 1) * (2 if bidirectional else 1)
+        for src, dst in zip(tasks, tasks[1:]):
+            self._links.append(_ChannelLink(src, dst, self,
+                                            propagate=not bidirectional))
+            if bidirectional:
+                self._links.append(_ChannelLink(dst, src, self))
 
     def __enter__(self):
         return self
@@ -83,44 +217,75 @@ class _TaskIOBridge(object):
     def __del__(self):
         self.close()
 
-    def _forward_in2out(self):
-        try:
-            for msg in self._intask.output.watch():
-                #LOG.info("Forwarding %r->%r - %r", self._intask, self._outtask, msg)
-                self._outtask.input.send(msg)
-        finally:
-            self._closed.set()
+    def __repr__(self):
+        return "%s%r" % (self.__class__.__name__, self._tasks)
 
-    def _forward_out2in(self):
-        try:
-            for msg in self._outtask.output.watch():
-                #LOG.info("Forwarding %r<-%r - %r", self._intask, self._outtask, msg)
-                self._intask.input.send(msg)
-        finally:
-            self._closed.set()
+    def _link_closed(self, link):
+        self._open -= 1
+        if self._closed or (self._open > 0 and not self._bidirectional):
+            return
+        self._closed = True
+        if self._closed_event is not None:
+            self._closed_event.set()
 
     @property
     def closed(self):
-        return self._closed.ready()
+        return self._closed
 
-    def wait(self):
-        self._closed.wait()
+    def wait(self, timeout=None):
+        if not self._closed:
+            if self._closed_event is None:
+                self._closed_event = Event()
+            self._closed_event.wait(timeout=timeout)
 
     def close(self):
-        if not self.closed:
-            self._in2out.kill()
-            self._out2in.kill()
+        for link in self._links:
+            link.close()
 
 
 class Task(object):
-    def __init__(self, run):
+    __slots__ = ('_input', '_output', '_started', '_created', '_obj',
+                 '_greenlet', 'idle_timeout', 'executor', 'session',
+                 '__weakref__')
+
+    def __init__(self, run, idle_timeout=None, executor=None, session=None):
         assert run is not None
-        self.input = Channel()
-        self.output = Channel()
-        self.started = Event()
+        self._input = None
+        self._output = None
+        self._started = None
+        self._created = get_hub().loop.now()
+        if idle_timeout is None:
+            idle_timeout = getattr(run, 'idle_timeout', None)
+        self.idle_timeout = idle_timeout
+        # Where run() executes, see kitsh.core.executor
+        if executor is None:
+            executor = getattr(run, 'executor', None) or GREENLET
+        self.executor = executor
         self._obj = run
         self._greenlet = None
+        # Names a terminal session, which a client can rejoin by it even
+        # after a handoff, see kitsh.core.handoff
+        self.session = session
         TaskManager.register(self)
+        TaskManager.announce(self, SPAWNED)
+
+    @property
+    def input(self):
+        if self._input is None:
+            self._input = Channel()
+        return self._input
+
+    @property
+    def output(self):
+        if self._output is None:
+            self._output = Channel()
+        return self._output
+
+    @property
+    def started(self):
+        if self._started is None:
+            self._started = Event()
+        return self._started
 
     def __repr__(self):
         return "%s:%x %r" % (self.__class__.__name__, id(self), self._obj)
@@ -159,17 +324,24 @@ class Task(object):
             self._greenlet.switch_in((self.input, self.output, self.output))
 
         LOG.info("RUNNING %r", self)
-        self.started.set()
+        if self._started is None:
+            self._started = SET
+        else:
+            self._started.set()
+        TaskManager.announce(self, RUNNING)
+        outcome = STOPPED
         try:
-            method(self)
+            self.executor.execute(method, self)
             LOG.info("STOPPED %r", self)
         except Exception as ex:
             LOG.exception("ERROR %r", self)
+            outcome = ERROR
             raise ex
         finally:
             self.input.close()
             self.output.close()
             TaskManager.unregister(self)
+            TaskManager.announce(self, outcome)
 
     def bridge(self, othertask):
         """
@@ -177,7 +349,51 @@ class Task(object):
         And the output of the other task to the input of this task
         """
         assert isinstance(othertask, Task)
-        return _TaskIOBridge(self, othertask)
+        return TaskPipeline((self, othertask), bidirectional=True)
+
+    @property
+    def created(self):
+        """
+        Event loop time at which the task was created
+        """
+        return self._created
+
+    @property
+    def runtime(self):
+        """
+        Seconds spent running in the task's own greenlet
+        """
+        if self._greenlet is None:
+            return 0.0
+        return self._greenlet.runtime
+
+    @property
+    def obj(self):
+        return self._obj
+
+    @property
+    def idle(self):
+        """
+        Seconds since a message was last sent to the input or output
+        """
+        last = self._created
+        for chan in (self._input, self._output):
+            if chan is not None and chan.last_active > last:
+                last = chan.last_active
+        return get_hub().loop.now() - last
+
+    def expired(self, idle_timeout=None):
+        """
+        True when the task has been idle for longer than its idle timeout,
+        or `idle_timeout` if it has none, or is over its resource limits.
+        The idle timeout of a task defaults to that of the object it runs.
+        """
+        if self.idle_timeout is not None:
+            idle_timeout = self.idle_timeout
+        if idle_timeout is not None and self.idle > idle_timeout:
+            return True
+        over_limit = getattr(self._obj, 'over_limit', None)
+        return bool(over_limit and over_limit())
 
     @property
     def error(self):
@@ -203,11 +419,15 @@ class Task(object):
             # Normally, upon I/O disconnect, the process will die gracefully
             self.input.close()
             self.output.close()
+            self.executor.stop(self)
         return self
 
 
 class TaskManager(object):
     _tasks = dict()
+    _sessions = dict()
+    _reaper = None
+    _events = Publisher()
 
     @classmethod
     def count(cls):
@@ -218,27 +438,78 @@ class TaskManager(object):
         return cls._tasks
 
     @classmethod
-    def spawn(cls, obj):
-        task = Task(obj)
+    def spawn(cls, obj, idle_timeout=None, executor=None, session=None):
+        task = Task(obj, idle_timeout=idle_timeout, executor=executor,
+                    session=session)
         task.start()
         return task
 
+    @classmethod
+    def pipe(cls, *tasks, **kwargs):
+        """
+        Connects the output of each task to the input of the next one,
+        pass `bidirectional=True` to also send output back up the pipe.
+        """
+        bidirectional = kwargs.pop('bidirectional', False)
+        if kwargs:
+            raise TypeError("Unexpected arguments: %r" % (kwargs.keys(),))
+        for task in tasks:
+            assert isinstance(task, Task)
+        return TaskPipeline(tasks, bidirectional=bidirectional)
+
     @classmethod
     def register(cls, task):
         assert isinstance(task, Task)
         if id(task) not in cls._tasks:
             cls._tasks[id(task)] = task
+        if task.session is not None:
+            cls._sessions[task.session] = task
 
     @classmethod
     def unregister(cls, task):
         assert isinstance(task, Task)
         if id(task) in cls._tasks:
             del cls._tasks[id(task)]
+        # Unless another task took the session over
+        if task.session is not None and \
+                cls._sessions.get(task.session) is task:
+            del cls._sessions[task.session]
+
+    @classmethod
+    def announce(cls, task, kind):
+        if cls._events:
+            cls._events.send(TaskEvent(kind, task, get_hub().loop.now()))
+
+    @classmethod
+    def watch(cls):
+        """
+        Subscribes to the TaskEvent of every task spawned, started or
+        finished from now on. Use `snapshot` for the tasks already there.
+        """
+        return cls._events.subscribe()
+
+    @classmethod
+    def snapshot(cls):
+        """
+        A TaskEvent for the current state of every task, taken together
+        with `watch` this never misses or repeats a change.
+        """
+        now = get_hub().loop.now()
+        return [TaskEvent(SPAWNED if task.state == 'NEW' else RUNNING,
+                          task, now)
+                for task in list(cls._tasks.values())]
 
     @classmethod
     def get(cls, name):
         return cls._tasks.get(name, None)
 
+    @classmethod
+    def session(cls, session):
+        """
+        The task of the terminal session named `session`, or None
+        """
+        return cls._sessions.get(session)
+
     @classmethod
     def list(cls):
         return cls._tasks.keys()
@@ -251,5 +522,48 @@ class TaskManager(object):
 
     @classmethod
     def stopall(cls):
-        for task in cls._tasks.itervalues():
+        for task in list(cls._tasks.values()):
             task.stop()
+
+    @classmethod
+    def reap(cls, idle_timeout=None, batch=100):
+        """
+        Stops running tasks which have expired, see `Task.expired`,
+        yielding to other greenlets after every `batch` tasks.
+        Returns the number of tasks stopped.
+        """
+        expired = [task for task in list(cls._tasks.values())
+                   if task.state == 'RUNNING' and task.expired(idle_timeout)]
+        for num, task in enumerate(expired, 1):
+            LOG.info("Reaping %r, idle %.1fs", task, task.idle)
+            try:
+                task.stop()
+            except Exception:
+                LOG.exception("While reaping %r", task)
+            if num % batch == 0:
+                gevent.sleep(0)
+        return len(expired)
+
+    @classmethod
+    def _reaploop(cls, interval, idle_timeout, batch):
+        while cls._reaper is gevent.getcurrent():
+            gevent.sleep(interval)
+            cls.reap(idle_timeout, batch)
+
+    @classmethod
+    def start_reaper(cls, interval=10.0, idle_timeout=None, batch=100):
+        """
+        Periodically stops expired tasks in the background, `idle_timeout`
+        applies to tasks which don't have their own.
+        """
+        cls.stop_reaper()
+        cls._reaper = gevent.spawn(cls._reaploop, interval, idle_timeout,
+                                   batch)
+
+    @classmethod
+    def stop_reaper(cls):
+        reaper = cls._reaper
+        cls._reaper = None
+        # When a reaped task stops the reaper, its loop ends by itself
+        if reaper is not None and reaper is not gevent.getcurrent():
+            reaper.kill()
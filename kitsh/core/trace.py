@@ -0,0 +1,150 @@
+"""
+Optional latency tracing of output on its way from a process to the
+client. A sampled message is stamped as it passes each stage:
+
+  read      read from the process
+  send      sent to a channel, the task's output and the client's input
+  forward   passed on by a pipe or bridge link
+  recv      received by a watcher, such as the websocket's send loop
+  encode    encoded for the client
+  sent      written to the client's socket
+
+and the time between stages is collected in one histogram each, such as
+'send->forward', with 'total' from read to sent. Only one in `1 / rate`
+messages is traced, the rest cost a type check per stage, so tracing can
+be left on.
+"""
+import logging
+
+from .inout import Message, TracedMessage, clock
+
+__all__ = ('Tracer', 'Histogram', 'TRACER')
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """
+    Counts of durations in power of two buckets of microseconds, bucket
+    `n` holding durations below 2**n microseconds.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    NBUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.NBUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micros = int(seconds * 1000000)
+        bucket = micros.bit_length() if micros > 0 else 0
+        self.buckets[min(bucket, self.NBUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Upper bound in seconds of the durations below `fraction`
+        """
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min((1 << bucket) / 1000000.0, self.max)
+        return self.max
+
+    def to_dict(self):
+        def millis(seconds):
+            return round(seconds * 1000, 3) if seconds is not None else None
+        return dict(
+            count=self.count,
+            mean_ms=millis(self.total / self.count if self.count else None),
+            p50_ms=millis(self.percentile(0.5)),
+            p99_ms=millis(self.percentile(0.99)),
+            p999_ms=millis(self.percentile(0.999)),
+            max_ms=millis(self.max),
+            buckets=dict(('<%dus' % (1 << bucket,), count)
+                         for bucket, count in enumerate(self.buckets)
+                         if count))
+
+
+class Tracer(object):
+    """
+    Samples messages read from processes at `rate`, from 0 for none to
+    1 for all, and collects how long they took between stages.
+    """
+    __slots__ = ('_rate', '_every', '_count', 'stages')
+
+    def __init__(self, rate=0.0):
+        self._count = 0
+        self.stages = dict()
+        self.rate = rate
+
+    def __repr__(self):
+        return "%s(rate=%r, %d stages)" % (self.__class__.__name__,
+                                           self._rate, len(self.stages))
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        rate = max(0.0, min(1.0, float(rate or 0)))
+        self._rate = rate
+        self._every = int(round(1 / rate)) if rate > 0 else 0
+
+    def message(self, kind, payload):
+        """
+        Message for output just read from a process, traced if sampled
+        """
+        every = self._every
+        if every:
+            self._count += 1
+            if self._count >= every:
+                self._count = 0
+                msg = TracedMessage(kind, payload)
+                msg.trace = [('read', clock())]
+                return msg
+        return Message(kind, payload)
+
+    def finish(self, msg):
+        """
+        Records the stages of a traced message, once it has been sent
+        """
+        trace = msg.trace
+        if trace is None:
+            return
+        msg.trace = None
+        msg_stage, previous = trace[0]
+        for stage, when in trace[1:]:
+            self._add('%s->%s' % (msg_stage, stage), when - previous)
+            msg_stage, previous = stage, when
+        self._add('total', previous - trace[0][1])
+
+    def _add(self, name, seconds):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = Histogram()
+        histogram.add(seconds)
+
+    def reset(self):
+        self.stages = dict()
+
+    def to_dict(self):
+        return dict(rate=self._rate,
+                    stages=dict((name, histogram.to_dict())
+                                for name, histogram in self.stages.items()))
+
+
+# Used by every process and client connection
+TRACER = Tracer()
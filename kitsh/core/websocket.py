@@ -1,20 +1,37 @@
 from __future__ import print_function
 
+import codecs
 import logging
 import json
 
 import gevent
 from gevent.event import Event
 
+from .inout import Message, TracedMessage, DATA, ERROR
+from .trace import TRACER
+from .sched import DEFAULT_SCHEDULER
+
 LOG = logging.getLogger(__name__)
 
 
 class Websocket(object):
-    def __init__(self, websocket, readonly=False, remote=None):
+    """
+    Carries task messages over a websocket as JSON objects, {kind: payload}.
+
+    Output is bytes and is decoded incrementally per stream, so characters
+    split across reads reach the client intact. With `binary` DATA is
+    sent as binary frames without decoding, and binary frames received
+    are taken as DATA; JSON is then only used for the other kinds.
+    """
+    def __init__(self, websocket, readonly=False, remote=None, binary=False,
+                 scheduler=DEFAULT_SCHEDULER):
         self._ws = websocket
+        self._scheduler = scheduler
         self._closed = Event()
         self._readonly = readonly
         self._remote = remote
+        self._binary = binary
+        self._decoders = dict()
         self._tasks = None
 
     def __repr__(self):
@@ -49,23 +66,56 @@ class Websocket(object):
                 LOG.exception("%r recvloop", self)
                 break
             if data in (StopIteration, None):
-                break                
+                break
             try:
-                msg = json.loads(data)
-            except ValueError:
+                msg = self._decode(data)
+            except (ValueError, TypeError):
                 LOG.exception("%r recv decode error for %r", self, data)
                 continue
             task.output.send(msg)
         LOG.debug("%r recvloop finished", self)
         self.stop()
 
+    def _decode(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            return Message(DATA, bytes(data))
+        msg = Message.from_dict(json.loads(data))
+        if msg.kind in (DATA, ERROR) and not isinstance(msg.payload, bytes):
+            msg = Message(msg.kind, msg.payload.encode('utf-8'))
+        return msg
+
+    def _encode(self, msg):
+        payload = msg.payload
+        if isinstance(payload, bytes):
+            if self._binary and msg.kind == DATA:
+                return payload
+            decoder = self._decoders.get(msg.kind)
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                self._decoders[msg.kind] = decoder
+            payload = decoder.decode(payload)
+            if not payload:
+                return None
+        return json.dumps({msg.kind: payload})
+
     def _sendloop(self, task):
+        # Messages from the client, such as keystrokes, are its input
+        quota = self._scheduler.quota(task.output)
         for msg in task.input.watch():
             #LOG.info("sendloop Got %r", msg)
             if msg is StopIteration or self.closed:
                 break
             try:
-                self._ws.send(json.dumps(msg))
+                traced = type(msg) is TracedMessage
+                data = self._encode(msg)
+                if traced:
+                    msg.stamp('encode')
+                if data is not None:
+                    self._ws.send(data)
+                    quota.charge(len(data))
+                if traced:
+                    msg.stamp('sent')
+                    TRACER.finish(msg)
             except Exception:
                 LOG.exception("%r send error for %r", self, msg)
                 continue
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+"""
+Full-text search of session output. The output of every recorded task
+is split into lines as it is sent, and each line is stored in an SQLite
+database with the session, its byte offset in the session's output and
+when it was output, indexed with FTS5. Files of output, such as those of
+`script`, can be indexed too:
+
+    python -m kitsh.search --db output.db index typescript
+    python -m kitsh.search --db output.db query 'rm -rf'
+"""
+from __future__ import print_function
+
+import re
+import os
+import time
+import sqlite3
+import logging
+import argparse
+
+import gevent
+from gevent.event import Event
+from gevent.threadpool import ThreadPool
+
+from .core.inout import Message, DATA
+
+__all__ = ('OutputIndex', 'INDEX_ENV')
+
+
+LOG = logging.getLogger(__name__)
+
+# Database the web UI records sessions to, unless given otherwise
+INDEX_ENV = 'KITSH_INDEX'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    started REAL,
+    ended REAL
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    time REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_session ON lines (session, offset);
+CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5 (
+    text, content='lines', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS lines_indexed AFTER INSERT ON lines BEGIN
+    INSERT INTO lines_fts (rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+# Terminal control sequences, which aren't searched for, backspaces are
+# applied by clean()
+ESCAPES = re.compile(u'\x1b\\[[0-?]*[ -/]*[@-~]'
+                     u'|\x1b\\][^\x07\x1b]*(?:\x07|\x1b\\\\)?'
+                     u'|\x1b[ -/]*[0-~]'
+                     u'|[\x00-\x07\x0b-\x1f\x7f]')
+
+
+def clean(line):
+    """
+    What a line of terminal output shows: without control sequences,
+    after carriage returns and backspaces
+    """
+    line = line.rstrip(u'\r\n')
+    if u'\r' in line:
+        line = line.rsplit(u'\r', 1)[1]
+    line = ESCAPES.sub(u'', line)
+    if u'\b' in line:
+        chars = []
+        for char in line:
+            if char == u'\b':
+                if chars:
+                    chars.pop()
+            else:
+                chars.append(char)
+        line = u''.join(chars)
+    return line.strip()
+
+
+class _Recorder(object):
+    """
+    Splits the output of one session into lines for the index. Without
+    a `session` yet messages are held until `start()` gives it one.
+    """
+    __slots__ = ('_index', 'session', '_held', '_buf', '_offset',
+                 '_started', '_maxlen')
+
+    def __init__(self, index, session=None, maxlen=4096):
+        self._index = index
+        self.session = session
+        self._held = [] if session is None else None
+        self._buf = b''
+        # Of the start of the buffer in the session's output
+        self._offset = 0
+        self._started = None
+        self._maxlen = maxlen
+
+    def start(self, session):
+        self.session = session
+        held, self._held = self._held, None
+        for msg in held:
+            self(msg)
+
+    def __call__(self, msg):
+        if self._held is not None:
+            self._held.append(msg)
+        elif msg is StopIteration:
+            self.close()
+        elif isinstance(msg, Message) and msg.kind == DATA:
+            payload = msg.payload
+            if not isinstance(payload, bytes):
+                payload = payload.encode('utf-8')
+            self.feed(payload)
+
+    def feed(self, data, now=None):
+        if not data:
+            return
+        if now is None:
+            now = time.time()
+        if not self._buf:
+            self._started = now
+        self._buf += data
+        while True:
+            end = self._buf.find(b'\n')
+            if end < 0:
+                if len(self._buf) < self._maxlen:
+                    break
+                # Long lines are indexed in parts
+                end = self._maxlen - 1
+            self._line(self._buf[:end + 1])
+            self._buf = self._buf[end + 1:]
+            self._started = now
+
+    def _line(self, raw):
+        text = clean(raw.decode('utf-8', 'replace'))
+        if text:
+            self._index.add(self.session, self._offset, self._started, text)
+        self._offset += len(raw)
+
+    def close(self):
+        if self._buf:
+            self._line(self._buf)
+            self._buf = b''
+        if self.session is not None:
+            self._index.ended(self.session)
+            self.session = None
+
+
+class OutputIndex(object):
+    """
+    The search index in the SQLite database at `path`. Lines are written
+    in batches, every `interval` seconds or once `batch` are pending.
+    The database is only used from a thread of its own, so neither
+    writing nor searching it holds up the hub.
+    """
+    __slots__ = ('_pool', '_db', '_pending', '_ended', '_batch',
+                 '_interval', '_due', '_flusher')
+
+    def __init__(self, path, interval=1.0, batch=1000):
+        self._pool = ThreadPool(1)
+        self._db = self._pool.apply(self._connect, (path,))
+        self._pending = []
+        # (time, session) of the sessions which ended since the last flush
+        self._ended = []
+        self._batch = batch
+        self._interval = interval
+        self._due = Event()
+        self._flusher = None
+
+    def __repr__(self):
+        return "%s(%d pending)" % (self.__class__.__name__,
+                                   len(self._pending))
+
+    @staticmethod
+    def _connect(path):
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        # Losing the last lines to a power cut is fine, waiting on fsync
+        # for every batch isn't
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        return db
+
+    def session(self, name=None, started=None):
+        """
+        Starts a new session, returning its ID
+        """
+        return self._pool.apply(self._insert_session,
+                                (name, started or time.time()))
+
+    def _insert_session(self, name, started):
+        with self._db:
+            return self._db.execute(
+                'INSERT INTO sessions (name, started) VALUES (?, ?)',
+                (name, started)).lastrowid
+
+    def record(self, task, name=None):
+        """
+        Indexes the output of `task` as a new session, returning its ID
+        """
+        # Tapped first, what is output while the session is created is
+        # held for it
+        recorder = _Recorder(self)
+        task.output.tap(recorder)
+        session = self.session(name)
+        recorder.start(session)
+        return session
+
+    def add_file(self, path, name=None):
+        """
+        Indexes a file of output as a session, as if it was output when
+        the file was last modified
+        """
+        when = os.path.getmtime(path)
+        session = self.session(name or path, when)
+        recorder = _Recorder(self, session)
+        with open(path, 'rb') as handle:
+            for data in iter(lambda: handle.read(65536), b''):
+                recorder.feed(data, when)
+        recorder.close()
+        return session
+
+    def add(self, session, offset, when, text):
+        if self._pool is None:
+            return
+        self._pending.append((session, offset, when, text))
+        if len(self._pending) >= self._batch:
+            self._due.set()
+        self._start_flusher()
+
+    def ended(self, session):
+        if self._pool is None:
+            return
+        self._ended.append((time.time(), session))
+        self._due.set()
+        self._start_flusher()
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = gevent.spawn(self._flushing)
+
+    def _flushing(self):
+        while True:
+            self._due.wait(self._interval)
+            self._due.clear()
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception("Writing to %r", self)
+
+    def flush(self):
+        """
+        Writes what is pending, waiting for it
+        """
+        pending, self._pending = self._pending, []
+        ended, self._ended = self._ended, []
+        if pending or ended:
+            self._pool.apply(self._write, (pending, ended))
+
+    def _write(self, pending, ended):
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO lines (session, offset, time, text) '
+                'VALUES (?, ?, ?, ?)', pending)
+            self._db.executemany(
+                'UPDATE sessions SET ended = ? WHERE id = ?', ended)
+
+    def _query(self, sql, params):
+        return self._db.execute(sql, params).fetchall()
+
+    def search(self, query, raw=False, since=None, until=None, limit=100):
+        """
+        The latest lines matching `query`, as a phrase or with `raw` in
+        FTS5 syntax, between the times `since` and `until`. Each is a
+        dict with the session, its name, the line's offset and time, and
+        the line with the matches in [brackets].
+        """
+        self.flush()
+        if not raw:
+            query = u'"%s"' % (query.replace(u'"', u'""'),)
+        sql = ('SELECT lines.session, sessions.name, lines.offset, '
+               'lines.time, highlight(lines_fts, 0, \'[\', \']\') '
+               'FROM lines_fts '
+               'JOIN lines ON lines.id = lines_fts.rowid '
+               'JOIN sessions ON sessions.id = lines.session '
+               'WHERE lines_fts MATCH ?')
+        params = [query]
+        if since is not None:
+            sql += ' AND lines.time >= ?'
+            params.append(since)
+        if until is not None:
+            sql += ' AND lines.time < ?'
+            params.append(until)
+        # Lines are numbered as they are output, newest first is cheap
+        sql += ' ORDER BY lines_fts.rowid DESC LIMIT ?'
+        params.append(limit)
+        return [dict(session=session, name=name, offset=offset, time=when,
+                     text=text)
+                for session, name, offset, when, text
+                in self._pool.apply(self._query, (sql, params))]
+
+    def context(self, session, offset=0, limit=50):
+        """
+        Lines of `session` from the byte `offset` of its output on
+        """
+        self.flush()
+        return [dict(offset=offset, time=when, text=text)
+                for offset, when, text in self._pool.apply(self._query, (
+                    'SELECT offset, time, text FROM lines '
+                    'WHERE session = ? AND offset >= ? '
+                    'ORDER BY offset LIMIT ?', (session, offset, limit)))]
+
+    def close(self):
+        if self._pool is None:
+            return
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            flusher.kill()
+        self.flush()
+        pool, self._pool = self._pool, None
+        pool.apply(self._db.close)
+        pool.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.environ.get(INDEX_ENV),
+                        help='Index database (default: $%s)' % (INDEX_ENV,))
+    commands = parser.add_subparsers(dest='command')
+    index = commands.add_parser('index', help='Index files of output')
+    index.add_argument('files', nargs='+')
+    query = commands.add_parser('query', help='Search the index')
+    query.add_argument('text')
+    query.add_argument('--raw', action='store_true',
+                       help='TEXT is an FTS5 query, not a phrase')
+    query.add_argument('--limit', '-n', type=int, default=20)
+    args = parser.parse_args()
+    if not args.db or not args.command:
+        parser.error('--db and a command are required')
+
+    outidx = OutputIndex(args.db)
+    try:
+        if args.command == 'index':
+            for path in args.files:
+                print("%s: session %d" % (path, outidx.add_file(path)))
+        else:
+            for row in outidx.search(args.text, args.raw, limit=args.limit):
+                print("%s %s @%d: %s" % (
+                    time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(row['time'])),
+                    row['name'], row['offset'], row['text']))
+    finally:
+        outidx.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,8 +10,8 @@ WSSHClient.prototype._generateEndpoint = function(options) {
         var protocol = 'ws://';
     }
     var endpoint = protocol + window.location.host;
-    if( options.bridge_id ) {
-        endpoint +='/websocket?id=' + options.bridge_id;
+    if( options.session ) {
+        endpoint +='/websocket?session=' + encodeURIComponent(options.session);
     }
     else {        
         endpoint += '/ssh/connect';
@@ -39,6 +39,12 @@ WSSHClient.prototype._generateEndpoint = function(options) {
 };
 
 WSSHClient.prototype.connect = function(options) {
+    if (options.mux) {
+        // Share one websocket with every other terminal on the page
+        this._stream = WSSHMux.shared().open(options);
+        options.onConnect();
+        return;
+    }
     var endpoint = this._generateEndpoint(options);
     var self = this;
 
@@ -73,5 +79,188 @@ WSSHClient.prototype.connect = function(options) {
 };
 
 WSSHClient.prototype.send = function(data) {
+    if (this._stream) {
+        this._stream.send(data);
+        return;
+    }
     this._connection.send(JSON.stringify({'data': data}));
-};
\ No newline at end of file
+};
+
+// Many terminal sessions over one websocket to /mux, every frame is
+// [uint32 stream id][uint8 type][payload], see kitsh/core/mux.py
+var MUX_OPEN = 1, MUX_CLOSE = 2, MUX_DATA = 3, MUX_CONTROL = 4,
+    MUX_WINDOW = 5;
+
+function WSSHMux(endpoint, window_size) {
+    if (endpoint === undefined) {
+        var protocol = window.location.protocol == 'https:' ? 'wss://' : 'ws://';
+        endpoint = protocol + window.location.host + '/mux';
+    }
+    this.window_size = window_size || 262144;
+    this._streams = {};
+    this._next_id = 1;
+    this._pending = [];
+    this._encoder = new TextEncoder();
+    this._connection = new WebSocket(endpoint);
+    this._connection.binaryType = 'arraybuffer';
+    var self = this;
+    this._connection.onopen = function() {
+        var pending = self._pending;
+        self._pending = null;
+        for (var i = 0; i < pending.length; i++) {
+            self._connection.send(pending[i]);
+        }
+    };
+    this._connection.onmessage = function(evt) {
+        self._receive(evt.data);
+    };
+    this._connection.onclose = function() {
+        var streams = self._streams;
+        self._streams = {};
+        // Shells outlive the connection when the server hands them to its
+        // replacement, see kitsh/core/handoff.py, so streams which know
+        // their session rejoin it over a new connection
+        var rejoin = [];
+        for (var stream_id in streams) {
+            var stream = streams[stream_id];
+            if (stream.session !== undefined &&
+                    stream._rejoins < WSSHMux.MAX_REJOINS) {
+                rejoin.push(stream);
+            }
+            else {
+                stream._closed();
+            }
+        }
+        if (rejoin.length) {
+            setTimeout(function() {
+                var mux = WSSHMux.shared();
+                for (var i = 0; i < rejoin.length; i++) {
+                    rejoin[i]._rejoins += 1;
+                    mux._open(rejoin[i]);
+                }
+            }, WSSHMux.REJOIN_DELAY);
+        }
+    };
+};
+
+// Attempts to rejoin a session, a second apart, before giving up
+WSSHMux.MAX_REJOINS = 10;
+WSSHMux.REJOIN_DELAY = 1000;
+
+// One connection shared by every terminal on the page
+WSSHMux.shared = function() {
+    if (!WSSHMux._shared || WSSHMux._shared._connection.readyState > 1) {
+        WSSHMux._shared = new WSSHMux();
+    }
+    return WSSHMux._shared;
+};
+
+WSSHMux.prototype._send = function(stream_id, op, payload) {
+    var body = payload || new Uint8Array(0);
+    var frame = new Uint8Array(5 + body.length);
+    var view = new DataView(frame.buffer);
+    view.setUint32(0, stream_id);
+    view.setUint8(4, op);
+    frame.set(body, 5);
+    if (this._pending !== null) {
+        this._pending.push(frame.buffer);
+    }
+    else {
+        this._connection.send(frame.buffer);
+    }
+};
+
+WSSHMux.prototype._receive = function(data) {
+    var view = new DataView(data);
+    var stream = this._streams[view.getUint32(0)];
+    if (stream === undefined) {
+        return;
+    }
+    var op = view.getUint8(4);
+    var payload = new Uint8Array(data, 5);
+    if (op == MUX_DATA) {
+        stream._data(payload);
+    }
+    else if (op == MUX_CONTROL) {
+        stream._control(JSON.parse(new TextDecoder().decode(payload)));
+    }
+    else if (op == MUX_CLOSE) {
+        delete this._streams[stream.id];
+        stream._closed();
+    }
+};
+
+WSSHMux.prototype.open = function(options) {
+    var stream = new WSSHStream(options);
+    this._open(stream);
+    return stream;
+};
+
+WSSHMux.prototype._open = function(stream) {
+    stream.mux = this;
+    stream.id = this._next_id;
+    stream._consumed = 0;
+    this._next_id += 2;
+    this._streams[stream.id] = stream;
+    var params = {'window': this.window_size};
+    if (stream.session !== undefined) {
+        params.session = stream.session;
+    }
+    this._send(stream.id, MUX_OPEN, this._encoder.encode(
+        JSON.stringify(params)));
+};
+
+function WSSHStream(options) {
+    this.mux = null;
+    this.id = null;
+    this.options = options;
+    // Named by the server once it has started the shell
+    this.session = options.session || undefined;
+    this._rejoins = 0;
+    this._decoder = new TextDecoder('utf-8');
+    this._consumed = 0;
+};
+
+WSSHStream.prototype._data = function(payload) {
+    this._rejoins = 0;
+    this.options.onData(this._decoder.decode(payload, {stream: true}));
+    // Grant the server more credit once half the window is used
+    this._consumed += payload.length;
+    if (this._consumed >= this.mux.window_size / 2) {
+        var credit = new Uint8Array(4);
+        new DataView(credit.buffer).setUint32(0, this._consumed);
+        this.mux._send(this.id, MUX_WINDOW, credit);
+        this._consumed = 0;
+    }
+};
+
+WSSHStream.prototype._control = function(message) {
+    if (message.session !== undefined) {
+        this.session = message.session;
+    }
+    if (message.error !== undefined && this.options.onError) {
+        this.options.onError(message.error);
+    }
+};
+
+WSSHStream.prototype._closed = function() {
+    if (this.options.onClose) {
+        this.options.onClose();
+    }
+};
+
+WSSHStream.prototype.send = function(data) {
+    this.mux._send(this.id, MUX_DATA, this.mux._encoder.encode(data));
+};
+
+WSSHStream.prototype.resize = function(width, height) {
+    this.mux._send(this.id, MUX_CONTROL, this.mux._encoder.encode(
+        JSON.stringify({'resize': {'width': width, 'height': height}})));
+};
+
+WSSHStream.prototype.close = function() {
+    if (this.mux._streams[this.id] !== undefined) {
+        delete this.mux._streams[this.id];
+        this.mux._send(this.id, MUX_CLOSE);
+    }
+};
@@ -0,0 +1,102 @@
+"""
+Live table of the tasks running in a kitsh server, like top(1)
+"""
+import argparse
+import json
+import sys
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+COLUMNS = (
+    ('id', '%-12s', 'ID'),
+    ('state', '%-8s', 'STATE'),
+    ('age', '%8s', 'AGE'),
+    ('in_rate', '%9s', 'IN/s'),
+    ('out_rate', '%9s', 'OUT/s'),
+    ('in_queue', '%6s', 'INQ'),
+    ('out_queue', '%6s', 'OUTQ'),
+    ('busy', '%6s', 'BUSY%'),
+    ('pid', '%7s', 'PID'),
+    ('cpu', '%6s', 'CPU%'),
+    ('rss', '%8s', 'RSS'),
+    ('task', '%s', 'TASK'),
+)
+
+
+def _size(num):
+    if num is None:
+        return '-'
+    for unit in ('', 'K', 'M', 'G'):
+        if abs(num) < 1024:
+            return '%d%s' % (num, unit)
+        num /= 1024.0
+    return '%dT' % (num,)
+
+
+def _age(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return '%d:%02d' % (seconds // 60, seconds % 60)
+    return '%dh%02d' % (seconds // 3600, (seconds % 3600) // 60)
+
+
+def _cell(row, key, now):
+    if key == 'id':
+        return '%x' % (row['id'],)
+    if key == 'age':
+        return _age(now - row['created'])
+    if key in ('in_rate', 'out_rate', 'rss'):
+        return _size(row.get(key))
+    value = row.get(key)
+    return '-' if value is None else str(value)
+
+
+def render(rows, now, out=sys.stdout, limit=None):
+    rows = sorted(rows, key=lambda row: (row['out_rate'] + row['in_rate'],
+                                         row.get('busy') or 0), reverse=True)
+    if limit:
+        rows = rows[:limit]
+    lines = [' '.join(fmt % (title,) for _, fmt, title in COLUMNS)]
+    for row in rows:
+        lines.append(' '.join(fmt % (_cell(row, key, now),)
+                              for key, fmt, _ in COLUMNS))
+    # Clear the screen and draw from the top left corner
+    out.write('\x1b[H\x1b[2J' + '\n'.join(lines) + '\n')
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', '-H', default='127.0.0.1',
+                        help='kitsh server host (default: 127.0.0.1)')
+    parser.add_argument('--port', '-P', type=int, default=5000,
+                        help='kitsh server port (default: 5000)')
+    parser.add_argument('--interval', '-d', type=float, default=1.0,
+                        help='Seconds between refreshes (default: 1)')
+    parser.add_argument('--limit', '-n', type=int, default=None,
+                        help='Show at most this many tasks')
+    args = parser.parse_args()
+
+    url = 'http://%s:%d/top?interval=%s' % (args.host, args.port,
+                                             args.interval)
+    rows = dict()
+    try:
+        stream = urlopen(url)
+        for line in stream:
+            update = json.loads(line.decode('utf-8'))
+            for ident in update['removed']:
+                rows.pop(ident, None)
+            for row in update['rows']:
+                rows[row['id']] = row
+            render(rows.values(), time.time(), limit=args.limit)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
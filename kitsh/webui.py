@@ -1,18 +1,39 @@
 import os
+import json
+import uuid
+import codecs
 import logging
+import sqlite3
 
-from flask import Blueprint, request, render_template, redirect
-from werkzeug.exceptions import BadRequest
+import gevent
+
+from flask import (Blueprint, Response, request, render_template, redirect,
+                   stream_with_context)
+import werkzeug.routing
+from werkzeug.exceptions import BadRequest, NotFound
 
 from .core.task import TaskManager
 from .core.plugin import PluginHost
 from .core.httpd import Httpd
 from .core.process import Process
 from .core.websocket import Websocket
+from .core.inout import History, Message, ERROR, SESSION
+from .core.stats import TaskStats
+from .core.trace import TRACER
+from .core.mux import Multiplexer
+from .batch import BatchExec
+from .agent import AgentRouter, TOKEN_ENV
+from .search import OutputIndex, INDEX_ENV
 
 
 LOG = logging.getLogger(__name__)
 
+# Werkzeug >= 1.0 only routes websocket requests to websocket rules
+if hasattr(werkzeug.routing, 'WebsocketMismatch'):
+    WEBSOCKET_RULE = dict(websocket=True)
+else:
+    WEBSOCKET_RULE = dict()
+
 
 def echoproc(task):
     LOG.info("echoproc started")
@@ -26,7 +47,8 @@ class WebUI(Blueprint):
     def __repr__(self):
         return "WebUI"
 
-    def __init__(self):
+    def __init__(self, batch_concurrency=16, tail_history=1000,
+                 agent_token=None, index_path=None):
         root_path = os.path.dirname(__file__)
         template_folder = os.path.join(root_path, 'templates')
         static_folder = os.path.join(root_path, 'static')
@@ -36,44 +58,351 @@ class WebUI(Blueprint):
             template_folder=template_folder,
             static_folder=static_folder)
         self._log = logging.getLogger(__name__)
+        self._batch_concurrency = batch_concurrency
+        self._tail_history = tail_history
+        self._histories = dict()
+        if agent_token is None:
+            agent_token = os.environ.get(TOKEN_ENV)
+        self.router = AgentRouter(agent_token)
+        # Output of the terminal sessions is only searchable with an index
+        if index_path is None:
+            index_path = os.environ.get(INDEX_ENV)
+        self.output_index = OutputIndex(index_path) if index_path else None
 
         self.add_url_rule('/', view_func=self.index)
         self.add_url_rule('/', methods=['POST'], view_func=self.view)
-        self.add_url_rule('/websocket', view_func=self.websocket)
+        self.add_url_rule('/websocket', view_func=self.websocket,
+                          **WEBSOCKET_RULE)
+        self.add_url_rule('/exec', methods=['POST'], view_func=self.batch)
+        self.add_url_rule('/tail', view_func=self.tail)
+        self.add_url_rule('/top', view_func=self.top)
+        self.add_url_rule('/latency', view_func=self.latency)
+        self.add_url_rule('/events', view_func=self.events,
+                          **WEBSOCKET_RULE)
+        self.add_url_rule('/mux', view_func=self.mux, **WEBSOCKET_RULE)
+        self.add_url_rule('/agent', view_func=self.agent, **WEBSOCKET_RULE)
+        self.add_url_rule('/agents', view_func=self.agents)
+        self.add_url_rule('/search', view_func=self.search)
+        self.add_url_rule('/search/<int:session>', view_func=self.context)
 
     def index(self):
         return render_template('index.html', tasks=TaskManager.tasks())
 
     def view(self):
-        task = request.args.get('id')
-        if task:
-            task = TaskManager.get(task)
+        task = TaskManager.get(request.args.get('id', type=int))
         if not task:
             return redirect('/')
-        return render_template('view.html', session_id=task.pid)
+        return render_template('view.html', session=task.session)
+
+    def batch(self):
+        """
+        Runs a batch of commands, {"commands": [...], "concurrency": N},
+        streaming their output and exit codes back as NDJSON.
+        """
+        params = request.get_json(force=True, silent=True)
+        if not isinstance(params, dict) or \
+                not isinstance(params.get('commands'), list):
+            raise BadRequest('Expected {"commands": [...]}')
+        try:
+            concurrency = int(params.get('concurrency',
+                                         self._batch_concurrency))
+        except (TypeError, ValueError):
+            raise BadRequest('Invalid concurrency')
+        concurrency = max(1, min(concurrency, self._batch_concurrency))
+        batch = BatchExec(params['commands'], concurrency=concurrency)
+
+        def generate():
+            for event in batch:
+                yield json.dumps(event) + "\n"
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+
+    def _history(self, task):
+        task_id = id(task)
+        history = self._histories.get(task_id)
+        if history is None:
+            history = History(
+                task.output, self._tail_history,
+                onclose=lambda _: self._histories.pop(task_id, None))
+            self._histories[task_id] = history
+        return history
+
+    @staticmethod
+    def _sse_event(seq, msg, decoder):
+        if isinstance(msg, Message):
+            payload = msg.payload
+            if isinstance(payload, bytes):
+                payload = decoder.decode(payload)
+            msg = {msg.kind: payload}
+        return "id: %d\ndata: %s\n\n" % (seq, json.dumps(msg))
+
+    def tail(self):
+        """
+        Server-Sent Events feed of a task's output. Reconnecting clients
+        resume after their Last-Event-ID from a bounded history buffer.
+        """
+        task = TaskManager.get(request.args.get('id', type=int))
+        if task is None or task.output.closed:
+            raise NotFound()
+        try:
+            last_id = int(request.headers.get('Last-Event-ID',
+                                              request.args.get('last', 0)))
+        except ValueError:
+            raise BadRequest('Invalid Last-Event-ID')
+        history = self._history(task)
+        # Nothing can be sent in between, so the subscriber continues
+        # exactly where the history snapshot ends
+        sub = task.output.watch()
+        backlog = history.since(last_id)
+        first = history.last + 1
+
+        def generate():
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            with sub:
+                for seq, msg in backlog:
+                    yield self._sse_event(seq, msg, decoder)
+                for seq, msg in enumerate(sub, first):
+                    yield self._sse_event(seq, msg, decoder)
+        return Response(stream_with_context(generate()),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    def top(self):
+        """
+        Streams task statistics as NDJSON, every row first and then only
+        the rows which changed every `interval` seconds.
+        """
+        interval = max(0.1, request.args.get('interval', 1.0, type=float))
+        stats = TaskStats()
+
+        def generate():
+            try:
+                update = stats.refresh()
+                while True:
+                    yield json.dumps(update) + "\n"
+                    gevent.sleep(interval)
+                    update = stats.refresh()
+            finally:
+                stats.close()
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+
+    def latency(self):
+        """
+        Latency histograms of the traced output, see `kitsh.core.trace`,
+        `?reset=1` starts collecting afresh after reading them.
+        """
+        result = TRACER.to_dict()
+        if request.args.get('reset', type=int) == 1:
+            TRACER.reset()
+        return Response(json.dumps(result), mimetype='application/json')
+
+    def close(self):
+        """
+        Writes out what the index still has pending, on shutdown
+        """
+        if self.output_index is not None:
+            self.output_index.close()
+
+    def _record(self, task, name):
+        if self.output_index is not None:
+            self.output_index.record(task, name)
+
+    def search(self):
+        """
+        The latest lines of session output matching `?q=`, a phrase, or
+        FTS5 syntax with `&raw=1`, optionally output `&since=` and
+        `&until=` UNIX times. As JSON, see `OutputIndex.search`.
+        """
+        if self.output_index is None:
+            raise NotFound()
+        query = request.args.get('q')
+        if not query:
+            raise BadRequest('Expected ?q=')
+        limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+        try:
+            result = self.output_index.search(
+                query, raw=request.args.get('raw', type=int) == 1,
+                since=request.args.get('since', type=float),
+                until=request.args.get('until', type=float), limit=limit)
+        except sqlite3.OperationalError as ex:
+            raise BadRequest('Invalid query: %s' % (ex,))
+        return Response(json.dumps(result), mimetype='application/json')
+
+    def context(self, session):
+        """
+        Lines of a session's output from the byte `?offset=` of a match
+        """
+        if self.output_index is None:
+            raise NotFound()
+        offset = request.args.get('offset', 0, type=int)
+        limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+        lines = self.output_index.context(session, offset, limit)
+        return Response(json.dumps(lines), mimetype='application/json')
+
+    @staticmethod
+    def _until_closed(sock, sub):
+        from geventwebsocket.exceptions import WebSocketError
+        try:
+            while sock.receive() is not None:
+                pass
+        except WebSocketError:
+            pass
+        sub.close()
+
+    def events(self):
+        """
+        Websocket feed of task lifecycle events. The first frame lists
+        every task, later frames only the tasks which changed since, as
+        JSON lists of `TaskEvent.to_dict()`.
+        """
+        from geventwebsocket.exceptions import WebSocketError
+        sock = request.environ.get('wsgi.websocket')
+        if not sock:
+            raise BadRequest()
+        # Nothing can happen in between, so the snapshot and the events
+        # which follow neither overlap nor leave a gap
+        sub = TaskManager.watch()
+        snapshot = [event.to_dict() for event in TaskManager.snapshot()]
+        reader = gevent.spawn(self._until_closed, sock, sub)
+        try:
+            sock.send(json.dumps(snapshot))
+            for event in sub:
+                # Everything queued while sending goes in the next frame,
+                # with only the latest event for each task
+                changes = dict()
+                while event is not None:
+                    changes[id(event.task)] = event
+                    event = sub.recv() if len(sub) else None
+                sock.send(json.dumps([event.to_dict()
+                                      for event in changes.values()]))
+        except WebSocketError:
+            pass
+        finally:
+            sub.close()
+            reader.kill()
+        return str()
+
+    def _shell(self, session, name):
+        """
+        The running shell of the terminal session named `session`, such as
+        one taken over from the previous server, or None if there is none.
+        Without `session` a new shell, recorded as `name`.
+        """
+        if session is not None:
+            task = TaskManager.session(session)
+            if task is None or task.state != 'RUNNING' or \
+                    not isinstance(task.obj, Process):
+                return None
+            return task
+        task = TaskManager.spawn(Process(["bash"]), session=uuid.uuid4().hex)
+        self._record(task, name)
+        return task
+
+    def _mux_session(self, stream_task):
+        params = stream_task.obj.params
+        session = params.get(SESSION) if isinstance(params, dict) else None
+        proc_task = self._shell(session, repr(stream_task.obj))
+        if proc_task is None:
+            stream_task.input.send(Message(ERROR, 'No such session'))
+            stream_task.stop()
+            return
+        stream_task.input.send(Message(SESSION, proc_task.session))
+        # Stop reading the shell's output while the client is behind
+        stream_task.obj.throttle = proc_task.output
+        with stream_task.bridge(proc_task) as bridge:
+            bridge.wait()
+        if session is not None or proc_task.obj.released:
+            # Joined shells outlive the stream, and one handed over stays
+            # open so the client rejoins it once this server goes
+            return
+        proc_task.stop()
+        stream_task.stop()
+
+    def mux(self):
+        """
+        Many terminal sessions over one websocket, each stream the client
+        opens runs a shell. See `kitsh.core.mux` for the framing.
+
+        The first message of a stream names its session. Opening a stream
+        with that `session` parameter rejoins the shell, which is how the
+        client gets it back once a replacement took over from this server;
+        the shell outlives a stream which joined it.
+        """
+        sock = request.environ.get('wsgi.websocket')
+        if not sock:
+            raise BadRequest()
+        remote_addr = "%s:%s" % (request.remote_addr,
+                                 request.environ.get('REMOTE_PORT'))
+        Multiplexer(sock, initiator=False, onopen=self._mux_session,
+                    name=remote_addr).run()
+        return str()
+
+    def agent(self):
+        """
+        Agents dial in here, see `kitsh.agent`
+        """
+        sock = request.environ.get('wsgi.websocket')
+        if not sock:
+            raise BadRequest()
+        remote_addr = "%s:%s" % (request.remote_addr,
+                                 request.environ.get('REMOTE_PORT'))
+        self.router.serve(sock, remote_addr)
+        return str()
+
+    def agents(self):
+        return Response(json.dumps(self.router.agents()),
+                        mimetype='application/json')
 
     def websocket(self):
+        """
+        Terminal session for the websocket, a local shell or with
+        `?agent=<name>`, or `?agent=` for any, a shell on an agent. With
+        `?session=<name>` it rejoins that shell, see `mux`.
+        """
+        sock = request.environ.get('wsgi.websocket')
+        if not sock:
+            self._log.error('Abort: Request is not WebSocket upgradable')
+            raise BadRequest()
+        agent = request.args.get('agent')
+        session = request.args.get(SESSION)
+        remote_addr = "%s:%s" % (request.remote_addr,
+                                 request.environ.get('REMOTE_PORT'))
+        subtask = task = None
         try:
-            sock = request.environ.get('wsgi.websocket')
-            if not sock:
-                self._log.error('Abort: Request is not WebSocket upgradable')
-                raise BadRequest()
+            if agent is None:
+                subtask = self._shell(session, remote_addr)
+                if subtask is None:
+                    sock.close(1008, b'No such session')
+                    return str()
+            else:
+                # None when no agent is connected or has room
+                subtask = self.router.open(agent or None)
+                if subtask is None:
+                    sock.close(1013, b'No agent available')
+                    return str()
+                self._record(subtask, remote_addr)
 
-            remote_addr = "%s:%s" % (request.remote_addr,
-                                     request.environ.get('REMOTE_PORT'))
-            task = TaskManager.spawn(Websocket(sock, remote=remote_addr))
-            subtask = TaskManager.spawn(Process(["bash"]))
+            binary = request.args.get('binary', type=int) == 1
+            task = TaskManager.spawn(Websocket(sock, remote=remote_addr,
+                                               binary=binary))
+            if subtask.session is not None:
+                task.input.send(Message(SESSION, subtask.session))
 
             with task.bridge(subtask) as bridge:
                 bridge.wait()
-
-            subtask.stop()
-            task.stop()
-
-            task.wait()
-            subtask.wait()
         except Exception:
             LOG.exception("in websocket")
+        finally:
+            if agent is None and session is not None:
+                # Joined, the shell outlives the websocket
+                subtask = None
+            for each in (subtask, task):
+                if each is not None:
+                    each.stop()
+            for each in (task, subtask):
+                if each is not None:
+                    each.wait()
         return str()
 
 
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import gevent
+
+from kitsh.batch import BatchExec
+from kitsh.core.task import TaskManager
+
+
+def test_batch():
+	batch = BatchExec([['echo', 'hello'], 'echo oops >&2; exit 3', ['true']], concurrency=2)
+	output = dict()
+	exits = dict()
+	for event in batch:
+		if 'data' in event or 'error' in event:
+			text = event.get('data', event.get('error'))
+			output[event['id']] = output.get(event['id'], '') + text
+		elif 'id' in event:
+			exits[event['id']] = event['exit']
+		else:
+			assert event['exit'] == [0, 3, 0]
+	assert output[0] == 'hello\n'
+	assert output[1] == 'oops\n'
+	assert exits == {0: 0, 1: 3, 2: 0}
+
+
+def test_batch_stdin():
+	"""
+	Verifies commands reading stdin see end of file instead of hanging
+	"""
+	with gevent.Timeout(5):
+		events = list(BatchExec([['cat'], 'read line; echo $?']))
+	assert events[-1] == dict(exit=[0, 0])
+	assert dict(id=1, data='1\n') in events
+
+
+def test_batch_abandon():
+	"""
+	Verifies abandoning a batch stops the commands still running
+	"""
+	batch = iter(BatchExec(['echo started; sleep 30']))
+	assert next(batch) == dict(id=0, data='started\n')
+	assert TaskManager.count() == 1
+	batch.close()
+	gevent.sleep(0.1)
+	assert TaskManager.count() == 0
+
+
+if __name__ == "__main__":
+	import logging
+	logging.basicConfig()
+	test_batch()
+	test_batch_stdin()
+	test_batch_abandon()
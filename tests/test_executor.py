@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import os
+import threading
+
+import gevent
+
+from kitsh.core.task import TaskManager
+from kitsh.core.forkserver import ForkServer
+from kitsh.core.executor import ThreadExecutor, ForkExecutor
+
+
+class Upper(object):
+	"""
+	Echoes its input in upper case, with where it ran
+	"""
+	def run(self, task):
+		task.output.send((os.getpid(), threading.current_thread().ident))
+		for msg in task.input:
+			task.output.send(msg.upper())
+
+
+class Broken(object):
+	def run(self, task):
+		raise ValueError("Broken")
+
+
+def echo(executor):
+	task = TaskManager.spawn(Upper(), executor=executor)
+	assert task.executor is executor
+	with task.output.watch() as sub:
+		task.input.send("derp")
+		task.input.send("merp")
+		task.input.close()
+		with gevent.Timeout(10):
+			where = sub.recv()
+			assert sub.recv() == "DERP"
+			assert sub.recv() == "MERP"
+	task.wait(timeout=10)
+	assert task.state == 'STOPPED'
+	return where
+
+
+def test_thread():
+	pid, thread = echo(ThreadExecutor(2))
+	assert pid == os.getpid()
+	assert thread != threading.current_thread().ident
+
+
+def test_fork():
+	forkserver = ForkServer()
+	try:
+		executor = ForkExecutor(2, forkserver)
+		pid, _ = echo(executor)
+		assert pid != os.getpid()
+
+		task = TaskManager.spawn(Broken(), executor=executor)
+		task.wait(timeout=10)
+		assert task.state == 'ERROR'
+
+		# Stopping a task terminates its process
+		task = TaskManager.spawn(Upper(), executor=executor)
+		with task.output.watch() as sub:
+			with gevent.Timeout(10):
+				sub.recv()
+		task.stop()
+		task.wait(timeout=10)
+		assert task.state == 'STOPPED'
+	finally:
+		forkserver.stop()
+
+
+def test_errors():
+	task = TaskManager.spawn(Broken(), executor=ThreadExecutor(1))
+	task.wait(timeout=10)
+	assert task.state == 'ERROR'
+
+
+if __name__ == "__main__":
+	import logging
+	logging.basicConfig()
+	test_thread()
+	test_fork()
+	test_errors()
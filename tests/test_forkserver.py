@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import os
+import time
+
+import gevent
+
+from kitsh.core.task import TaskManager
+from kitsh.core.inout import Message, DATA
+from kitsh.core.forkserver import ForkServer
+from kitsh.cmd.python import PythonConsole
+
+
+def read_until(sub, text, timeout=10):
+	output = b''
+	with gevent.Timeout(timeout):
+		while text not in output:
+			output += sub.recv().payload
+	return output
+
+
+def test_console():
+	"""
+	Verifies consoles run in forked children, and one stuck in a loop
+	doesn't hold up the hub
+	"""
+	forkserver = ForkServer()
+	try:
+		busy = TaskManager.spawn(PythonConsole(dict(answer=42), forkserver))
+		with busy.output.watch() as sub:
+			busy.input.send(Message(DATA, b'print(answer + 1)\r'))
+			read_until(sub, b'43')
+		assert busy.obj.pid != os.getpid()
+		busy.input.send(Message(DATA, b'while True: pass\r'))
+		before = time.time()
+		gevent.sleep(0.01)
+		assert time.time() - before < 0.5
+
+		started = time.time()
+		quiet = TaskManager.spawn(PythonConsole(forkserver=forkserver))
+		with quiet.output.watch() as sub:
+			quiet.input.send(Message(DATA, b'exit(3)\r'))
+			read_until(sub, b'>>> ')
+		quiet.wait(timeout=5)
+		assert time.time() - started < 5
+		assert quiet.obj.wait(5) == 3
+
+		busy.stop()
+		busy.wait(timeout=5)
+		assert busy.obj.wait(5) is not None
+	finally:
+		forkserver.stop()
+
+
+def test_stop():
+	"""
+	Verifies stopping doesn't wait for the template to exit
+	"""
+	forkserver = ForkServer(kill_timeout=0.5)
+	forkserver.start()
+	proc = forkserver._proc
+	started = time.time()
+	forkserver.stop()
+	assert time.time() - started < 0.5
+	assert not forkserver.running
+	assert proc.wait(5) is not None
+
+
+if __name__ == "__main__":
+	import logging
+	logging.basicConfig()
+	test_console()
+	test_stop()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import tempfile
+from argparse import Namespace
+
+import gevent
+import gevent.socket
+from gevent.event import Event
+from gevent.subprocess import Popen
+
+from kitsh.core.task import TaskManager
+from kitsh.core.process import Process
+from kitsh.core.inout import Message, DATA, SESSION
+from kitsh.core.handoff import AdoptedChild, HandoffServer, take_over
+from kitsh.core.httpd import Httpd
+from kitsh.core.mux import Multiplexer
+from kitsh.agent import dial
+from kitsh.webui import WebUI
+
+
+def echoed(task, data):
+	output = b''
+	with task.output.watch() as sub:
+		task.input.send(Message(DATA, data + b'\n'))
+		with gevent.Timeout(5):
+			while data not in output:
+				output += sub.recv().payload
+
+
+def test_adopted_child():
+	proc = Popen(['sleep', '30'])
+	child = AdoptedChild(proc.pid)
+	assert child.wait(timeout=0.1) is None
+	proc.kill()
+	assert child.wait(timeout=5) == -1
+
+
+def test_handoff():
+	path = os.path.join(tempfile.mkdtemp(), 'handoff.sock')
+	listener = gevent.socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(1)
+	old = TaskManager.spawn(Process(['cat']))
+	echoed(old, b'before')
+
+	done = Event()
+	server = HandoffServer(path, listener, done.set)
+	server.start()
+	try:
+		inherited, tasks = take_over(path)
+		assert done.wait(timeout=5)
+	finally:
+		server.stop()
+	assert inherited.getsockname() == listener.getsockname()
+	listener.close()
+
+	# The old task let go of the shell without stopping it
+	old.wait(timeout=5)
+	assert old.state == 'STOPPED'
+	new = [task for task in tasks if task.obj.pid == old.obj.pid][0]
+	assert new.obj.returncode is None
+	echoed(new, b'after')
+
+	new.stop()
+	assert new.obj.wait(timeout=5) == -1
+	new.wait()
+	inherited.close()
+
+
+def test_handoff_output():
+	"""
+	Verifies output written during the handoff is read by one side or
+	the other, none of it lost or read twice
+	"""
+	path = os.path.join(tempfile.mkdtemp(), 'handoff.sock')
+	listener = gevent.socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(1)
+	count = 1000000
+	old = TaskManager.spawn(Process(
+		['sh', '-c', 'seq 1 %d; sleep 30' % (count,)]))
+	before = b''
+	with old.output.watch() as sub:
+		before += sub.recv().payload
+		done = Event()
+		server = HandoffServer(path, listener, done.set)
+		server.start()
+		try:
+			inherited, tasks = take_over(path)
+			assert done.wait(timeout=5)
+		finally:
+			server.stop()
+		for msg in sub:
+			before += msg.payload
+	inherited.close()
+	listener.close()
+
+	new = [task for task in tasks if task.obj.pid == old.obj.pid][0]
+	after = b''
+	last = b'%d\r\n' % (count,)
+	with new.output.watch() as sub:
+		with gevent.Timeout(30):
+			while not after.endswith(last):
+				after += sub.recv().payload
+	# Handed over while it was writing
+	assert before and after
+	assert (before + after).split() == \
+		[b'%d' % (num,) for num in range(1, count + 1)]
+	new.stop()
+	new.wait()
+
+
+def test_rejoin():
+	"""
+	Verifies a client of /mux rejoins its shell on the server which took
+	over, by the session name it was given
+	"""
+	path = os.path.join(tempfile.mkdtemp(), 'handoff.sock')
+	sock = gevent.socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+
+	def shell_pid(stream):
+		output = b''
+		stream.input.send(Message(DATA, b'echo PID=$$\n'))
+		with gevent.Timeout(5):
+			while not re.search(br'PID=\d+\r', output):
+				output += stream.output.recv().payload
+		return re.search(br'PID=(\d+)\r', output).group(1)
+
+	def connect(**params):
+		client = Multiplexer(dial('ws://127.0.0.1:%d/mux' % (port,)))
+		gevent.spawn(client.run)
+		stream = client.open(**params)
+		with gevent.Timeout(5):
+			msg = stream.output.recv()
+		assert msg.kind == SESSION
+		return client, stream, msg.payload
+
+	# The running server, which exits once it has handed over
+	old = Popen([sys.executable, '-m', 'kitsh.webui', '--host', '127.0.0.1',
+				 '--port', str(port), '--handoff', path],
+				cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	with gevent.Timeout(10):
+		while not os.path.exists(path):
+			gevent.sleep(0.05)
+	client, stream, session = connect()
+	pid = shell_pid(stream)
+
+	new = Httpd([WebUI()])
+	new.configure(Namespace(
+		host='127.0.0.1', port=0, idle_timeout=None, trace_rate=0.0,
+		spill_threshold=1 << 20, spill_dir=None, handoff=path,
+		takeover=True), None)
+	new_task = TaskManager.spawn(new)
+	assert old.wait(timeout=10) is not None
+	# Its connections went with it
+	with gevent.Timeout(5):
+		while not client.closed:
+			gevent.sleep(0.01)
+
+	client, stream, rejoined = connect(session=session)
+	assert rejoined == session
+	assert shell_pid(stream) == pid
+	client.close()
+	new_task.stop()
+	new_task.wait(timeout=10)
+
+
+def test_handoff_failed():
+	"""
+	Verifies the sessions stay with the old server if the replacement
+	goes away before adopting them
+	"""
+	path = os.path.join(tempfile.mkdtemp(), 'handoff.sock')
+	listener = gevent.socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(1)
+	old = TaskManager.spawn(Process(['cat']))
+	server = HandoffServer(path, listener, lambda: None)
+	server.start()
+	try:
+		sock = gevent.socket.socket(gevent.socket.AF_UNIX)
+		sock.connect(path)
+		sock.recv(1)
+		sock.close()
+		gevent.sleep(0.1)
+		assert old.state == 'RUNNING'
+		echoed(old, b'still here')
+	finally:
+		server.stop()
+		listener.close()
+	old.stop()
+	old.wait()
+
+
+if __name__ == "__main__":
+	import logging
+	logging.basicConfig()
+	test_adopted_child()
+	test_handoff()
+	test_handoff_output()
+	test_rejoin()
+	test_handoff_failed()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+from argparse import Namespace
+
+import gevent
+
+from kitsh.core.httpd import Httpd
+from kitsh.core.task import TaskManager
+
+
+class Idle(object):
+	def run(self, task):
+		for _ in task.input:
+			pass
+
+
+def test_httpd_idle_timeout():
+	"""
+	Verifies the reaper started by Httpd stops idle sessions, but not the
+	server, which never has any channel activity of its own
+	"""
+	httpd = Httpd([])
+	options = Namespace(host='127.0.0.1', port=0, idle_timeout=0.2,
+						trace_rate=0.0, spill_threshold=1 << 20,
+						spill_dir=None, handoff=None, takeover=False)
+	httpd.configure(options, None)
+	server = TaskManager.spawn(httpd)
+	session = TaskManager.spawn(Idle())
+	session.wait(timeout=2)
+	assert session.state == 'STOPPED'
+	gevent.sleep(0.3)
+	assert server.state == 'RUNNING'
+	assert TaskManager._reaper is not None
+	server.stop()
+	server.wait(timeout=2)
+	assert server.state == 'STOPPED'
+	assert TaskManager._reaper is None
+
+
+if __name__ == "__main__":
+	import logging
+	logging.basicConfig()
+	test_httpd_idle_timeout()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
-from kitsh.core.inout import Channel, DataStream
+import gevent
+
+from kitsh.core.inout import (Channel, DataStream, History, MessageQueue,
+							   Message, MessageFilter, Publisher, SpillQueue,
+							   DATA, ERROR, RESIZE)
 
 
 def test_channel():
@@ -21,15 +25,36 @@ def test_channel():
 def test_datastream():
 	sockB = Channel()
 	with DataStream(sockB) as streamB:
-		streamB.write("derp\nmer")
-		streamB.write("p\nyay\n")
+		streamB.write(b"derp\nmer")
+		streamB.write(b"p\nyay\n")
 		sockB.close()
-		streamB.readline() == "derp"
-		streamB.readline() == "merp"
-		streamB.readline() == "yay"
+		assert streamB.readline() == b"derp"
+		assert streamB.readline() == b"merp"
+		assert streamB.readline() == b"yay"
+		assert streamB.readline() == b""
 
 
-# TODO: test DataStream.read(), where maxbytes != None
+def test_datastream_read():
+	chan = Channel()
+	with chan.datastream() as stream:
+		stream.write(b"abc")
+		stream.write(b"defg")
+		assert stream.read(2) == b"ab"
+		assert stream.read(4) == b"cdef"
+		chan.close()
+		assert stream.read(4) == b"g"
+		assert stream.read() == b""
+
+
+def test_datastream_text():
+	chan = Channel()
+	snowman = u"\u2603".encode('utf-8')
+	# A character split across messages is decoded once it is complete
+	chan.send(Message(DATA, b"x" + snowman[:1]))
+	chan.send(Message(DATA, snowman[1:] + b"y\n"))
+	chan.close()
+	with chan.datastream('utf-8') as stream:
+		assert stream.readline() == u"x\u2603y"
 
 
 def test_subscribe():
@@ -57,7 +82,176 @@ def test_subscribe():
 			chan.close()
 
 
+def test_message():
+	msg = Message.from_dict({'resize': {'width': 80, 'height': 24}})
+	assert msg.kind == RESIZE
+	assert msg.payload == {'width': 80, 'height': 24}
+	assert Message(DATA, "x").to_dict() == {'data': "x"}
+	try:
+		Message.from_dict({'bogus': 1})
+	except ValueError:
+		pass
+	else:
+		assert False
+
+
+def test_queue():
+	queue = MessageQueue()
+	assert len(queue) == 0
+	reader = gevent.spawn(queue.get)
+	gevent.sleep(0)
+	queue.put_nowait("first")
+	queue.put_nowait("second")
+	assert reader.get() == "first"
+	assert len(queue) == 1
+	assert queue.get() == "second"
+	assert len(queue) == 0
+
+
+def test_history():
+	chan = Channel()
+	history = History(chan, maxlen=2)
+	for msg in ("a", "b", "c"):
+		chan.send(msg)
+	assert history.last == 3
+	assert history.since(0) == [(2, "b"), (3, "c")]
+	assert history.since(2) == [(3, "c")]
+	assert history.since(3) == []
+	chan.close()
+	assert history.closed
+
+
+def test_batches():
+	chan = Channel()
+	chan.send_many(["a", "b", "c"])
+	assert len(chan) == 3
+	assert chan.recv_many() == ["a", "b", "c"]
+	assert chan.nmsgs == 3
+
+	# Watchers get what was buffered before what is sent now
+	chan.send("d")
+	received = []
+	chan.attach(received.append)
+	chan.send_many(["e", "f"])
+	assert received == ["d", "e", "f"]
+	assert len(chan) == 0
+	chan.detach(received.append)
+
+	chan.send_many(["g", StopIteration])
+	assert chan.recv_many() == ["g", StopIteration]
+	assert chan.closed
+
+
+def test_publisher():
+	pub = Publisher()
+	received = []
+
+	def first(msg):
+		received.append(("first", msg))
+		# Still called for this message, not for the next
+		pub.detach(second)
+
+	def second(msg):
+		received.append(("second", msg))
+
+	pub.attach(first)
+	pub.attach(second)
+	pub.attach(first)
+	assert len(pub) == 2
+	pub.send(1)
+	pub.send(2)
+	assert received == [("first", 1), ("second", 1), ("first", 2)]
+	pub.detach(first)
+	assert len(pub) == 0
+
+
+def test_filtered():
+	chan = Channel()
+	resizes = chan.watch(kinds=(RESIZE,))
+	prompts = chan.watch(regex=b"\\$ $")
+	errors = chan.watch(kinds=(ERROR,), line_mode=True)
+	lines = chan.watch(regex=u"^ok", line_mode=True)
+	data = chan.watch(kinds=DATA)
+	chan.send(Message(DATA, b"ok 1\r\nnot ok 2\r\no"))
+	chan.send(Message(RESIZE, {'width': 80, 'height': 24}))
+	chan.send(Message(ERROR, b"bad"))
+	chan.send(Message(DATA, b"k 3\nuser@host $"))
+	chan.send(Message(DATA, b" "))
+	chan.send(Message(ERROR, b" thing\n"))
+	chan.send(Message(DATA, b"\nok 4"))
+	chan.close()
+
+	assert list(resizes) == [Message(RESIZE, {'width': 80, 'height': 24})]
+	# The prompt is split across two messages
+	assert list(prompts) == [Message(DATA, b" ")]
+	assert list(errors) == [Message(ERROR, b"bad thing")]
+	assert list(lines) == [Message(DATA, b"ok 1"), Message(DATA, b"ok 3"),
+						   Message(DATA, b"ok 4")]
+	assert len(list(data)) == 4
+
+
+def test_filtered_long_lines():
+	chan = Channel()
+	lines = chan.watch(regex=b"ab", line_mode=True)
+	chan.send(Message(DATA, b"a" * 300))
+	chan.send(Message(DATA, b"b\n"))
+	chan.close()
+	assert list(lines) == [Message(DATA, b"a" * 300 + b"b")]
+
+	msgfilter = MessageFilter(line_mode=True, max_line=4)
+	assert msgfilter(Message(DATA, b"abcdefghij")) == (
+		Message(DATA, b"abcd"), Message(DATA, b"efgh"))
+	assert msgfilter(StopIteration) == (Message(DATA, b"ij"), StopIteration)
+
+
+def test_spill():
+	threshold = SpillQueue.threshold
+	SpillQueue.threshold = 100
+	try:
+		chan = Channel()
+		sent = [Message(DATA, b"%02d" % (i,) * 10) for i in range(20)]
+		sent.insert(5, Message(RESIZE, {'width': 80, 'height': 24}))
+		sent.insert(10, "not a message")
+		# Can't be pickled, so it is held in memory in its place
+		sent.insert(1, lambda: None)
+		for msg in sent:
+			chan.send(msg)
+		queue = chan._recvq
+		assert len(chan) == len(sent)
+		assert 0 < queue.spilled
+		assert queue._nbytes <= 100
+		assert [chan.recv() for _ in range(3)] == sent[:3]
+		# A batch only holds about the threshold of what was spilled
+		received = []
+		while len(chan):
+			batch = chan.recv_many()
+			assert sum(len(msg.payload) for msg in batch
+					   if getattr(msg, 'kind', None) == DATA) <= 120
+			received += batch
+		assert received == sent[3:]
+		assert queue.spilled == 0 and queue._spill is None
+
+		# Spilled while a reader waits for the first message
+		reader = gevent.spawn(lambda: [chan.recv() for _ in sent])
+		gevent.sleep(0)
+		for msg in sent:
+			chan.send(msg)
+		assert reader.get(timeout=5) == sent
+	finally:
+		SpillQueue.threshold = threshold
+
+
 if __name__ == "__main__":
 	test_channel()
 	test_datastream()
+	test_datastream_read()
+	test_datastream_text()
 	test_subscribe()
+	test_message()
+	test_queue()
+	test_history()
+	test_batches()
+	test_publisher()
+	test_filtered()
+	test_filtered_long_lines()
+	test_spill()
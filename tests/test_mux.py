@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import gevent
+from gevent.queue import Queue
+
+from kitsh.core.task import TaskManager
+from kitsh.core.mux import Multiplexer
+from kitsh.core.inout import Message, DATA
+from kitsh.core.process import Process
+from kitsh.agent import Agent, AgentRouter
+
+
+class Pipe(object):
+	"""
+	One end of an in-memory message connection
+	"""
+	def __init__(self, inbox, outbox):
+		self.inbox = inbox
+		self.outbox = outbox
+
+	def send(self, data):
+		self.outbox.put(data)
+
+	def receive(self):
+		return self.inbox.get()
+
+	def close(self):
+		self.outbox.put(None)
+		self.inbox.put(None)
+
+
+def pipe_pair():
+	a, b = Queue(), Queue()
+	return Pipe(a, b), Pipe(b, a)
+
+
+def settle(count, timeout=5):
+	"""
+	Waits for the tasks of a test to finish
+	"""
+	with gevent.Timeout(timeout):
+		while TaskManager.count() > count:
+			gevent.sleep(0.01)
+
+
+class Echo(object):
+	def run(self, task):
+		for msg in task.input:
+			task.output.send(msg)
+
+
+def test_streams():
+	"""
+	Verifies messages of several streams go over one connection, and
+	closing a stream closes the other end
+	"""
+	before = TaskManager.count()
+	left, right = pipe_pair()
+
+	def onopen(stream_task):
+		echo = TaskManager.spawn(Echo())
+		with stream_task.bridge(echo) as bridge:
+			bridge.wait()
+		echo.stop()
+		stream_task.stop()
+
+	server = Multiplexer(right, initiator=False, onopen=onopen)
+	client = Multiplexer(left, initiator=True)
+	runners = [gevent.spawn(server.run), gevent.spawn(client.run)]
+
+	streams = [client.open() for _ in range(3)]
+	for num, stream in enumerate(streams):
+		stream.input.send(Message(DATA, b'hello %d' % (num,)))
+		stream.input.send(Message('resize', dict(width=80, height=24)))
+	for num, stream in enumerate(streams):
+		assert stream.output.recv() == Message(DATA, b'hello %d' % (num,))
+		assert stream.output.recv() == \
+			Message('resize', dict(width=80, height=24))
+	assert len(server) == 3
+
+	streams[0].stop()
+	streams[0].wait()
+	gevent.sleep(0.01)
+	assert len(server) == 2
+	assert len(client) == 2
+
+	# Losing the connection ends every stream
+	left.close()
+	gevent.joinall(runners, timeout=1)
+	for stream in streams:
+		stream.wait(timeout=1)
+		assert stream.state != 'RUNNING'
+	assert len(client) == 0
+	settle(before)
+
+
+def test_window():
+	"""
+	Verifies the other end stops sending, and the process stops being
+	read, when the opener's window is used up
+	"""
+	before = TaskManager.count()
+	left, right = pipe_pair()
+
+	def onopen(stream_task):
+		proc = TaskManager.spawn(Process(
+			['head', '-c', '1000000', '/dev/zero'], tty=False))
+		stream_task.obj.throttle = proc.output
+		with stream_task.bridge(proc) as bridge:
+			bridge.wait()
+		proc.stop()
+		stream_task.stop()
+
+	server = Multiplexer(right, initiator=False, onopen=onopen)
+	client = Multiplexer(left, initiator=True)
+	gevent.spawn(server.run)
+	gevent.spawn(client.run)
+
+	stream = client.open(window=100000)
+	with stream.output.watch() as sub:
+		def recv():
+			msg = sub.recv()
+			return len(msg.payload) if msg is not None else 0
+
+		received = 0
+		while received < 100000:
+			received += recv()
+		gevent.sleep(0.1)
+		while len(sub) > 1:
+			received += recv()
+		# Never more than the window
+		assert received == 100000
+
+		while received < 1000000:
+			stream.obj.grant(100000)
+			received += recv()
+	assert received == 1000000
+	client.close()
+	settle(before)
+
+
+def test_router():
+	"""
+	Verifies sessions are placed on the least loaded agent
+	"""
+	before = TaskManager.count()
+	router = AgentRouter(token='secret')
+	agents = []
+	for num in range(2):
+		left, right = pipe_pair()
+		agents.append(gevent.spawn(Agent(name='agent%d' % (num,),
+		                                 shell='cat', token='secret').attach,
+		                           right))
+		gevent.spawn(router.serve, left, 'pipe%d' % (num,))
+	gevent.sleep(0.01)
+	assert sorted(agent['name'] for agent in router.agents()) == \
+		['agent0', 'agent1']
+
+	sessions = [router.open() for _ in range(4)]
+	assert sorted(agent['sessions'] for agent in router.agents()) == [2, 2]
+	assert router.open('agent1') is not None
+
+	sessions[0].input.send(Message(DATA, b'ping\n'))
+	data = b''
+	while b'ping' not in data:
+		data += sessions[0].output.recv().payload
+
+	for mux in list(router._agents):
+		mux.close()
+	gevent.joinall(agents, timeout=5)
+	assert len(router) == 0
+	settle(before)
+
+
+def test_router_reject():
+	"""
+	Verifies agents with the wrong token or an invalid hello are
+	disconnected, as are all agents when the router has no token
+	"""
+	before = TaskManager.count()
+	for token, hello in (('secret', dict(token='wrong')),
+	                     ('secret', dict(capacity='lots', token='secret')),
+	                     ('secret', dict(name=42, token='secret')),
+	                     (None, dict(token=None))):
+		router = AgentRouter(token=token)
+		left, right = pipe_pair()
+		server = gevent.spawn(router.serve, left, 'pipe')
+		Multiplexer(right, initiator=False).send_control(dict(hello=hello))
+		server.join(timeout=5)
+		assert server.ready()
+		assert len(router) == 0
+		assert router.open() is None
+	settle(before)
+
+
+if __name__ == "__main__":
+	test_streams()
+	test_window()
+	test_router()
+	test_router_reject()
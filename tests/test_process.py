@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import signal
+
 from kitsh.core.process import Process
 from kitsh.core.task import TaskManager
 
@@ -10,7 +12,98 @@ def test_proc_stdout():
 	assert len(task.output) > 0
 
 
+def test_proc_notty():
+	task = TaskManager.spawn(Process(
+		['sh', '-c', 'echo out; echo err >&2'], tty=False))
+	output = dict()
+	with task.output.watch() as sub:
+		for msg in sub:
+			output[msg.kind] = output.get(msg.kind, b'') + msg.payload
+	task.wait()
+	assert output == {'data': b'out\n', 'error': b'err\n'}
+
+
+def test_proc_kill():
+	proc = Process(['sh', '-c', 'trap "" TERM; echo ready; sleep 30'],
+				   kill_timeout=0.1)
+	task = TaskManager.spawn(proc)
+	with task.output.watch() as sub:
+		sub.recv()
+		task.stop()
+	assert proc.wait(timeout=5) == -signal.SIGKILL
+	task.wait()
+
+
+def test_proc_limits():
+	proc = Process(['sh', '-c', 'ulimit -n'], tty=False,
+				   limits=dict(nofile=42, cpu=(60, 120)))
+	task = TaskManager.spawn(proc)
+	with task.output.datastream() as stream:
+		assert stream.read() == b'42\n'
+	assert not proc.over_limit()
+	task.wait()
+
+
+def test_proc_pipe():
+	source = TaskManager.spawn(Process(['sh', '-c', 'sleep 0.2; echo piped']))
+	sink = TaskManager.spawn(Process(['cat']))
+	with TaskManager.pipe(source, sink):
+		output = b''
+		with sink.output.watch() as sub:
+			for msg in sub:
+				output += msg.payload
+				if b'piped' in output:
+					break
+		source.wait()
+	# Also counted when spliced straight into the sink's PTY
+	assert source.output.nbytes >= len(b'piped\n')
+	sink.stop()
+	sink.wait()
+
+
+def test_proc_pipe_eof():
+	"""
+	Verifies a pipe of processes ends like a shell pipeline, each command
+	seeing the end of the previous one's output
+	"""
+	first = TaskManager.spawn(Process(['printf', 'b\\na\\n'], tty=False))
+	second = TaskManager.spawn(Process(['sort'], tty=False))
+	third = TaskManager.spawn(Process(['cat'], tty=False))
+	with third.output.watch() as sub:
+		with TaskManager.pipe(first, second, third) as pipe:
+			output = b''.join(msg.payload for msg in sub)
+			pipe.wait(timeout=5)
+			assert pipe.closed
+	assert output == b'a\nb\n'
+	for task in (first, second, third):
+		task.wait(timeout=5)
+		assert task.state == 'STOPPED'
+
+
+def test_proc_pipe_dst_stop():
+	"""
+	Verifies stopping the destination of a pipe releases its PTY, rather
+	than the source keeping a copy of it open
+	"""
+	source = TaskManager.spawn(Process(['sh', '-c', 'sleep 30']))
+	sink = TaskManager.spawn(Process(['cat']))
+	with TaskManager.pipe(source, sink) as pipe:
+		assert source.obj._sink is not None
+		sink.stop()
+		pipe.wait(timeout=5)
+		assert pipe.closed
+		assert source.obj._sink is None
+	source.stop()
+	source.wait(timeout=5)
+
+
 if __name__ == "__main__":
 	import logging
 	logging.basicConfig()
 	test_proc_stdout()
+	test_proc_notty()
+	test_proc_kill()
+	test_proc_limits()
+	test_proc_pipe()
+	test_proc_pipe_eof()
+	test_proc_pipe_dst_stop()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+from kitsh.core.inout import Channel
+from kitsh.core.sched import OutputScheduler
+
+
+def test_quota():
+	sched = OutputScheduler(quantum=10, timeslice=60)
+	chan = Channel()
+	quota = sched.quota(chan)
+	quota.charge(5)
+	assert quota.yields == 0
+	assert not quota.interactive
+	quota.charge(5)
+	assert quota.yields == 1
+
+	# Small output answering fresh input is interactive
+	chan.send("key")
+	quota.charge(1)
+	assert quota.interactive
+	quota.charge(20)
+	assert not quota.interactive
+	assert quota.yields == 2
+
+
+if __name__ == "__main__":
+	test_quota()
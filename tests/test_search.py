@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import os
+import json
+import sqlite3
+import tempfile
+
+from flask import Flask
+
+from kitsh.core.task import TaskManager
+from kitsh.core.inout import Message, DATA
+from kitsh.search import OutputIndex, clean
+from kitsh.webui import WebUI
+
+
+def shell(task):
+	for data in (b"\x1b[01;32muser@prod\x1b[00m:~$ rm -r", b"f /tmp/x\r\n",
+				 b"progress 10%\rprogress 100%\r\n", b"no newline"):
+		task.output.send(Message(DATA, data))
+
+
+def test_clean():
+	assert clean(u"\x1b]0;title\x07$ ls\x1b[K\r\n") == u"$ ls"
+	assert clean(u"rn\bm -rf\r\n") == u"rm -rf"
+
+
+def test_index():
+	outidx = OutputIndex(':memory:')
+	task = TaskManager.spawn(shell)
+	session = outidx.record(task, 'prod')
+	task.wait(timeout=5)
+	# Tapping the output doesn't take it from the task's reader
+	assert [msg.payload for msg in task.output][-1] == b"no newline"
+
+	found = outidx.search(u"rm -rf")
+	assert len(found) == 1
+	assert found[0]['session'] == session
+	assert found[0]['name'] == 'prod'
+	assert found[0]['offset'] == 0
+	assert found[0]['text'] == u"user@prod:~$ [rm -rf] /tmp/x"
+	assert outidx.search(u"rm -rf", until=found[0]['time']) == []
+	assert [row['text'] for row in outidx.search(u"progress")] == \
+		[u"[progress] 100%"]
+
+	lines = outidx.context(session, found[0]['offset'] + 1)
+	assert [line['text'] for line in lines] == [u"progress 100%",
+												u"no newline"]
+	assert lines[0]['offset'] == 41
+	outidx.close()
+
+
+def test_search_route():
+	handle, path = tempfile.mkstemp(suffix='.db')
+	os.close(handle)
+	try:
+		webui = WebUI(index_path=path)
+		with open(path + '.out', 'wb') as output:
+			output.write(b"$ rm -rf /\r\n")
+		session = webui.output_index.add_file(path + '.out')
+		app = Flask(__name__)
+		app.register_blueprint(webui)
+		client = app.test_client()
+		found = json.loads(client.get('/search?q=rm+-rf').data)
+		assert [row['session'] for row in found] == [session]
+		assert client.get('/search?q=rm+-rf+"&raw=1').status_code == 400
+		lines = json.loads(client.get('/search/%d?offset=0' % (session,)).data)
+		assert lines[0]['text'] == u"$ rm -rf /"
+
+		# Pending lines are written on shutdown
+		webui.output_index.add(session, 100, 0.0, u"pending")
+		webui.close()
+		db = sqlite3.connect(path)
+		assert db.execute('SELECT count(*) FROM lines WHERE text = ?',
+						  (u"pending",)).fetchone() == (1,)
+		db.close()
+	finally:
+		for name in (path, path + '.out', path + '-wal', path + '-shm'):
+			if os.path.exists(name):
+				os.unlink(name)
+
+
+if __name__ == "__main__":
+	test_clean()
+	test_index()
+	test_search_route()
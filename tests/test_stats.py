@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import gevent
+from gevent.event import Event
+from kitsh.core.task import Task, TaskManager
+from kitsh.core.stats import TaskStats
+from kitsh.core.inout import Message, DATA
+
+
+class Echo(object):
+	def run(self, task):
+		for msg in task.input:
+			task.output.send(msg)
+
+
+def test_refresh():
+	"""
+	Verifies the first refresh has every task, and later ones only the
+	tasks which changed or went away
+	"""
+	stats = TaskStats()
+	task = TaskManager.spawn(Echo())
+	gevent.sleep(0)
+	update = stats.refresh()
+	rows = dict((row['id'], row) for row in update['rows'])
+	assert id(task) in rows
+	assert rows[id(task)]['state'] == task.state
+	assert update['removed'] == []
+
+	# Nothing happened, so nothing to report
+	update = stats.refresh()
+	assert id(task) not in [row['id'] for row in update['rows']]
+
+	task.input.send(Message(DATA, b'x' * 1000))
+	gevent.sleep(0.01)
+	update = stats.refresh()
+	rows = dict((row['id'], row) for row in update['rows'])
+	assert rows[id(task)]['in_rate'] > 0
+	assert rows[id(task)]['out_rate'] > 0
+
+	task.input.close()
+	task.wait()
+	gevent.sleep(0)
+	update = stats.refresh()
+	assert id(task) in update['removed']
+	assert id(task) not in [row['id'] for row in stats.rows()]
+	stats.close()
+
+
+class Waiter(object):
+	def __init__(self, event):
+		self.event = event
+
+	def run(self, task):
+		self.event.wait()
+
+
+def test_lazy_channels():
+	"""
+	Verifies measuring a task doesn't create the channels it never used,
+	and tasks spawned later are picked up from their events
+	"""
+	event = Event()
+	stats = TaskStats()
+	stats.refresh()
+	task = Task(Waiter(event))
+	rows = dict((row['id'], row) for row in stats.refresh()['rows'])
+	assert rows[id(task)]['state'] == 'NEW'
+	assert rows[id(task)]['in_queue'] == 0
+	assert task._input is None and task._output is None
+	assert stats.refresh()['rows'] == []
+	task.start()
+	gevent.sleep(0)
+	rows = dict((row['id'], row) for row in stats.refresh()['rows'])
+	assert rows[id(task)]['state'] == 'RUNNING'
+	event.set()
+	task.wait()
+	assert id(task) in stats.refresh()['removed']
+	stats.close()
+
+
+if __name__ == "__main__":
+	test_refresh()
+	test_lazy_channels()
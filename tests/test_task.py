@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import gevent
 from kitsh.core.task import TaskManager
 from gevent.event import Event
 
@@ -13,7 +14,7 @@ def test_stdio():
 		print("Derp")
 		print("Merp")
 	task = TaskManager.spawn(printer)
-	with task.output.datastream() as stream:
+	with task.output.datastream('utf-8') as stream:
 		assert stream.readline() == "Derp"
 		assert stream.readline() == "Merp"
 	task.wait()
@@ -61,8 +62,94 @@ def test_bridge():
 	assert TaskManager.count() == 0
 
 
+class Idle(object):
+	def run(self, task):
+		for _ in task.input:
+			pass
+
+
+class Doubler(object):
+	def run(self, task):
+		for msg in task.input:
+			task.output.send(msg * 2)
+
+
+def test_pipe():
+	source = TaskManager.spawn(Idle())
+	doubler = TaskManager.spawn(Doubler())
+	with TaskManager.pipe(source, doubler) as pipe:
+		with doubler.output.watch() as sub:
+			source.output.send("ab")
+			assert sub.recv() == "abab"
+			# Pipes only go one way
+			doubler.output.send("cd")
+			assert len(source.input) == 0
+		source.stop()
+		pipe.wait()
+		assert pipe.closed
+	doubler.stop()
+	doubler.wait()
+	source.wait()
+
+
+def test_pipe_ended():
+	"""
+	Verifies piping into a task which has already stopped closes the pipe
+	"""
+	source = TaskManager.spawn(Idle())
+	stopped = TaskManager.spawn(Idle())
+	stopped.stop()
+	stopped.wait()
+	with TaskManager.pipe(source, stopped) as pipe:
+		assert pipe.closed
+	source.stop()
+	source.wait()
+
+
+def test_reap():
+	idle = TaskManager.spawn(Idle(), idle_timeout=0.05)
+	busy = TaskManager.spawn(Idle(), idle_timeout=60)
+	gevent.sleep(0.1)
+	assert idle.expired()
+	assert not busy.expired()
+	assert TaskManager.reap() == 1
+	idle.wait()
+	assert idle.state == 'STOPPED'
+	assert busy.state == 'RUNNING'
+	busy.stop()
+	busy.wait()
+
+
+def test_events():
+	"""
+	Verifies lifecycle events are published as tasks come and go
+	"""
+	with TaskManager.watch() as sub:
+		task = TaskManager.spawn(lambda task: None)
+		task.wait()
+		gevent.sleep(0)
+		events = [sub.recv() for _ in range(len(sub))]
+	assert [event.kind for event in events] == \
+		['spawned', 'running', 'stopped']
+	assert all(event.task is task for event in events)
+	info = events[-1].to_dict()
+	assert info['id'] == id(task)
+	assert info['state'] == 'STOPPED'
+	assert info['elapsed'] >= 0
+
+	idle = TaskManager.spawn(Idle())
+	gevent.sleep(0)
+	assert id(idle) in [id(event.task) for event in TaskManager.snapshot()]
+	idle.input.close()
+	idle.wait()
+
+
 if __name__ == "__main__":
 	import logging
 	logging.basicConfig()
 	test_stdio()
 	test_bridge()
+	test_pipe()
+	test_pipe_ended()
+	test_reap()
+	test_events()
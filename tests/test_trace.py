@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+from gevent.event import Event
+
+from kitsh.core.task import TaskManager
+from kitsh.core.process import Process
+from kitsh.core.websocket import Websocket
+from kitsh.core.trace import TRACER, Tracer, Histogram
+from kitsh.core.inout import Message, TracedMessage, DATA
+
+
+class FakeSocket(object):
+	"""
+	Websocket which receives nothing until closed, keeping what's sent
+	"""
+	def __init__(self):
+		self.sent = []
+		self.closed = Event()
+
+	def send(self, data):
+		self.sent.append(data)
+
+	def receive(self):
+		self.closed.wait()
+
+	def close(self):
+		self.closed.set()
+
+
+def test_histogram():
+	histogram = Histogram()
+	for micros in (1, 10, 100, 1000):
+		histogram.add(micros / 1000000.0)
+	assert histogram.count == 4
+	# Upper bounds of the power of two buckets
+	assert histogram.percentile(0.5) == 16 / 1000000.0
+	assert histogram.percentile(1.0) == 0.001
+	assert histogram.to_dict()['max_ms'] == 1.0
+
+
+def test_sampling():
+	tracer = Tracer(rate=0.25)
+	msgs = [tracer.message(DATA, b'x') for _ in range(8)]
+	traced = [msg for msg in msgs if type(msg) is TracedMessage]
+	assert len(traced) == 2
+	assert all(msg == Message(DATA, b'x') for msg in msgs)
+	tracer.rate = 0
+	assert type(tracer.message(DATA, b'x')) is Message
+
+
+def test_trace():
+	"""
+	Verifies output traced from a process to a websocket is recorded for
+	every stage it passes
+	"""
+	TRACER.rate = 1
+	TRACER.reset()
+	try:
+		sock = FakeSocket()
+		proc = TaskManager.spawn(Process(['echo', 'traced']))
+		ws = TaskManager.spawn(Websocket(sock))
+		with ws.bridge(proc):
+			proc.wait()
+		ws.stop()
+		ws.wait()
+		assert any('traced' in data for data in sock.sent)
+		stages = TRACER.to_dict()['stages']
+		for stage in ('read->send', 'send->forward', 'forward->send',
+					  'send->recv', 'recv->encode', 'encode->sent', 'total'):
+			assert stages[stage]['count'] > 0, stage
+	finally:
+		TRACER.rate = 0
+		TRACER.reset()
+
+
+if __name__ == "__main__":
+	import logging
+	logging.basicConfig()
+	test_histogram()
+	test_sampling()
+	test_trace()